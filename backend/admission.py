@@ -0,0 +1,106 @@
+import math
+import threading
+
+import config
+import metrics
+
+
+class AdmissionRejected(Exception):
+    """Raised when a lane of a model has no room for another request"""
+    def __init__(self, model_id, lane, retry_after):
+        super().__init__(f"Too many requests queued for {model_id} ({lane}); retry in {retry_after}s")
+        self.model_id = model_id
+        self.lane = lane
+        self.retry_after = retry_after
+
+
+def estimate_cost(prompt, max_tokens):
+    """
+    Tokens a request will occupy: its prompt plus everything it may generate
+
+    The prompt is estimated from its length so admission does not need the
+    model's tokenizer, which may only be loaded in a worker process.
+    """
+    return math.ceil(len(prompt) / config.ADMISSION_CHARS_PER_TOKEN) + int(max_tokens)
+
+
+class Ticket:
+    def __init__(self, model_id, lane, cost):
+        self.model_id = model_id
+        self.lane = lane
+        self.cost = cost
+        self.released = False
+
+
+class AdmissionController:
+    """
+    Token-budget admission per model and priority lane
+
+    Every (model, lane) pair holds at most its lane's token budget and
+    request count across queued and running generations; anything beyond is
+    turned away with a retry hint instead of queueing without bound. Lanes
+    have separate budgets, so a burst of long financial-advice generations
+    cannot crowd out short chat requests; once admitted, the scheduler also
+    lets each lane into the batch by its LANE_PRIORITIES. A request larger
+    than the whole budget is still admitted when its lane is otherwise empty.
+    """
+    def __init__(self, token_budgets=None, max_requests=None):
+        self.token_budgets = token_budgets or config.ADMISSION_TOKEN_BUDGETS
+        self.max_requests = max_requests or config.ADMISSION_MAX_REQUESTS
+        self._usage = {}
+        self._lock = threading.Lock()
+        self.admitted = 0
+        self.rejected = 0
+
+    def acquire(self, model_id, lane, cost):
+        """
+        Reserve room for a request
+
+        Returns:
+            Ticket to pass to release() once the request has finished
+
+        Raises:
+            AdmissionRejected: The lane is full for this model
+        """
+        with self._lock:
+            tokens, requests = self._usage.get((model_id, lane), (0, 0))
+            budget = self.token_budgets[lane]
+            full = requests >= self.max_requests[lane] or (requests and tokens + cost > budget)
+            if full:
+                self.rejected += 1
+                retry_after = self._retry_after(tokens + cost - budget)
+            else:
+                self.admitted += 1
+                self._usage[(model_id, lane)] = (tokens + cost, requests + 1)
+        if full:
+            metrics.ADMISSION_REJECTIONS.inc(lane)
+            raise AdmissionRejected(model_id, lane, retry_after)
+        return Ticket(model_id, lane, cost)
+
+    def release(self, ticket):
+        with self._lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            tokens, requests = self._usage[(ticket.model_id, ticket.lane)]
+            if requests <= 1:
+                del self._usage[(ticket.model_id, ticket.lane)]
+            else:
+                self._usage[(ticket.model_id, ticket.lane)] = (tokens - ticket.cost, requests - 1)
+
+    def _retry_after(self, excess_tokens):
+        """Seconds until enough queued tokens should have drained"""
+        return max(1, math.ceil(max(excess_tokens, 0) / config.ADMISSION_DRAIN_TOKENS_PER_SECOND))
+
+    def stats(self):
+        with self._lock:
+            return {
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'token_budgets': dict(self.token_budgets),
+                'max_requests': dict(self.max_requests),
+                'usage': [
+                    {'model_id': model_id, 'lane': lane, 'tokens': tokens, 'requests': requests}
+                    for (model_id, lane), (tokens, requests) in self._usage.items()
+                ],
+            }
@@ -1,16 +1,25 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context, g, send_file
 from flask_cors import CORS
 import os
 import json
 from datetime import datetime
 import threading
+import time
+import uuid
 from werkzeug.utils import secure_filename
 import train
 import inference
+import batch_job
 import config
 import database
 import financial_advisor
 import location_handler
+import latency
+import metrics
+import worker_pool
+from admission import AdmissionController, AdmissionRejected, estimate_cost
+from cancellation import GenerationCancelled
+from latency import LatencyTrace
 app = Flask(__name__)
 CORS(app)
 
@@ -19,10 +28,306 @@ app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024
 app.config['ALLOWED_EXTENSIONS'] = {'json', 'jsonl', 'csv'}
 
 training_status = {}
+batch_status = {}
+admission_controller = AdmissionController()
+
+def inference_backend():
+    """In-process inference, or the worker pool when INFERENCE_WORKERS is set"""
+    if config.INFERENCE_WORKERS:
+        return worker_pool.get_pool()
+    return inference
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
+def sse_event(event, data):
+    """Format one Server-Sent Events message"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+class BadRequest(Exception):
+    """A request body that failed validation, answered with status"""
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+def parse_timeout(data):
+    """The optional 'timeout' field of a request body in seconds, or None"""
+    timeout = data.get('timeout')
+    if timeout is None:
+        return None
+    if isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or timeout <= 0:
+        raise BadRequest("timeout must be a positive number of seconds")
+    return float(timeout)
+
+def parse_generation_params(data, max_tokens=256, temperature=0.7):
+    """
+    The max_tokens and temperature fields of a request (JSON or form), with defaults
+    
+    Raises:
+        BadRequest: A value is not a number or out of range
+    """
+    try:
+        max_tokens = int(data.get('max_tokens', max_tokens))
+        temperature = float(data.get('temperature', temperature))
+    except (TypeError, ValueError):
+        raise BadRequest("max_tokens and temperature must be numbers")
+    if max_tokens <= 0 or temperature < 0:
+        raise BadRequest("max_tokens must be positive and temperature non-negative")
+    return max_tokens, temperature
+
+def _model_path(model_id):
+    model_path = os.path.join(config.MODEL_PATH, model_id)
+    if not os.path.exists(model_path):
+        raise BadRequest('Model not found', 404)
+    return model_path
+
+def parse_chat_request(data):
+    """
+    Validate the body of a chat request (Flask and ASGI routes alike)
+    
+    Returns:
+        Dict with model_id, message, session_id, request_id, the admission
+        cost, whether to decode speculatively, and under 'generate' the
+        arguments every generation call takes
+    
+    Raises:
+        BadRequest: Missing fields, unknown model or invalid values
+    """
+    if not data or 'model_id' not in data or 'message' not in data:
+        raise BadRequest('Missing fields')
+    
+    model_id = data['model_id']
+    message = data['message']
+    max_tokens, temperature = parse_generation_params(data)
+    request_id = data.get('request_id') or uuid.uuid4().hex
+    return {
+        'model_id': model_id,
+        'message': message,
+        'session_id': data.get('session_id', None),
+        'request_id': request_id,
+        'cost': estimate_cost(message, max_tokens),
+        'speculative': bool(data.get('speculative')) and config.SPECULATIVE_DECODING,
+        'generate': {
+            'model_path': _model_path(model_id),
+            'prompt': message,
+            'max_tokens': max_tokens,
+            'temperature': temperature,
+            'request_id': request_id,
+            'timeout': parse_timeout(data),
+        },
+    }
+
+def finish_chat(chat_request, response_text, trace, speculative_stats=None):
+    """Save a finished chat turn and build the body returned for it"""
+    with trace.time('db_write'):
+        database.save_conversation(
+            user_message=chat_request['message'],
+            ai_response=response_text,
+            model_id=chat_request['model_id'],
+            session_id=chat_request['session_id']
+        )
+    
+    result = {
+        'success': True,
+        'response': response_text,
+        'model_id': chat_request['model_id'],
+        'request_id': chat_request['request_id'],
+        'latency': latency.record(chat_request['model_id'], trace),
+        'timestamp': datetime.now().isoformat()
+    }
+    if speculative_stats is not None:
+        result['speculative'] = speculative_stats
+    return result
+
+REQUIRED_ADVICE_FIELDS = ['age', 'income', 'debt', 'savings', 'city', 'state', 'goals', 'model_id']
+
+def parse_advice_request(data):
+    """
+    Validate the body of a financial advice request
+    
+    Returns:
+        Dict like parse_chat_request's, plus the request body under 'data'
+    
+    Raises:
+        BadRequest: Missing fields, unknown model or invalid values
+    """
+    for field in REQUIRED_ADVICE_FIELDS:
+        if not data or field not in data:
+            raise BadRequest(f'Missing field: {field}')
+    
+    model_id = data['model_id']
+    model_path = _model_path(model_id)
+    request_id = data.get('request_id') or uuid.uuid4().hex
+    timeout = parse_timeout(data)
+    prompt = financial_advisor.create_financial_prompt(data)
+    return {
+        'model_id': model_id,
+        'request_id': request_id,
+        'data': data,
+        'cost': estimate_cost(prompt, 512),
+        'generate': {
+            'model_path': model_path,
+            'prompt': prompt,
+            'max_tokens': 512,
+            'temperature': 0.7,
+            'shared_prefix': financial_advisor.PROMPT_PREAMBLE,
+            'lane': 'advice',
+            'request_id': request_id,
+            'timeout': timeout,
+        },
+    }
+
+def location_block(advice_request, trace):
+    """Location-specific resources appended to a piece of advice"""
+    data = advice_request['data']
+    with trace.time('location_formatting'):
+        return financial_advisor.get_location_block(data['city'], data['state'])
+
+def finish_advice(advice_request, ai_response, block, trace):
+    """Save finished advice with its location block and build the body returned for it"""
+    data = advice_request['data']
+    enhanced_response = f"{ai_response}\n\n{block}"
+    with trace.time('db_write'):
+        database.save_conversation(
+            user_message=f"Financial advice request: Age {data['age']}, Income ${data['income']}, Location: {data['city']}, {data['state']}",
+            ai_response=enhanced_response,
+            model_id=advice_request['model_id'],
+            session_id=data.get('session_id')
+        )
+    
+    return {
+        'success': True,
+        'advice': enhanced_response,
+        'request_id': advice_request['request_id'],
+        'latency': latency.record(advice_request['model_id'], trace),
+        'timestamp': datetime.now().isoformat()
+    }
+
+def cancelled_body(error, request_id):
+    """Body and status code answering a cancelled generation"""
+    status = 504 if error.reason == 'timeout' else 499
+    return {'success': False, 'error': str(error), 'reason': error.reason, 'request_id': request_id}, status
+
+def rejected_body(error):
+    """Body and headers answering a request turned away by admission control (429)"""
+    body = {'success': False, 'error': str(error), 'retry_after': error.retry_after}
+    return body, {'Retry-After': str(error.retry_after)}
+
+def stream_error_event(error):
+    """Final SSE event of a stream that failed or was cancelled"""
+    if isinstance(error, GenerationCancelled):
+        return sse_event('cancelled', {'success': False, 'error': str(error), 'reason': error.reason})
+    return sse_event('error', {'success': False, 'error': str(error)})
+
+def cancelled_response(error, request_id):
+    body, status = cancelled_body(error, request_id)
+    return jsonify(body), status
+
+def rejected_response(error):
+    body, headers = rejected_body(error)
+    response = jsonify(body)
+    response.headers.update(headers)
+    return response, 429
+
+def sse_response(events, on_close=None):
+    response = Response(
+        stream_with_context(events),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    if on_close is not None:
+        response.call_on_close(on_close)
+    return response
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.HTTP_REQUESTS.inc(route, request.method, str(response.status_code))
+    started = getattr(g, 'request_started', None)
+    if started is not None:
+        metrics.HTTP_LATENCY.observe(time.perf_counter() - started, route)
+    return response
+
+def collect_gauges():
+    """Gauges read at scrape time: training and batch jobs, model cache and queue depths"""
+    states = {}
+    for status in list(training_status.values()):
+        states[status.get('status', 'unknown')] = states.get(status.get('status', 'unknown'), 0) + 1
+    gauges = [(
+        'langpbl_training_jobs', 'Training jobs by status', ('status',),
+        sorted(((state,), count) for state, count in states.items())
+    )]
+    batch_states = {}
+    for status in list(batch_status.values()):
+        batch_states[status['status']] = batch_states.get(status['status'], 0) + 1
+    gauges.append((
+        'langpbl_batch_jobs', 'Batch generation jobs by status', ('status',),
+        sorted(((state,), count) for state, count in batch_states.items())
+    ))
+    
+    stats = inference_backend().get_cache_stats()
+    # The worker pool reports one set of stats per worker process
+    workers = stats.get('workers', {'0': stats})
+    used, budget, resident, active, pending, session_lookups = [], [], [], [], [], []
+    # ModelCache.stats() fields exported as-is, one sample per worker
+    cache_fields = [
+        ('hits', 'langpbl_model_cache_hits', 'Model cache lookups served by a resident model'),
+        ('misses', 'langpbl_model_cache_misses', 'Model cache lookups that had to load the model'),
+        ('evictions', 'langpbl_model_cache_evictions', 'Models evicted to stay within the budget'),
+        ('loads', 'langpbl_model_cache_loads', 'Model loads that finished'),
+        ('load_failures', 'langpbl_model_cache_load_failures', 'Model loads that raised'),
+        ('load_seconds_total', 'langpbl_model_cache_load_seconds', 'Seconds spent loading models'),
+        ('coalesced_waiters', 'langpbl_model_cache_coalesced_waiters',
+         'Requests that waited on a load another request had started'),
+    ]
+    cache_samples = {field: [] for field, _, _ in cache_fields}
+    waiting = []
+    for worker_id, worker in workers.items():
+        labels = (str(worker_id),)
+        used.append((labels, worker.get('used_bytes', 0)))
+        budget.append((labels, worker.get('budget_bytes', 0)))
+        resident.append((labels, len(worker.get('models', []))))
+        for field in cache_samples:
+            cache_samples[field].append((labels, worker.get(field, 0)))
+        waiting.append((labels, sum(worker.get('waiting', {}).values())))
+        sessions = worker.get('session_cache', {})
+        for tier, field in (('device', 'device_hits'), ('host', 'host_hits'),
+                            ('prefetched', 'prefetched_hits'), ('miss', 'misses')):
+            session_lookups.append(((str(worker_id), tier), sessions.get(field, 0)))
+        for key, scheduler_stats in worker.get('schedulers', {}).items():
+            model_labels = (str(worker_id), os.path.basename(os.path.normpath(str(key))))
+            active.append((model_labels, scheduler_stats['active']))
+            pending.append((model_labels, scheduler_stats['pending']))
+    admission = admission_controller.stats()['usage']
+    gauges += [
+        ('langpbl_admission_queued_tokens', 'Tokens admitted and not yet finished', ('model', 'lane'),
+         [((u['model_id'], u['lane']), u['tokens']) for u in admission]),
+        ('langpbl_admission_queued_requests', 'Requests admitted and not yet finished', ('model', 'lane'),
+         [((u['model_id'], u['lane']), u['requests']) for u in admission]),
+        ('langpbl_model_cache_used_bytes', 'Bytes of models held in the model cache', ('worker',), used),
+        ('langpbl_model_cache_budget_bytes', 'Memory budget of the model cache', ('worker',), budget),
+        ('langpbl_model_cache_models', 'Models resident in the model cache', ('worker',), resident),
+        ('langpbl_model_cache_waiters', 'Requests waiting on a model load right now', ('worker',), waiting),
+        ('langpbl_scheduler_active_requests', 'Requests in the running batch', ('worker', 'model'), active),
+        ('langpbl_scheduler_pending_requests', 'Requests waiting to join the batch', ('worker', 'model'), pending),
+        ('langpbl_session_cache_lookups', 'Session KV lookups by the tier that served them', ('worker', 'tier'),
+         session_lookups),
+    ]
+    gauges += [(name, documentation, ('worker',), cache_samples[field])
+               for field, name, documentation in cache_fields]
+    return gauges
+
+metrics.register_collector(collect_gauges)
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Metrics in the Prometheus text exposition format"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
     return jsonify({
@@ -118,6 +423,9 @@ def start_training():
                     training_id=training_id,
                     status_dict=training_status
                 )
+                
+                # Drop any stale copy of a model that was overwritten
+                inference_backend().evict_model(os.path.join(config.MODEL_PATH, output_name))
             except Exception as e:
                 training_status[training_id]['status'] = 'failed'
                 training_status[training_id]['error'] = str(e)
@@ -141,6 +449,101 @@ def get_training_status(training_id):
         return jsonify({'success': False, 'error': 'Training ID not found'}), 404
     return jsonify(training_status[training_id])
 
+@app.route('/api/batch-generate', methods=['POST'])
+def batch_generate():
+    """
+    Start a background job generating a response for every row of a file
+    
+    Takes a multipart upload ('file' plus form fields) or JSON naming a
+    file_id from /api/upload-data. Rows hold a 'prompt' or a client profile
+    (the financial-advice fields); results stream to a JSONL file.
+    """
+    try:
+        if 'file' in request.files:
+            data = request.form
+            file = request.files['file']
+            if file.filename == '' or not allowed_file(file.filename):
+                return jsonify({'success': False, 'error': 'Invalid file type'}), 400
+            file_id = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{secure_filename(file.filename)}"
+            os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+            file.save(os.path.join(app.config['UPLOAD_FOLDER'], file_id))
+        else:
+            data = request.get_json() or {}
+            if 'file_id' not in data:
+                return jsonify({'success': False, 'error': 'Missing: file or file_id'}), 400
+            file_id = secure_filename(data['file_id'])
+        
+        if 'model_id' not in data:
+            return jsonify({'success': False, 'error': 'Missing: model_id'}), 400
+        
+        input_path = os.path.join(app.config['UPLOAD_FOLDER'], file_id)
+        model_path = os.path.join(config.MODEL_PATH, data['model_id'])
+        if not os.path.exists(input_path):
+            return jsonify({'success': False, 'error': 'File not found'}), 404
+        if not os.path.exists(model_path):
+            return jsonify({'success': False, 'error': 'Model not found'}), 404
+        max_tokens, temperature = parse_generation_params(data, max_tokens=512)
+        
+        job_id = f"batch_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}"
+        output_path = os.path.join(config.BATCH_OUTPUT_PATH, f"{job_id}.jsonl")
+        batch_status[job_id] = {
+            'status': 'queued',
+            'progress': 0,
+            'total': None,
+            'completed': 0,
+            'failed': 0,
+            'tokens': 0,
+            'tokens_per_second': None,
+            'model_id': data['model_id'],
+            'file_id': file_id,
+            'started_at': datetime.now().isoformat()
+        }
+        
+        thread = threading.Thread(target=batch_job.run_batch, kwargs={
+            'job_id': job_id,
+            'input_path': input_path,
+            'model_path': model_path,
+            'output_path': output_path,
+            'backend': inference_backend(),
+            'status_dict': batch_status,
+            'max_tokens': max_tokens,
+            'temperature': temperature,
+        })
+        thread.start()
+        
+        return jsonify({
+            'success': True,
+            'job_id': job_id,
+            'message': 'Batch generation started'
+        })
+    
+    except BadRequest as e:
+        return jsonify({'success': False, 'error': str(e)}), e.status
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/batch-status/<job_id>', methods=['GET'])
+def get_batch_status(job_id):
+    if job_id not in batch_status:
+        return jsonify({'success': False, 'error': 'Batch job not found'}), 404
+    return jsonify(batch_status[job_id])
+
+@app.route('/api/batch-results/<job_id>', methods=['GET'])
+def get_batch_results(job_id):
+    """Download the JSONL results written so far"""
+    output_path = os.path.join(config.BATCH_OUTPUT_PATH, f"{secure_filename(job_id)}.jsonl")
+    if not os.path.exists(output_path):
+        return jsonify({'success': False, 'error': 'Batch results not found'}), 404
+    return send_file(output_path, mimetype='application/x-ndjson', as_attachment=True)
+
+@app.route('/api/batch-generate/<job_id>/cancel', methods=['POST'])
+def cancel_batch(job_id):
+    if job_id not in batch_status:
+        return jsonify({'success': False, 'error': 'Batch job not found'}), 404
+    if not inference_backend().cancel_generation(job_id, reason='admin'):
+        return jsonify({'success': False, 'error': 'Batch job is not running'}), 404
+    return jsonify({'success': True, 'job_id': job_id})
+
 @app.route('/api/models', methods=['GET'])
 def list_models():
     try:
@@ -175,46 +578,76 @@ def list_models():
 
 @app.route('/api/chat', methods=['POST'])
 def chat():
+    ticket = None
+    request_id = None
     try:
-        data = request.get_json()
-        
-        if 'model_id' not in data or 'message' not in data:
-            return jsonify({'success': False, 'error': 'Missing fields'}), 400
-        
-        model_id = data['model_id']
-        message = data['message']
-        max_tokens = data.get('max_tokens', 256)
-        temperature = data.get('temperature', 0.7)
-        session_id = data.get('session_id', None)
-        
-        model_path = os.path.join(config.MODEL_PATH, model_id)
-        if not os.path.exists(model_path):
-            return jsonify({'success': False, 'error': 'Model not found'}), 404
-        
-        response_text = inference.generate_response(
-            model_path=model_path,
-            prompt=message,
-            max_tokens=max_tokens,
-            temperature=temperature
-        )
+        chat_request = parse_chat_request(request.get_json())
+        request_id = chat_request['request_id']
+        
+        ticket = admission_controller.acquire(chat_request['model_id'], 'chat', chat_request['cost'])
+        trace = LatencyTrace()
+        speculative_stats = None
+        if chat_request['speculative']:
+            response_text, speculative_stats = inference_backend().generate_speculative(
+                **chat_request['generate'], trace=trace
+            )
+        else:
+            response_text = inference_backend().generate_response(
+                **chat_request['generate'], trace=trace, session_id=chat_request['session_id']
+            )
         
         # 🔥 SAVE CONVERSATION TO DATABASE
-        database.save_conversation(
-            user_message=message,
-            ai_response=response_text,
-            model_id=model_id,
-            session_id=session_id
-        )
-        
-        return jsonify({
-            'success': True,
-            'response': response_text,
-            'model_id': model_id,
-            'timestamp': datetime.now().isoformat()
-        })
+        return jsonify(finish_chat(chat_request, response_text, trace, speculative_stats))
     
+    except BadRequest as e:
+        return jsonify({'success': False, 'error': str(e)}), e.status
+    except AdmissionRejected as e:
+        return rejected_response(e)
+    except GenerationCancelled as e:
+        return cancelled_response(e, request_id)
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
+    finally:
+        if ticket is not None:
+            admission_controller.release(ticket)
+
+@app.route('/api/chat/stream', methods=['POST'])
+def chat_stream():
+    """Stream a chat response token by token as Server-Sent Events"""
+    try:
+        chat_request = parse_chat_request(request.get_json())
+        ticket = admission_controller.acquire(chat_request['model_id'], 'chat', chat_request['cost'])
+    except BadRequest as e:
+        return jsonify({'success': False, 'error': str(e)}), e.status
+    except AdmissionRejected as e:
+        return rejected_response(e)
+    
+    def events():
+        chunks = []
+        trace = LatencyTrace()
+        try:
+            yield sse_event('start', {'request_id': chat_request['request_id']})
+            for text in inference_backend().stream_response(
+                **chat_request['generate'], trace=trace, session_id=chat_request['session_id']
+            ):
+                chunks.append(text)
+                yield sse_event('token', {'text': text})
+            
+            yield sse_event('done', finish_chat(chat_request, ''.join(chunks).strip(), trace))
+        except Exception as e:
+            yield stream_error_event(e)
+    
+    return sse_response(events(), on_close=lambda: admission_controller.release(ticket))
+
+@app.route('/api/generations', methods=['GET'])
+def list_generations():
+    return jsonify({'generations': inference_backend().list_generations()})
+
+@app.route('/api/generations/<request_id>/cancel', methods=['POST'])
+def cancel_generation(request_id):
+    if not inference_backend().cancel_generation(request_id, reason='admin'):
+        return jsonify({'success': False, 'error': 'Generation not found'}), 404
+    return jsonify({'success': True, 'request_id': request_id, 'message': 'Cancellation requested'})
 
 @app.route('/api/models/<model_id>', methods=['DELETE'])
 def delete_model(model_id):
@@ -225,6 +658,7 @@ def delete_model(model_id):
             return jsonify({'success': False, 'error': 'Model not found'}), 404
         
         import shutil
+        inference_backend().evict_model(model_path)
         shutil.rmtree(model_path)
         
         return jsonify({
@@ -235,6 +669,33 @@ def delete_model(model_id):
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/latency', methods=['GET'])
+def get_latency():
+    """Per-model p50/p95/p99 latency of each generation stage"""
+    return jsonify({'success': True, 'latency': latency.summary()})
+
+@app.route('/api/model-cache', methods=['GET'])
+def model_cache_stats():
+    return jsonify(inference_backend().get_cache_stats())
+
+@app.route('/api/model-cache/<model_id>/pin', methods=['POST', 'DELETE'])
+def pin_model(model_id):
+    try:
+        model_path = os.path.join(config.MODEL_PATH, model_id)
+        
+        if not os.path.exists(model_path):
+            return jsonify({'success': False, 'error': 'Model not found'}), 404
+        
+        if request.method == 'POST':
+            inference_backend().pin_model(model_path)
+        else:
+            inference_backend().unpin_model(model_path)
+        
+        return jsonify({'success': True, 'pinned': request.method == 'POST', 'model_id': model_id})
+    
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/api/base-models', methods=['GET'])
 def get_base_models():
     base_models = [
@@ -301,6 +762,9 @@ def trigger_retrain():
                     status_dict=training_status
                 )
                 
+                # Serve the retrained adapter instead of the cached one
+                inference_backend().evict_model(os.path.join(config.MODEL_PATH, model_id))
+                
                 # Mark conversations as trained
                 database.mark_conversations_trained()
                 
@@ -324,55 +788,59 @@ def trigger_retrain():
 @app.route('/api/financial-advice', methods=['POST'])
 def get_financial_advice():
     """Generate financial advice with location-specific resources"""
+    ticket = None
+    request_id = None
     try:
-        data = request.get_json()
+        advice_request = parse_advice_request(request.get_json())
+        request_id = advice_request['request_id']
         
-        # Validate required fields
-        required_fields = ['age', 'income', 'debt', 'savings', 'city', 'state', 'goals', 'model_id']
-        for field in required_fields:
-            if field not in data:
-                return jsonify({'success': False, 'error': f'Missing field: {field}'}), 400
-        
-        model_id = data['model_id']
-        model_path = os.path.join(config.MODEL_PATH, model_id)
-        
-        if not os.path.exists(model_path):
-            return jsonify({'success': False, 'error': 'Model not found'}), 404
+        ticket = admission_controller.acquire(advice_request['model_id'], 'advice', advice_request['cost'])
+        trace = LatencyTrace()
+        ai_response = inference_backend().generate_response(**advice_request['generate'], trace=trace)
         
-        # Create financial advice prompt
-        prompt = financial_advisor.create_financial_prompt(data)
-        
-        # Get AI response
-        ai_response = inference.generate_response(
-            model_path=model_path,
-            prompt=prompt,
-            max_tokens=512,
-            temperature=0.7
-        )
-        
-        # Enhance with location-specific resources
-        enhanced_response = financial_advisor.enhance_with_location(
-            ai_response,
-            data['city'],
-            data['state']
-        )
-        
-        # Save to database
-        database.save_conversation(
-            user_message=f"Financial advice request: Age {data['age']}, Income ${data['income']}, Location: {data['city']}, {data['state']}",
-            ai_response=enhanced_response,
-            model_id=model_id,
-            session_id=data.get('session_id')
-        )
-        
-        return jsonify({
-            'success': True,
-            'advice': enhanced_response,
-            'timestamp': datetime.now().isoformat()
-        })
+        # Enhance with location-specific resources and save to database
+        block = location_block(advice_request, trace)
+        return jsonify(finish_advice(advice_request, ai_response, block, trace))
     
+    except BadRequest as e:
+        return jsonify({'success': False, 'error': str(e)}), e.status
+    except AdmissionRejected as e:
+        return rejected_response(e)
+    except GenerationCancelled as e:
+        return cancelled_response(e, request_id)
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
+    finally:
+        if ticket is not None:
+            admission_controller.release(ticket)
+
+@app.route('/api/financial-advice/stream', methods=['POST'])
+def stream_financial_advice():
+    """Stream financial advice as Server-Sent Events, ending with the location block"""
+    try:
+        advice_request = parse_advice_request(request.get_json())
+        ticket = admission_controller.acquire(advice_request['model_id'], 'advice', advice_request['cost'])
+    except BadRequest as e:
+        return jsonify({'success': False, 'error': str(e)}), e.status
+    except AdmissionRejected as e:
+        return rejected_response(e)
+    
+    def events():
+        chunks = []
+        trace = LatencyTrace()
+        try:
+            yield sse_event('start', {'request_id': advice_request['request_id']})
+            for text in inference_backend().stream_response(**advice_request['generate'], trace=trace):
+                chunks.append(text)
+                yield sse_event('token', {'text': text})
+            
+            block = location_block(advice_request, trace)
+            yield sse_event('location', {'text': block})
+            yield sse_event('done', finish_advice(advice_request, ''.join(chunks).strip(), block, trace))
+        except Exception as e:
+            yield stream_error_event(e)
+    
+    return sse_response(events(), on_close=lambda: admission_controller.release(ticket))
 
 @app.route('/api/available-locations', methods=['GET'])
 def available_locations():
@@ -387,6 +855,7 @@ if __name__ == '__main__':
     os.makedirs(config.DATA_PATH, exist_ok=True)
     os.makedirs(config.MODEL_PATH, exist_ok=True)
     os.makedirs(config.CHECKPOINT_PATH, exist_ok=True)
+    os.makedirs(config.BATCH_OUTPUT_PATH, exist_ok=True)
     os.makedirs(os.path.join('data', 'auto_generated'), exist_ok=True)
     
     print("🚀 Starting Unsloth Web API...")
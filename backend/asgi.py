@@ -0,0 +1,341 @@
+import asyncio
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import datetime
+from functools import partial
+
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+from werkzeug.utils import secure_filename
+
+import app as flask_app
+import config
+import metrics
+from admission import AdmissionRejected
+from cancellation import GenerationCancelled
+from latency import LatencyTrace
+
+# Generation, upload and health routes run natively on the event loop; every
+# other route is served by the Flask app, whose handlers run on a thread pool.
+admission_controller = flask_app.admission_controller
+inference_backend = flask_app.inference_backend
+sse_event = flask_app.sse_event
+BadRequest = flask_app.BadRequest
+
+# How often a non-streaming generation checks whether its client went away
+DISCONNECT_POLL_SECONDS = 0.5
+
+
+async def run_blocking(fn, *args, **kwargs):
+    """Run a blocking call (SQLite, filesystem, model loads) off the event loop"""
+    return await asyncio.get_running_loop().run_in_executor(None, partial(fn, *args, **kwargs))
+
+
+async def unless_disconnected(request, request_id, generation):
+    """
+    Await a generation, cancelling it if the client disconnects first
+
+    Streaming routes notice a disconnect when a write fails; a plain JSON
+    route only writes once, so it watches the connection while it waits.
+    Cancellation is retried until the generation ends because the request
+    may not be queued yet (e.g. while its model loads) when the client leaves.
+    """
+    task = asyncio.ensure_future(generation)
+    while not task.done():
+        await asyncio.wait({task}, timeout=DISCONNECT_POLL_SECONDS)
+        if not task.done() and await request.is_disconnected():
+            while not task.done():
+                await run_blocking(inference_backend().cancel_generation, request_id, 'client_disconnected')
+                await asyncio.wait({task}, timeout=DISCONNECT_POLL_SECONDS)
+    return task.result()
+
+
+def instrumented(route):
+    """Count requests and time handlers the same way the Flask hooks do"""
+    def decorate(handler):
+        async def endpoint(request):
+            started = time.perf_counter()
+            response = await handler(request)
+            metrics.HTTP_REQUESTS.inc(route, request.method, str(response.status_code))
+            metrics.HTTP_LATENCY.observe(time.perf_counter() - started, route)
+            return response
+        return endpoint
+    return decorate
+
+
+def error_response(error, status_code=500):
+    return JSONResponse({'success': False, 'error': str(error)}, status_code=status_code)
+
+
+def cancelled_response(error, request_id):
+    body, status_code = flask_app.cancelled_body(error, request_id)
+    return JSONResponse(body, status_code=status_code)
+
+
+def rejected_response(error):
+    body, headers = flask_app.rejected_body(error)
+    return JSONResponse(body, status_code=429, headers=headers)
+
+
+def sse_response(events, ticket):
+    # Released both when the stream ends and when it never starts
+    release = partial(admission_controller.release, ticket)
+
+    async def guarded():
+        try:
+            async for event in events:
+                yield event
+        finally:
+            release()
+
+    return StreamingResponse(
+        guarded(),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+        background=BackgroundTask(release)
+    )
+
+
+@instrumented('/api/health')
+async def health_check(request):
+    return JSONResponse({
+        'status': 'healthy',
+        'message': 'Unsloth API is running',
+        'timestamp': datetime.now().isoformat()
+    })
+
+
+def _save_upload(source, filepath):
+    with open(filepath, 'wb') as f:
+        shutil.copyfileobj(source, f, length=1024 * 1024)
+
+
+def _count_rows(filepath, filename):
+    with open(filepath, 'r', encoding='utf-8') as f:
+        if filename.endswith('.json'):
+            data = json.load(f)
+            return len(data) if isinstance(data, list) else 1
+        if filename.endswith('.jsonl'):
+            return sum(1 for line in f)
+        return sum(1 for line in f) - 1
+
+
+@instrumented('/api/upload-data')
+async def upload_data(request):
+    """Upload training data; the multipart body is spooled to disk while it arrives"""
+    try:
+        if int(request.headers.get('content-length', 0)) > flask_app.app.config['MAX_CONTENT_LENGTH']:
+            return error_response('File too large', 413)
+
+        form = await request.form()
+        file = form.get('file')
+        if file is None or not hasattr(file, 'filename'):
+            return error_response('No file provided', 400)
+
+        if file.filename == '':
+            return error_response('No file selected', 400)
+
+        if not flask_app.allowed_file(file.filename):
+            return error_response('Invalid file type', 400)
+
+        filename = secure_filename(file.filename)
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        file_id = f"{timestamp}_{filename}"
+        filepath = os.path.join(config.DATA_PATH, file_id)
+
+        os.makedirs(config.DATA_PATH, exist_ok=True)
+        try:
+            await run_blocking(_save_upload, file.file, filepath)
+        finally:
+            await file.close()
+        rows = await run_blocking(_count_rows, filepath, filename)
+
+        return JSONResponse({
+            'success': True,
+            'message': 'Data uploaded successfully',
+            'file_id': file_id,
+            'filename': filename,
+            'rows': rows,
+            'uploaded_at': datetime.now().isoformat()
+        })
+
+    except Exception as e:
+        return error_response(e)
+
+
+@instrumented('/api/chat')
+async def chat(request):
+    ticket = None
+    request_id = None
+    try:
+        chat_request = await run_blocking(flask_app.parse_chat_request, await request.json())
+        request_id = chat_request['request_id']
+
+        ticket = admission_controller.acquire(chat_request['model_id'], 'chat', chat_request['cost'])
+        trace = LatencyTrace()
+        speculative_stats = None
+        if chat_request['speculative']:
+            response_text, speculative_stats = await unless_disconnected(request, request_id, run_blocking(
+                inference_backend().generate_speculative, **chat_request['generate'], trace=trace
+            ))
+        else:
+            response_text = await unless_disconnected(request, request_id, inference_backend().agenerate_response(
+                **chat_request['generate'], trace=trace, session_id=chat_request['session_id']
+            ))
+
+        result = await run_blocking(flask_app.finish_chat, chat_request, response_text, trace, speculative_stats)
+        return JSONResponse(result)
+
+    except BadRequest as e:
+        return error_response(e, e.status)
+    except AdmissionRejected as e:
+        return rejected_response(e)
+    except GenerationCancelled as e:
+        return cancelled_response(e, request_id)
+    except Exception as e:
+        return error_response(e)
+    finally:
+        if ticket is not None:
+            admission_controller.release(ticket)
+
+
+@instrumented('/api/chat/stream')
+async def chat_stream(request):
+    """Stream a chat response token by token as Server-Sent Events"""
+    try:
+        chat_request = await run_blocking(flask_app.parse_chat_request, await request.json())
+        ticket = admission_controller.acquire(chat_request['model_id'], 'chat', chat_request['cost'])
+    except BadRequest as e:
+        return error_response(e, e.status)
+    except AdmissionRejected as e:
+        return rejected_response(e)
+
+    async def events():
+        chunks = []
+        trace = LatencyTrace()
+        try:
+            yield sse_event('start', {'request_id': chat_request['request_id']})
+            async for text in inference_backend().astream_response(
+                **chat_request['generate'], trace=trace, session_id=chat_request['session_id']
+            ):
+                chunks.append(text)
+                yield sse_event('token', {'text': text})
+
+            result = await run_blocking(flask_app.finish_chat, chat_request, ''.join(chunks).strip(), trace)
+            yield sse_event('done', result)
+        except Exception as e:
+            yield flask_app.stream_error_event(e)
+
+    return sse_response(events(), ticket)
+
+
+@instrumented('/api/financial-advice')
+async def get_financial_advice(request):
+    """Generate financial advice with location-specific resources"""
+    ticket = None
+    request_id = None
+    try:
+        advice_request = await run_blocking(flask_app.parse_advice_request, await request.json())
+        request_id = advice_request['request_id']
+
+        ticket = admission_controller.acquire(advice_request['model_id'], 'advice', advice_request['cost'])
+        trace = LatencyTrace()
+        ai_response = await unless_disconnected(request, request_id, inference_backend().agenerate_response(
+            **advice_request['generate'], trace=trace
+        ))
+
+        block = await run_blocking(flask_app.location_block, advice_request, trace)
+        result = await run_blocking(flask_app.finish_advice, advice_request, ai_response, block, trace)
+        return JSONResponse(result)
+
+    except BadRequest as e:
+        return error_response(e, e.status)
+    except AdmissionRejected as e:
+        return rejected_response(e)
+    except GenerationCancelled as e:
+        return cancelled_response(e, request_id)
+    except Exception as e:
+        return error_response(e)
+    finally:
+        if ticket is not None:
+            admission_controller.release(ticket)
+
+
+@instrumented('/api/financial-advice/stream')
+async def stream_financial_advice(request):
+    """Stream financial advice as Server-Sent Events, ending with the location block"""
+    try:
+        advice_request = await run_blocking(flask_app.parse_advice_request, await request.json())
+        ticket = admission_controller.acquire(advice_request['model_id'], 'advice', advice_request['cost'])
+    except BadRequest as e:
+        return error_response(e, e.status)
+    except AdmissionRejected as e:
+        return rejected_response(e)
+
+    async def events():
+        chunks = []
+        trace = LatencyTrace()
+        try:
+            yield sse_event('start', {'request_id': advice_request['request_id']})
+            async for text in inference_backend().astream_response(**advice_request['generate'], trace=trace):
+                chunks.append(text)
+                yield sse_event('token', {'text': text})
+
+            block = await run_blocking(flask_app.location_block, advice_request, trace)
+            yield sse_event('location', {'text': block})
+            result = await run_blocking(
+                flask_app.finish_advice, advice_request, ''.join(chunks).strip(), block, trace
+            )
+            yield sse_event('done', result)
+        except Exception as e:
+            yield flask_app.stream_error_event(e)
+
+    return sse_response(events(), ticket)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Model loads and SQLite writes share this pool; size it for the load
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=config.ASGI_EXECUTOR_THREADS)
+    )
+    yield
+
+
+asgi_app = Starlette(
+    routes=[
+        Route('/api/health', health_check, methods=['GET']),
+        Route('/api/upload-data', upload_data, methods=['POST']),
+        Route('/api/chat', chat, methods=['POST']),
+        Route('/api/chat/stream', chat_stream, methods=['POST']),
+        Route('/api/financial-advice', get_financial_advice, methods=['POST']),
+        Route('/api/financial-advice/stream', stream_financial_advice, methods=['POST']),
+        Mount('/', WSGIMiddleware(flask_app.app, workers=config.ASGI_EXECUTOR_THREADS)),
+    ],
+    middleware=[Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])],
+    lifespan=lifespan,
+)
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    os.makedirs(config.DATA_PATH, exist_ok=True)
+    os.makedirs(config.MODEL_PATH, exist_ok=True)
+    os.makedirs(config.CHECKPOINT_PATH, exist_ok=True)
+    os.makedirs(os.path.join('data', 'auto_generated'), exist_ok=True)
+
+    print("🚀 Starting Unsloth Web API (ASGI)...")
+    print(f"📁 Data: {config.DATA_PATH}")
+    print(f"🤖 Models: {config.MODEL_PATH}")
+    print(f"💾 Database: conversations.db")
+    uvicorn.run(asgi_app, host=config.API_HOST, port=config.API_PORT)
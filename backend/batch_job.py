@@ -0,0 +1,149 @@
+import csv
+import json
+import os
+import time
+from datetime import datetime
+
+import financial_advisor
+from cancellation import GenerationCancelled
+
+# A row with all of these is a client profile and gets financial advice
+PROFILE_FIELDS = ['age', 'income', 'debt', 'savings', 'city', 'state', 'goals']
+NUMERIC_FIELDS = ['age', 'income', 'debt', 'savings']
+
+
+def read_rows(path):
+    """Rows of a JSONL, JSON (list) or CSV upload as dicts"""
+    with open(path, 'r', encoding='utf-8') as f:
+        if path.endswith('.csv'):
+            return list(csv.DictReader(f))
+        if path.endswith('.json'):
+            data = json.load(f)
+            return data if isinstance(data, list) else [data]
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _number(value):
+    if isinstance(value, str):
+        value = float(value.replace(',', '').replace('$', ''))
+    return int(value) if float(value).is_integer() else value
+
+
+def row_id(row, index):
+    """Id a result line is tagged with: the row's own 'id', else its index"""
+    return row.get('id', index) if isinstance(row, dict) else index
+
+
+def row_prompt(row):
+    """
+    Build the prompt for one row
+
+    Args:
+        row: Dict with either a 'prompt' or every field of PROFILE_FIELDS
+
+    Returns:
+        (prompt, profile) where profile is the cleaned profile or None
+
+    Raises:
+        TypeError: The row is not an object (e.g. a bare string in JSONL)
+        ValueError: The row has neither a prompt nor a full profile
+    """
+    if not isinstance(row, dict):
+        raise TypeError(f"Row must be an object, got {type(row).__name__}")
+    if row.get('prompt'):
+        return str(row['prompt']), None
+    missing = [field for field in PROFILE_FIELDS if field not in row]
+    if missing:
+        raise ValueError(f"Row needs 'prompt' or profile fields, missing: {', '.join(missing)}")
+    profile = dict(row)
+    for field in NUMERIC_FIELDS:
+        profile[field] = _number(profile[field])
+    return financial_advisor.create_financial_prompt(profile), profile
+
+
+def run_batch(job_id, input_path, model_path, output_path, backend, status_dict,
+              max_tokens=512, temperature=0.7):
+    """
+    Generate a response for every row of an upload and write them as JSONL
+
+    Results are written as soon as each prompt finishes, so the output file
+    is usable while the job runs; 'index' and 'id' tie a line to its row.
+    Progress is kept in status_dict[job_id].
+
+    Args:
+        job_id: Id of the job, also the id under which it can be cancelled
+        input_path: JSONL/JSON/CSV file of prompts or client profiles
+        model_path: Path to the trained model directory
+        output_path: JSONL file the results are written to
+        backend: inference module or worker pool to generate with
+        status_dict: Dict of job statuses, updated in place
+        max_tokens: Maximum tokens to generate per row
+        temperature: Sampling temperature (0.0 to 1.0)
+    """
+    status = status_dict[job_id]
+    try:
+        status['status'] = 'loading_data'
+        rows = read_rows(input_path)
+        status['total'] = len(rows)
+
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        with open(output_path, 'w', encoding='utf-8') as out:
+            def write(record):
+                out.write(json.dumps(record) + '\n')
+                out.flush()
+
+            prompts, indices, profiles = [], [], []
+            for index, row in enumerate(rows):
+                try:
+                    prompt, profile = row_prompt(row)
+                except (ValueError, TypeError) as e:
+                    write({'index': index, 'id': row_id(row, index), 'error': str(e)})
+                    status['failed'] += 1
+                    continue
+                prompts.append(prompt)
+                indices.append(index)
+                profiles.append(profile)
+
+            status['status'] = 'generating'
+            started = time.perf_counter()
+            shared_prefix = financial_advisor.PROMPT_PREAMBLE if any(profiles) else ""
+            for result in backend.generate_batch(
+                model_path=model_path,
+                prompts=prompts,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                shared_prefix=shared_prefix,
+                request_id=job_id
+            ):
+                position = result.pop('index')
+                index, profile = indices[position], profiles[position]
+                record = {'index': index, 'id': row_id(rows[index], index), **result}
+                if 'error' in result:
+                    status['failed'] += 1
+                else:
+                    if profile is not None:
+                        record['response'] = financial_advisor.enhance_with_location(
+                            result['response'], profile['city'], profile['state']
+                        )
+                    status['completed'] += 1
+                    status['tokens'] += result['tokens']
+                write(record)
+
+                elapsed = time.perf_counter() - started
+                status.update({
+                    'progress': int((status['completed'] + status['failed']) / len(rows) * 100),
+                    'tokens_per_second': round(status['tokens'] / elapsed, 2) if elapsed > 0 else None,
+                })
+
+        status.update({
+            'status': 'completed',
+            'progress': 100,
+            'finished_at': datetime.now().isoformat()
+        })
+        print(f"✅ Batch job {job_id} finished: {status['completed']} completed, {status['failed']} failed")
+
+    except GenerationCancelled as e:
+        status.update({'status': 'cancelled', 'reason': e.reason, 'finished_at': datetime.now().isoformat()})
+    except Exception as e:
+        print(f"❌ Batch job {job_id} failed: {str(e)}")
+        status.update({'status': 'failed', 'error': str(e), 'finished_at': datetime.now().isoformat()})
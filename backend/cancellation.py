@@ -0,0 +1,40 @@
+import threading
+import time
+
+
+class GenerationCancelled(Exception):
+    """Raised to the caller of a generation that was cancelled before finishing"""
+    def __init__(self, reason):
+        super().__init__(f"Generation cancelled: {reason}")
+        self.reason = reason
+
+    def __reduce__(self):
+        return (GenerationCancelled, (self.reason,))
+
+
+class CancellationToken:
+    """
+    Signals that a generation should stop early
+
+    A token is cancelled explicitly (client disconnect, admin request) or
+    implicitly once its deadline passes.
+    """
+    def __init__(self, timeout=None):
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self.reason = None
+        self._event = threading.Event()
+
+    def cancel(self, reason='cancelled'):
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    @property
+    def cancelled(self):
+        if not self._event.is_set() and self.deadline is not None and time.monotonic() >= self.deadline:
+            self.cancel('timeout')
+        return self._event.is_set()
+
+    def error(self):
+        return GenerationCancelled(self.reason)
+
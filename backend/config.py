@@ -9,11 +9,126 @@ CHECKPOINT_PATH = os.path.join(BASE_DIR, 'checkpoints')
 API_HOST = '0.0.0.0'
 API_PORT = 5000
 SECRET_KEY = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
+# Threads for blocking work (model loads, SQLite, Flask-served routes) under asgi.py
+ASGI_EXECUTOR_THREADS = int(os.environ.get('ASGI_EXECUTOR_THREADS', 64))
 
 DEFAULT_MODEL = 'unsloth/llama-3-8b-bnb-4bit'
 MAX_SEQ_LENGTH = 2048
 LOAD_IN_4BIT = True
 
+# 'auto' uses CUDA when available and falls back to CPU
+INFERENCE_DEVICE = os.environ.get('INFERENCE_DEVICE', 'auto')
+CPU_DTYPE = os.environ.get('CPU_DTYPE', 'float32')
+# int8 dynamic quantization on CPU; applies to full and merged checkpoints only,
+# LoRA adapters are served on full-precision bases
+CPU_INT8_DYNAMIC = os.environ.get('CPU_INT8_DYNAMIC', '0') == '1'
+CPU_THREADS = int(os.environ.get('CPU_THREADS', 0))
+
+# Merge LoRA adapters into a full-weight checkpoint after training and serve it
+EXPORT_MERGED_AFTER_TRAINING = os.environ.get('EXPORT_MERGED_AFTER_TRAINING', '0') == '1'
+MERGED_EXPORT_DTYPE = os.environ.get('MERGED_EXPORT_DTYPE', 'fp16')
+PREFER_MERGED = os.environ.get('PREFER_MERGED', '1') == '1'
+
+# Models (by id) served through an ONNX Runtime CPU session instead of PyTorch
+# (needs optimum[onnxruntime]); the export is built on first load
+ONNX_MODELS = [m for m in os.environ.get('ONNX_MODELS', '').split(',') if m]
+ONNX_IO_BINDING = os.environ.get('ONNX_IO_BINDING', '1') == '1'
+
+# On CPU, map base weights from one exported file shared by all worker processes
+SHARED_BASE_WEIGHTS = os.environ.get('SHARED_BASE_WEIGHTS', '0') == '1'
+SHARED_WEIGHTS_PATH = os.path.join(BASE_DIR, 'shared_weights')
+
+# Number of inference worker processes; 0 runs inference inside the API process
+INFERENCE_WORKERS = int(os.environ.get('INFERENCE_WORKERS', 0))
+WORKER_THREADS = int(os.environ.get('WORKER_THREADS', 32))
+# Threads per worker for control calls (cancel, stats, evict), kept apart from generations
+WORKER_CONTROL_THREADS = int(os.environ.get('WORKER_CONTROL_THREADS', 4))
+WORKER_CONTROL_TIMEOUT_SECONDS = float(os.environ.get('WORKER_CONTROL_TIMEOUT_SECONDS', 10))
+# Added to a generation's own timeout while waiting on a worker, to cover model loads
+WORKER_RESULT_GRACE_SECONDS = float(os.environ.get('WORKER_RESULT_GRACE_SECONDS', 300))
+WORKER_MONITOR_INTERVAL = 1.0
+
+# A worker is skipped while its load exceeds this multiple of the average
+ROUTER_LOAD_FACTOR = float(os.environ.get('ROUTER_LOAD_FACTOR', 1.25))
+ROUTER_VIRTUAL_NODES = 64
+
+SCHEDULER_MAX_BATCH_SIZE = int(os.environ.get('SCHEDULER_MAX_BATCH_SIZE', 8))
+# Order in which waiting requests join a batch, lowest first; batch slots kept
+# free for the first lane so chat turns do not wait behind long generations
+LANE_PRIORITIES = {'chat': 0, 'advice': 1, 'batch': 2}
+SCHEDULER_RESERVED_CHAT_SLOTS = int(os.environ.get('SCHEDULER_RESERVED_CHAT_SLOTS', 2))
+# Models (by id) whose generations hold their KV states as int8 between decode
+# steps. Only resting memory halves: every step dequantizes the whole batch and
+# the model returns a full-precision cache, so the peak during a step is still
+# most of the fp16 one (see peak_step_bytes in scheduler stats). Check quality
+# with kv_eval.py first
+KV_CACHE_INT8_MODELS = [m for m in os.environ.get('KV_CACHE_INT8_MODELS', '').split(',') if m]
+# Prompt tokens prefilled per scheduler step, interleaved with decode; 0 = no limit
+PREFILL_CHUNK_TOKENS = int(os.environ.get('PREFILL_CHUNK_TOKENS', 256))
+SAMPLING_TOP_K = 50
+# Prompts of a batch job queued or running at once; 0 = twice the scheduler batch size
+BATCH_JOB_WINDOW = int(os.environ.get('BATCH_JOB_WINDOW', 0))
+BATCH_OUTPUT_PATH = os.path.join(BASE_DIR, 'data', 'batch_outputs')
+
+# Byte budget for resident models; 0 means a fraction of device (or host) memory
+MODEL_CACHE_BUDGET_BYTES = int(os.environ.get('MODEL_CACHE_BUDGET_BYTES', 0))
+MODEL_CACHE_BUDGET_FRACTION = float(os.environ.get('MODEL_CACHE_BUDGET_FRACTION', 0.8))
+# Decode requests for different LoRA adapters of one base model in a single batch
+MIXED_ADAPTER_BATCHES = os.environ.get('MIXED_ADAPTER_BATCHES', '1') == '1'
+PINNED_MODELS = [p for p in os.environ.get('PINNED_MODELS', '').split(',') if p]
+
+# Admission control: queued + running tokens (prompt + max_tokens) and requests
+# allowed per model in each priority lane before new requests get a 429
+ADMISSION_TOKEN_BUDGETS = {
+    'chat': int(os.environ.get('ADMISSION_CHAT_TOKENS', 8192)),
+    'advice': int(os.environ.get('ADMISSION_ADVICE_TOKENS', 8192)),
+}
+ADMISSION_MAX_REQUESTS = {
+    'chat': int(os.environ.get('ADMISSION_CHAT_REQUESTS', 32)),
+    'advice': int(os.environ.get('ADMISSION_ADVICE_REQUESTS', 12)),
+}
+ADMISSION_CHARS_PER_TOKEN = 4
+# Used for the Retry-After hint of rejected requests
+ADMISSION_DRAIN_TOKENS_PER_SECOND = float(os.environ.get('ADMISSION_DRAIN_TOKENS_PER_SECOND', 100))
+
+# Recent observations kept per model and stage for latency percentiles
+LATENCY_SAMPLES = int(os.environ.get('LATENCY_SAMPLES', 2048))
+
+# Generation halts as soon as the model starts a new block of its prompt template
+TEMPLATE_STOP_SEQUENCES = {
+    'instruction': ["### Instruction:", "### Input:", "### Response:"],
+}
+
+# Optional draft model (directory under MODEL_PATH or hub id) for speculative decoding;
+# requests may only ask for it ("speculative": true) when SPECULATIVE_DECODING is on
+SPECULATIVE_DECODING = os.environ.get('SPECULATIVE_DECODING', '0') == '1'
+DRAFT_MODEL = os.environ.get('DRAFT_MODEL', '')
+SPECULATIVE_TOKENS = int(os.environ.get('SPECULATIVE_TOKENS', 4))
+
+# Generations still running after this many seconds are cancelled
+GENERATION_TIMEOUT_SECONDS = float(os.environ.get('GENERATION_TIMEOUT_SECONDS', 120))
+
+# Responses are cached only for deterministic (greedy) requests by default
+RESPONSE_CACHE_MAX_TEMPERATURE = float(os.environ.get('RESPONSE_CACHE_MAX_TEMPERATURE', 0.0))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', 10000))
+RESPONSE_CACHE_TTL_SECONDS = int(os.environ.get('RESPONSE_CACHE_TTL_SECONDS', 3600))
+
+# Chat turns with a session_id see the session's history; its KV states stay
+# resident so a turn only prefills the previous reply and the new message.
+# Idle sessions move from the device (SESSION_CACHE_BYTES) to host memory
+# (SESSION_HOST_CACHE_BYTES) and are rebuilt from the database after that.
+# llama-3-8b holds about 128 KiB of KV states per token, so the defaults keep
+# roughly 8k tokens on the device and 32k in pinned host memory; device bytes
+# count against the model cache budget
+SESSION_MEMORY = os.environ.get('SESSION_MEMORY', '1') == '1'
+SESSION_CACHE_BYTES = int(os.environ.get('SESSION_CACHE_BYTES', 1024 * 1024 * 1024))
+SESSION_HOST_CACHE_BYTES = int(os.environ.get('SESSION_HOST_CACHE_BYTES', 4 * 1024 * 1024 * 1024))
+# Oldest turns are dropped once a session's prompt grows past this many tokens
+SESSION_MAX_PROMPT_TOKENS = int(os.environ.get('SESSION_MAX_PROMPT_TOKENS', 768))
+
+# Per-model byte budget for KV states of shared prompt prefixes
+PREFIX_CACHE_BUDGET_BYTES = int(os.environ.get('PREFIX_CACHE_BUDGET_BYTES', 256 * 1024 * 1024))
+
 DEFAULT_TRAINING_CONFIG = {
     'max_steps': 60,
     'learning_rate': 2e-4,
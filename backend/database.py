@@ -2,6 +2,8 @@ import sqlite3
 import json
 from datetime import datetime
 import os
+import time
+import metrics
 
 DB_PATH = 'conversations.db'
 
@@ -24,6 +26,8 @@ def init_db():
         )
     ''')
     
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_conversations_session ON conversations (session_id)')
+    
     # Create training_queue table
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS training_queue (
@@ -40,6 +44,7 @@ def init_db():
 
 def save_conversation(user_message, ai_response, model_id, session_id=None):
     """Save a conversation to the database"""
+    started = time.perf_counter()
     conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
     
@@ -50,6 +55,55 @@ def save_conversation(user_message, ai_response, model_id, session_id=None):
     
     conn.commit()
     conn.close()
+    metrics.DB_WRITE_LATENCY.observe(time.perf_counter() - started)
+
+def get_session_history(session_id, model_id=None, limit=None):
+    """
+    Get the turns of a session, oldest first
+    
+    Args:
+        session_id: Session to read
+        model_id: Only include turns answered by this model
+        limit: Only return the most recent turns
+    
+    Returns:
+        List of (user_message, ai_response) tuples
+    """
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    
+    query = 'SELECT user_message, ai_response FROM conversations WHERE session_id = ?'
+    params = [session_id]
+    if model_id is not None:
+        query += ' AND model_id = ?'
+        params.append(model_id)
+    query += ' ORDER BY id DESC'
+    if limit is not None:
+        query += ' LIMIT ?'
+        params.append(limit)
+    
+    cursor.execute(query, params)
+    history = cursor.fetchall()
+    conn.close()
+    
+    return list(reversed(history))
+
+def count_session_turns(session_id, model_id=None):
+    """Number of turns saved for a session"""
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    
+    if model_id is None:
+        cursor.execute('SELECT COUNT(*) FROM conversations WHERE session_id = ?', (session_id,))
+    else:
+        cursor.execute(
+            'SELECT COUNT(*) FROM conversations WHERE session_id = ? AND model_id = ?',
+            (session_id, model_id)
+        )
+    count = cursor.fetchone()[0]
+    conn.close()
+    
+    return count
 
 def get_recent_conversations(limit=100):
     """Get recent conversations for retraining"""
@@ -0,0 +1,57 @@
+import re
+
+import torch
+
+import config
+
+_DTYPES = {
+    'float32': torch.float32,
+    'fp32': torch.float32,
+    'bfloat16': torch.bfloat16,
+    'bf16': torch.bfloat16,
+}
+
+
+def select_device():
+    """Pick the inference device: CUDA when present (or requested), otherwise CPU"""
+    requested = config.INFERENCE_DEVICE
+    if requested == 'auto':
+        return 'cuda' if torch.cuda.is_available() else 'cpu'
+    if requested == 'cuda' and not torch.cuda.is_available():
+        raise RuntimeError("INFERENCE_DEVICE=cuda but no CUDA device is available")
+    return requested
+
+
+def configure_cpu():
+    """Apply the configured intra-op thread count for CPU inference"""
+    if config.CPU_THREADS:
+        torch.set_num_threads(config.CPU_THREADS)
+
+
+def cpu_dtype():
+    """Weight dtype on CPU; int8 dynamic quantization needs float32 weights"""
+    if config.CPU_INT8_DYNAMIC:
+        return torch.float32
+    return _DTYPES[config.CPU_DTYPE]
+
+
+def cpu_model_name(model_name):
+    """
+    Map a bitsandbytes 4-bit checkpoint to its full-precision counterpart
+
+    bitsandbytes kernels need CUDA, so e.g. unsloth/llama-3-8b-bnb-4bit is
+    loaded as unsloth/llama-3-8b on CPU.
+    """
+    return re.sub(r'(-unsloth)?-bnb-4bit$', '', model_name)
+
+
+def quantize_int8(model):
+    """
+    Replace the model's nn.Linear layers with int8 dynamically quantized ones
+
+    Only for plain (full or merged) checkpoints: a quantized Linear has no
+    weight tensor, which PEFT's LoRA layers need.
+    """
+    if hasattr(model, 'peft_config'):
+        raise ValueError("LoRA adapter models cannot be int8 quantized; export a merged model instead")
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
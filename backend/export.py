@@ -0,0 +1,169 @@
+import json
+import os
+import sys
+import time
+
+import torch
+
+import config
+import device
+
+MERGED_DIR = 'merged'
+SERVING_FILE = 'serving.json'
+
+BENCHMARK_PROMPTS = [
+    "I'm 25 with $40k in student loans at 6% interest. Should I pay extra or invest?",
+    "How much of my income should go to an emergency fund?",
+    "Is it better to lease or buy a car on a $50k salary?",
+]
+
+
+def merged_path(model_path):
+    """Location of the merged full-weight artifact for an adapter directory"""
+    return os.path.join(model_path, MERGED_DIR)
+
+
+def _newest_mtime(path, files_only=False):
+    try:
+        return max(
+            os.path.getmtime(os.path.join(path, name))
+            for name in os.listdir(path)
+            if not files_only or os.path.isfile(os.path.join(path, name))
+        )
+    except (OSError, ValueError):
+        return None
+
+
+def is_current(artifact_dir, model_path):
+    """
+    Whether an export inside model_path is newer than the files it was built from
+
+    Retraining rewrites the adapter in place, which leaves older exports stale.
+    """
+    built = _newest_mtime(artifact_dir)
+    source = _newest_mtime(model_path, files_only=True)
+    return built is not None and (source is None or built >= source)
+
+
+def is_merged(model_dir):
+    """Whether a directory holds a merged artifact written by export_merged"""
+    return os.path.isfile(os.path.join(model_dir, SERVING_FILE))
+
+
+def merged_dtype(merged_dir):
+    """Serving dtype recorded when the merged artifact was exported"""
+    serving_file = os.path.join(merged_dir, SERVING_FILE)
+    if not os.path.exists(serving_file):
+        return 'fp16'
+    with open(serving_file, 'r', encoding='utf-8') as f:
+        return json.load(f).get('dtype', 'fp16')
+
+
+def _load_unmerged(adapter_dir, dtype=torch.float16):
+    """Load the full-precision base of an adapter with the adapter applied"""
+    from peft import PeftModel
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    with open(os.path.join(adapter_dir, 'adapter_config.json'), 'r', encoding='utf-8') as f:
+        base_name = device.cpu_model_name(json.load(f)['base_model_name_or_path'])
+
+    target = 'cuda' if torch.cuda.is_available() else 'cpu'
+    tokenizer = AutoTokenizer.from_pretrained(adapter_dir)
+    model = AutoModelForCausalLM.from_pretrained(base_name, torch_dtype=dtype).to(target)
+    model = PeftModel.from_pretrained(model, adapter_dir)
+    return model, tokenizer
+
+
+def export_merged(adapter_dir, dtype='fp16', model=None, tokenizer=None):
+    """
+    Merge a LoRA adapter into its base weights and save a servable checkpoint
+
+    Args:
+        adapter_dir: Directory written by train.train_model
+        dtype: 'fp16', or 'int8' to serve the merged weights 8-bit quantized
+        model: Optional in-memory PEFT model to merge instead of reloading
+        tokenizer: Tokenizer saved alongside the merged weights
+
+    Returns:
+        Path of the merged artifact
+    """
+    if dtype not in ('fp16', 'int8'):
+        raise ValueError(f"Unsupported merged dtype: {dtype}")
+
+    output_dir = merged_path(adapter_dir)
+    print(f"🧬 Merging adapter {adapter_dir} into {output_dir}...")
+
+    if model is not None and hasattr(model, 'save_pretrained_merged'):
+        model.save_pretrained_merged(output_dir, tokenizer, save_method="merged_16bit")
+    else:
+        if model is None:
+            model, tokenizer = _load_unmerged(adapter_dir)
+        merged = model.merge_and_unload()
+        merged.save_pretrained(output_dir, safe_serialization=True)
+        tokenizer.save_pretrained(output_dir)
+
+    # int8 is applied when the artifact is loaded (bitsandbytes on CUDA,
+    # dynamic quantization on CPU), so the weights themselves stay fp16
+    with open(os.path.join(output_dir, SERVING_FILE), 'w', encoding='utf-8') as f:
+        json.dump({'dtype': dtype, 'source': os.path.basename(os.path.normpath(adapter_dir))}, f, indent=2)
+
+    print(f"✅ Merged model saved to: {output_dir}")
+    return output_dir
+
+
+def _tokens_per_second(model, tokenizer, prompts, max_tokens):
+    from inference import format_prompt
+
+    model_device = next(model.parameters()).device
+    generated = 0
+    started = time.time()
+    with torch.inference_mode():
+        for prompt in prompts:
+            inputs = tokenizer([format_prompt(prompt)], return_tensors="pt").to(model_device)
+            outputs = model.generate(**inputs, max_new_tokens=max_tokens, do_sample=False, use_cache=True)
+            generated += outputs.shape[-1] - inputs['input_ids'].shape[-1]
+    return generated / (time.time() - started)
+
+
+def benchmark(adapter_dir, prompts=None, max_tokens=128):
+    """
+    Compare decode throughput of an adapter served unmerged and merged
+
+    The merged artifact is loaded through the serving path, so an fp16
+    export is measured in fp16 and an int8 one quantized.
+
+    Returns:
+        Dict with tokens/sec for both paths and the merged speedup
+    """
+    prompts = prompts or BENCHMARK_PROMPTS
+    from inference import _load_pretrained
+
+    model, tokenizer = _load_unmerged(adapter_dir)
+    model.eval()
+    unmerged = _tokens_per_second(model, tokenizer, prompts, max_tokens)
+    del model
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+    # Load the artifact exactly as the server does, in its recorded dtype
+    (model, tokenizer), _ = _load_pretrained(merged_path(adapter_dir))
+    merged = _tokens_per_second(model, tokenizer, prompts, max_tokens)
+
+    return {
+        'unmerged_tokens_per_second': round(unmerged, 2),
+        'merged_tokens_per_second': round(merged, 2),
+        'speedup': round(merged / unmerged, 3) if unmerged else None,
+    }
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python export.py <model_dir> [fp16|int8] [--benchmark]")
+        sys.exit(1)
+
+    model_dir = sys.argv[1]
+    dtype = next((arg for arg in sys.argv[2:] if arg in ('fp16', 'int8')), config.MERGED_EXPORT_DTYPE)
+
+    export_merged(model_dir, dtype=dtype)
+    if '--benchmark' in sys.argv:
+        print(json.dumps(benchmark(model_dir), indent=2))
@@ -1,5 +1,8 @@
 import location_handler
 
+# Fixed opening of every financial advice prompt, shared across requests
+PROMPT_PREAMBLE = "You are a professional financial advisor. Provide detailed, actionable financial advice for this person:\n\n"
+
 def create_financial_prompt(user_data):
     """
     Create a detailed financial advice prompt for the AI
@@ -17,9 +20,7 @@ def create_financial_prompt(user_data):
     Returns:
         Formatted prompt string
     """
-    prompt = f"""You are a professional financial advisor. Provide detailed, actionable financial advice for this person:
-
-Age: {user_data['age']}
+    prompt = f"""{PROMPT_PREAMBLE}Age: {user_data['age']}
 Annual Income: ${user_data['income']:,}
 Total Debt: ${user_data['debt']:,}
 Current Savings: ${user_data['savings']:,}
@@ -37,22 +38,34 @@ Be specific, practical, and encouraging. Use bullet points for clarity."""
 
     return prompt
 
-def enhance_with_location(ai_response, city, state):
+def get_location_block(city, state):
     """
-    Enhance AI response with location-specific resources
+    Build the block of location-specific resources appended to advice
     
     Args:
-        ai_response: The AI-generated financial advice
         city: User's city
         state: User's state
     
     Returns:
-        Enhanced response with local resources
+        Formatted local resources, or a note when none are known
     """
     resources = location_handler.get_location_resources(city, state)
     
     if resources:
-        location_info = location_handler.format_location_resources(resources)
-        return f"{ai_response}\n\n{location_info}"
+        return location_handler.format_location_resources(resources)
     else:
-        return f"{ai_response}\n\n📍 Note: No specific local resources found for {city}, {state}. Consider searching for local credit unions and financial counseling services in your area."
\ No newline at end of file
+        return f"📍 Note: No specific local resources found for {city}, {state}. Consider searching for local credit unions and financial counseling services in your area."
+
+def enhance_with_location(ai_response, city, state):
+    """
+    Enhance AI response with location-specific resources
+    
+    Args:
+        ai_response: The AI-generated financial advice
+        city: User's city
+        state: User's state
+    
+    Returns:
+        Enhanced response with local resources
+    """
+    return f"{ai_response}\n\n{get_location_block(city, state)}"
\ No newline at end of file
@@ -1,86 +1,815 @@
-from unsloth import FastLanguageModel
+# Unsloth patches transformers and peft when it is imported, so the device
+# check and its import come before anything else that pulls them in
+import device
+
+DEVICE = device.select_device()
+if DEVICE == 'cuda':
+    from unsloth import FastLanguageModel
+else:
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+    device.configure_cpu()
+
+from peft import PeftModel
+import asyncio
+import os
+import json
+import queue
+import threading
+import weakref
 import torch
+import config
+import database
+import export
+import onnx_backend
+import scheduler
+import shared_weights
+import speculative
+from cancellation import CancellationToken, GenerationCancelled
+from detokenizer import IncrementalDetokenizer
+from latency import LatencyTrace
+from model_cache import ModelCache, checkpoint_nbytes, model_nbytes
+from response_cache import ResponseCache, dir_mtime
+from session_cache import SessionCache, SessionState
+
+def _on_evict(key, value):
+    _resident.pop(key, None)
+    _session_cache.invalidate(key)
+    scheduler.remove_scheduler(key)
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+# Cache for loaded base models to avoid reloading, bounded by a memory budget.
+# LoRA adapters are attached to the cached base model they were trained on.
+_session_cache = SessionCache()
+_model_cache = ModelCache(
+    on_evict=_on_evict,
+    in_use=scheduler.is_busy,
+    reserved=_session_cache.device_bytes,
+)
+_adapter_lock = threading.Lock()
+_response_cache = ResponseCache()
+_compatible_drafts = set()
+# Cancellation tokens of running batch jobs by job id
+_batch_jobs = {}
+# Model directories served by each cached model, reported to request routers
+_resident = {}
+# Model directory -> (directory mtimes, resolve_model result)
+_resolved = {}
 
-# Cache for loaded models to avoid reloading
-_model_cache = {}
+def get_adapter_base(model_path):
+    """Return the base model a LoRA adapter directory was trained on, or None"""
+    adapter_config = os.path.join(model_path, 'adapter_config.json')
+    if not os.path.exists(adapter_config):
+        return None
+    with open(adapter_config, 'r', encoding='utf-8') as f:
+        return json.load(f).get('base_model_name_or_path')
 
-def generate_response(model_path, prompt, max_tokens=256, temperature=0.7):
+def adapter_name_for(model_path):
+    """PEFT adapter name used for a model directory"""
+    return os.path.basename(os.path.normpath(model_path)).replace('.', '_')
+
+def resolve_model(model_path):
+    """
+    Work out which cached model serves model_path
+    
+    The answer is remembered until the model directory or its merged export
+    directory changes, or evict_model drops it after a retrain.
+    
+    Returns:
+        Tuple of (cache key, adapter name). Adapters share the cache entry of
+        their base model unless a current merged export exists; ONNX models
+        and full checkpoints are cached under their own path.
+    """
+    stamp = (dir_mtime(model_path), dir_mtime(export.merged_path(model_path)))
+    known = _resolved.get(model_path)
+    if known is not None and known[0] == stamp:
+        return known[1]
+    resolved = _resolve_model(model_path)
+    _resolved[model_path] = (stamp, resolved)
+    return resolved
+
+def _resolve_model(model_path):
+    if onnx_backend.enabled_for(model_path):
+        return onnx_backend.onnx_path(model_path), None
+    merged = export.merged_path(model_path)
+    if config.PREFER_MERGED and export.is_current(merged, model_path):
+        return merged, None
+    base_model = get_adapter_base(model_path)
+    if base_model is None:
+        return model_path, None
+    return base_model, adapter_name_for(model_path)
+
+for _model_id in config.PINNED_MODELS:
+    _model_cache.pin(resolve_model(os.path.join(config.MODEL_PATH, _model_id))[0])
+
+def _prepare_for_inference(model, quantize=True, int8=False):
+    """Switch a loaded model to inference mode for the selected device"""
+    if DEVICE == 'cuda':
+        FastLanguageModel.for_inference(model)
+        return model
+    model.eval()
+    # PEFT's LoRA layers cannot run on (or be loaded onto) quantized Linears,
+    # so adapter models stay full precision; serve a merged export to get int8
+    if isinstance(model, PeftModel):
+        return model
+    # Quantizing would copy shared, memory-mapped weights into private memory,
+    # so only an int8 merged export overrides weight sharing
+    if quantize and (int8 or (config.CPU_INT8_DYNAMIC and not config.SHARED_BASE_WEIGHTS)):
+        model = device.quantize_int8(model)
+    return model
+
+def _load_pretrained(model_name, quantize=True):
+    """
+    Load a model from disk or the hub
+    
+    Args:
+        model_name: Model directory or hub id
+        quantize: Apply CPU int8 quantization; False for bases of LoRA adapters,
+            which are never quantized
+    
+    Returns:
+        Tuple of ((model, tokenizer), nbytes)
+    """
+    print(f"🔧 Loading model from {model_name} on {DEVICE}...")
+    
+    # Merged exports record the dtype they are served in: fp16 artifacts load
+    # unquantized and int8 ones 8-bit; anything else keeps the 4-bit default
+    merged = os.path.isdir(model_name) and export.is_merged(model_name)
+    int8 = merged and export.merged_dtype(model_name) == 'int8'
+    
+    if DEVICE == 'cuda':
+        model, tokenizer = FastLanguageModel.from_pretrained(
+            model_name=model_name,
+            max_seq_length=1024,
+            dtype=None,
+            load_in_4bit=config.LOAD_IN_4BIT and not merged,
+            load_in_8bit=int8,
+        )
+    else:
+        cpu_name = device.cpu_model_name(model_name)
+        tokenizer = AutoTokenizer.from_pretrained(cpu_name)
+        if config.SHARED_BASE_WEIGHTS:
+            model = shared_weights.load_shared(cpu_name, device.cpu_dtype())
+        else:
+            model = AutoModelForCausalLM.from_pretrained(cpu_name, torch_dtype=device.cpu_dtype())
+    
+    # Enable inference mode
+    model = _prepare_for_inference(model, quantize=quantize, int8=int8)
+    
+    print(f"✅ Model loaded and cached!")
+    return (model, tokenizer), model_nbytes(model)
+
+def _estimate_nbytes(model_name):
+    """Expected memory of a model about to be loaded, from its checkpoint files; 0 if unknown"""
+    path = model_name if DEVICE == 'cuda' else device.cpu_model_name(model_name)
+    if not os.path.isdir(path):
+        try:
+            from huggingface_hub import snapshot_download
+            path = snapshot_download(path, local_files_only=True)
+        except Exception:
+            # Not downloaded yet: room is made once the model has loaded
+            return 0
+    nbytes = checkpoint_nbytes(path)
+    if DEVICE != 'cuda':
+        # Checkpoints are stored 16-bit, CPU weights may be float32
+        nbytes = nbytes * torch.empty((), dtype=device.cpu_dtype()).element_size() // 2
+    return nbytes
+
+def _attach_adapter(key, model, tokenizer, model_path, adapter_name):
+    """Load a LoRA adapter onto a cached base model unless it is already there"""
+    cached = _model_cache.peek(key)
+    if cached is not None:
+        model = cached[0]
+    if adapter_name in getattr(model, 'peft_config', {}):
+        return model
+    
+    def attach():
+        # Runs on the decode thread, outside its inference mode so the
+        # adapter's weights load as ordinary parameters
+        with _adapter_lock, torch.inference_mode(False):
+            # Another request may have wrapped the base model while we waited
+            cached = _model_cache.peek(key)
+            current = cached[0] if cached is not None else model
+            if adapter_name in getattr(current, 'peft_config', {}):
+                return current
+            
+            print(f"🔌 Attaching adapter {adapter_name} to {key}...")
+            if isinstance(current, PeftModel):
+                current.load_adapter(model_path, adapter_name=adapter_name)
+                return current
+            current = PeftModel.from_pretrained(current, model_path, adapter_name=adapter_name)
+            current = _prepare_for_inference(current)
+            _model_cache.put(key, (current, tokenizer), model_nbytes(current))
+            return current
+    
+    # The scheduler may be mid-forward on the base model; attach between its steps
+    return scheduler.get_scheduler(key, model, tokenizer).attach_adapter(attach)
+
+def load_model(model_path):
+    """
+    Load a model and tokenizer, reusing the cached copy when available
+    
+    Returns:
+        Tuple of (cache key, model, tokenizer, adapter name)
+    """
+    key, adapter_name = resolve_model(model_path)
+    
+    if onnx_backend.enabled_for(model_path):
+        loader = lambda: onnx_backend.load(model_path)
+        estimate = None
+    else:
+        loader = lambda: _load_pretrained(key, quantize=adapter_name is None)
+        estimate = lambda: _estimate_nbytes(key)
+    model, tokenizer = _model_cache.get_or_load(key, loader, estimate=estimate)
+    
+    if adapter_name:
+        model = _attach_adapter(key, model, tokenizer, model_path, adapter_name)
+    _resident.setdefault(key, set()).add(model_path)
+    
+    return key, model, tokenizer, adapter_name
+
+PROMPT_TEMPLATE = 'instruction'
+
+# Fixed start of every formatted prompt; its KV states are shared between requests
+PROMPT_HEADER = """### Instruction:
+Provide financial advice for this situation.
+
+### Input:
+"""
+
+def format_prompt(prompt):
+    """Wrap a user prompt in the instruction template the models were trained on"""
+    return f"""{PROMPT_HEADER}{prompt}
+
+### Response:
+"""
+
+def format_followup(prompt):
+    """Template for a later turn of a session, appended after the previous reply"""
+    return f"""
+
+### Input:
+{prompt}
+
+### Response:
+"""
+
+def _transcript_ids(tokenizer, history, prompt):
+    """Token ids of a session's earlier turns followed by a new message"""
+    if not history:
+        return tokenizer(format_prompt(prompt))["input_ids"]
+    input_ids = tokenizer(format_prompt(history[0][0]))["input_ids"]
+    followups = [user_message for user_message, _ in history[1:]] + [prompt]
+    # Each reply is tokenized together with the message after it, exactly as
+    # a cached session is extended turn by turn
+    for (_, response), user_message in zip(history, followups):
+        input_ids += tokenizer(response + format_followup(user_message), add_special_tokens=False)["input_ids"]
+    return input_ids
+
+def _session_input(session_key, tokenizer, model_path, session_id, prompt):
+    """
+    Token ids for the next turn of a chat session
+    
+    Returns:
+        Tuple of (input_ids, cached KV states covering the start of input_ids
+        or None, number of turns once this one is saved)
+    """
+    model_id = os.path.basename(os.path.normpath(model_path))
+    turns = database.count_session_turns(session_id, model_id)
+    
+    state = _session_cache.take(session_key)
+    # A turn served elsewhere (another worker, a failed save) makes the states stale
+    if state is not None and state.turns == turns:
+        input_ids = state.token_ids + tokenizer(
+            state.last_response + format_followup(prompt), add_special_tokens=False
+        )["input_ids"]
+        if len(input_ids) <= config.SESSION_MAX_PROMPT_TOKENS:
+            return input_ids, state.past_key_values, turns + 1
+    
+    history = database.get_session_history(session_id, model_id)
+    for start in range(len(history) + 1):
+        input_ids = _transcript_ids(tokenizer, history[start:], prompt)
+        if len(input_ids) <= config.SESSION_MAX_PROMPT_TOKENS:
+            break
+    return input_ids, None, turns + 1
+
+def _remember_session(request):
+    """Keep a finished session turn's prompt KV states for the next turn"""
+    if request.session is None or request.prompt_cache is None or request.error is not None:
+        return
+    session_key, turns = request.session
+    _session_cache.put(session_key, SessionState(
+        request.input_ids, request.prompt_cache, extract_response(request.text), turns
+    ))
+    request.prompt_cache = None
+
+# Token ids of PROMPT_HEADER + shared_prefix by tokenizer, then by shared_prefix
+_template_ids = weakref.WeakKeyDictionary()
+
+def _template_prefix_ids(tokenizer, shared_prefix=""):
+    """Tokenize PROMPT_HEADER + shared_prefix once per tokenizer and reuse the ids"""
+    by_prefix = _template_ids.setdefault(tokenizer, {})
+    prefix_ids = by_prefix.get(shared_prefix)
+    if prefix_ids is None:
+        prefix_ids = by_prefix[shared_prefix] = tokenizer(PROMPT_HEADER + shared_prefix)["input_ids"]
+    return prefix_ids
+
+def shared_prefix_length(tokenizer, input_ids, shared_prefix="", prefix_ids=None):
+    """
+    Count the leading prompt tokens that come from fixed template text
+    
+    Args:
+        tokenizer: Tokenizer of the model
+        input_ids: Token ids of the full formatted prompt
+        shared_prefix: Fixed text that follows PROMPT_HEADER for this kind of request
+        prefix_ids: Already tokenized PROMPT_HEADER + shared_prefix, if at hand
+    
+    Returns:
+        Number of leading tokens of input_ids whose KV states can be reused
+    """
+    if prefix_ids is None:
+        prefix_ids = _template_prefix_ids(tokenizer, shared_prefix)
+    length = 0
+    for prefix_id, input_id in zip(prefix_ids, input_ids):
+        if prefix_id != input_id:
+            break
+        length += 1
+    return min(length, len(input_ids) - 1)
+
+def extract_response(text):
+    """Extract only the response part (after "### Response:")"""
+    if "### Response:" in text:
+        return text.split("### Response:")[-1].strip()
+    return text.strip()
+
+def _cached_response(model_path, prompt, max_tokens, temperature, session_id, trace):
+    """
+    Look a request up in the response cache
+    
+    Returns:
+        Tuple of (cache key, or None if the request may not be cached, and
+        the cached response or None)
+    """
+    # A session's reply depends on its history, not only the prompt
+    if session_id is not None or not _response_cache.cacheable(temperature):
+        return None, None
+    with trace.time('cache_lookup'):
+        cache_key = _response_cache.make_key(model_path, prompt, max_tokens, temperature)
+        return cache_key, _response_cache.get(cache_key)
+
+def _submit(model_path, prompt, max_tokens, temperature, stream=False, shared_prefix="",
+            request_id=None, timeout=None, trace=None, loop=None, session_id=None, lane='chat'):
+    """Load the model, format the prompt and queue it on the model's scheduler"""
+    trace = trace or LatencyTrace()
+    if session_id and config.SESSION_MEMORY:
+        # Bring a parked session back to the device while the model loads
+        _session_cache.prefetch((*resolve_model(model_path), session_id))
+    with trace.time('model_load'):
+        key, model, tokenizer, adapter_name = load_model(model_path)
+    
+    session = None
+    past_prefix = None
+    with trace.time('tokenization'):
+        if session_id and config.SESSION_MEMORY:
+            session_key = (key, adapter_name, session_id)
+            input_ids, past_prefix, turns = _session_input(session_key, tokenizer, model_path, session_id, prompt)
+            session = (session_key, turns)
+        else:
+            formatted_prompt = format_prompt(prompt)
+            input_ids = tokenizer(formatted_prompt)["input_ids"]
+        prefix_len = shared_prefix_length(tokenizer, input_ids, shared_prefix)
+    
+    request = scheduler.GenerationRequest(
+        input_ids, max_tokens, temperature, stream=stream, adapter_name=adapter_name,
+        prefix_len=prefix_len,
+        detokenizer=IncrementalDetokenizer(tokenizer),
+        stop_sequences=config.TEMPLATE_STOP_SEQUENCES.get(PROMPT_TEMPLATE),
+        cancel_token=CancellationToken(timeout or config.GENERATION_TIMEOUT_SECONDS),
+        request_id=request_id,
+        trace=trace,
+        loop=loop,
+        past_prefix=past_prefix,
+        keep_prompt_cache=session is not None,
+        kv_int8=os.path.basename(os.path.normpath(model_path)) in config.KV_CACHE_INT8_MODELS,
+        session=session,
+        priority=config.LANE_PRIORITIES[lane]
+    )
+    scheduler.get_scheduler(key, model, tokenizer).submit(request)
+    return request
+
+def generate_response(model_path, prompt, max_tokens=256, temperature=0.7, shared_prefix="",
+                      request_id=None, timeout=None, trace=None, session_id=None, lane='chat'):
     """
     Generate a response from the trained model
     
+    Requests for the same model are batched together by a shared
+    scheduler, so concurrent callers decode in one loop instead of
+    queueing behind each other.
+    
     Args:
         model_path: Path to the trained model directory
         prompt: The input prompt/question
         max_tokens: Maximum tokens to generate
         temperature: Sampling temperature (0.0 to 1.0)
+        shared_prefix: Fixed text at the start of prompt shared by many requests
+        request_id: Optional id under which the generation can be cancelled
+        timeout: Seconds before the generation is cancelled (default from config)
+        trace: Optional LatencyTrace that receives the per-stage timings
+        session_id: Chat session whose earlier turns the model should see
+        lane: Priority lane ('chat', 'advice' or 'batch') the scheduler admits it by
     
     Returns:
         Generated response text
     """
     try:
-        # Load model if not cached
-        if model_path not in _model_cache:
-            print(f"🔧 Loading model from {model_path}...")
-            
-            model, tokenizer = FastLanguageModel.from_pretrained(
-                model_name=model_path,
-                max_seq_length=1024,
-                dtype=None,
-                load_in_4bit=True,
-            )
-            
-            # Enable inference mode
-            FastLanguageModel.for_inference(model)
-            
-            _model_cache[model_path] = (model, tokenizer)
-            print(f"✅ Model loaded and cached!")
-        else:
-            model, tokenizer = _model_cache[model_path]
+        trace = trace or LatencyTrace()
+        cache_key, cached = _cached_response(model_path, prompt, max_tokens, temperature, session_id, trace)
+        if cached is not None:
+            return cached
         
-        # Format prompt for instruction-following
-        formatted_prompt = f"""### Instruction:
-Provide financial advice for this situation.
+        request = _submit(
+            model_path, prompt, max_tokens, temperature, shared_prefix=shared_prefix,
+            request_id=request_id, timeout=timeout, trace=trace, session_id=session_id, lane=lane
+        )
+        request.wait()
+        _remember_session(request)
+        
+        response = extract_response(request.text)
+        if cache_key is not None:
+            _response_cache.put(cache_key, response)
+        return response
+    
+    except GenerationCancelled:
+        raise
+    except Exception as e:
+        print(f"❌ Error generating response: {str(e)}")
+        raise Exception(f"Failed to generate response: {str(e)}")
 
-### Input:
-{prompt}
+def stream_response(model_path, prompt, max_tokens=256, temperature=0.7, shared_prefix="",
+                    request_id=None, timeout=None, trace=None, session_id=None, lane='chat'):
+    """
+    Generate a response from the trained model, yielding text as it is produced
+    
+    Args:
+        model_path: Path to the trained model directory
+        prompt: The input prompt/question
+        max_tokens: Maximum tokens to generate
+        temperature: Sampling temperature (0.0 to 1.0)
+        shared_prefix: Fixed text at the start of prompt shared by many requests
+        request_id: Optional id under which the generation can be cancelled
+        timeout: Seconds before the generation is cancelled (default from config)
+        trace: Optional LatencyTrace that receives the per-stage timings
+        session_id: Chat session whose earlier turns the model should see
+        lane: Priority lane ('chat', 'advice' or 'batch') the scheduler admits it by
+    
+    Yields:
+        Chunks of response text; joined together they form the full response
+    """
+    try:
+        trace = trace or LatencyTrace()
+        cache_key, cached = _cached_response(model_path, prompt, max_tokens, temperature, session_id, trace)
+        if cached is not None:
+            yield cached
+            return
+        
+        request = _submit(
+            model_path, prompt, max_tokens, temperature, stream=True, shared_prefix=shared_prefix,
+            request_id=request_id, timeout=timeout, trace=trace, session_id=session_id, lane=lane
+        )
+        started = False
+        
+        try:
+            for text in request.iter_text():
+                if not started:
+                    text = text.lstrip()
+                    started = bool(text)
+                if text:
+                    yield text
+        finally:
+            # The consumer went away (e.g. the client disconnected): free the slot
+            if not request.done.is_set():
+                request.cancel_token.cancel('client_disconnected')
+        
+        _remember_session(request)
+        if cache_key is not None:
+            _response_cache.put(cache_key, extract_response(request.text))
+    
+    except GenerationCancelled:
+        raise
+    except Exception as e:
+        print(f"❌ Error streaming response: {str(e)}")
+        raise Exception(f"Failed to generate response: {str(e)}")
 
-### Response:
-"""
+async def astream_response(model_path, prompt, max_tokens=256, temperature=0.7, shared_prefix="",
+                           request_id=None, timeout=None, trace=None, session_id=None, lane='chat'):
+    """
+    Async version of stream_response for event-loop servers
+    
+    The response cache lookup (which lists the model directory), loading the
+    model and tokenizing run in the loop's default executor; generated text
+    is awaited without holding a thread per request.
+    """
+    try:
+        trace = trace or LatencyTrace()
+        loop = asyncio.get_running_loop()
+        cache_key, cached = await loop.run_in_executor(None, lambda: _cached_response(
+            model_path, prompt, max_tokens, temperature, session_id, trace
+        ))
+        if cached is not None:
+            yield cached
+            return
+        
+        request = await loop.run_in_executor(None, lambda: _submit(
+            model_path, prompt, max_tokens, temperature, stream=True, shared_prefix=shared_prefix,
+            request_id=request_id, timeout=timeout, trace=trace, loop=loop, session_id=session_id,
+            lane=lane
+        ))
+        started = False
+        
+        try:
+            async for text in request.aiter_text():
+                if not started:
+                    text = text.lstrip()
+                    started = bool(text)
+                if text:
+                    yield text
+        finally:
+            if not request.done.is_set():
+                request.cancel_token.cancel('client_disconnected')
+        
+        _remember_session(request)
+        if cache_key is not None:
+            _response_cache.put(cache_key, extract_response(request.text))
+    
+    except GenerationCancelled:
+        raise
+    except Exception as e:
+        print(f"❌ Error streaming response: {str(e)}")
+        raise Exception(f"Failed to generate response: {str(e)}")
+
+async def agenerate_response(model_path, prompt, max_tokens=256, temperature=0.7, shared_prefix="",
+                             request_id=None, timeout=None, trace=None, session_id=None, lane='chat'):
+    """Async version of generate_response for event-loop servers"""
+    chunks = []
+    async for text in astream_response(
+        model_path, prompt, max_tokens, temperature, shared_prefix=shared_prefix,
+        request_id=request_id, timeout=timeout, trace=trace, session_id=session_id, lane=lane
+    ):
+        chunks.append(text)
+    return extract_response(''.join(chunks))
+
+def generate_speculative(model_path, prompt, max_tokens=256, temperature=0.7,
+                         request_id=None, timeout=None, draft_model=None, trace=None):
+    """
+    Generate a response with speculative decoding using a small draft model
+    
+    The draft proposes SPECULATIVE_TOKENS tokens per round and the target
+    verifies them in one forward pass. Each round runs at batch size 1 on
+    the target's decode thread, and the batch takes a step between rounds.
+    
+    Args:
+        model_path: Path to the trained model directory
+        prompt: The input prompt/question
+        max_tokens: Maximum tokens to generate
+        temperature: Sampling temperature (0.0 to 1.0)
+        request_id: Optional id under which the generation can be cancelled
+        timeout: Seconds before the generation is cancelled (default from config)
+        draft_model: Draft model directory or hub id (default DRAFT_MODEL)
+        trace: Optional LatencyTrace that receives the per-stage timings
+    
+    Returns:
+        Tuple of (response text, speculative decoding stats)
+    """
+    draft_model = draft_model or config.DRAFT_MODEL
+    if not draft_model:
+        raise Exception("Speculative decoding needs a draft model (set DRAFT_MODEL)")
+    if not os.path.isabs(draft_model) and os.path.isdir(os.path.join(config.MODEL_PATH, draft_model)):
+        draft_model = os.path.join(config.MODEL_PATH, draft_model)
+    
+    trace = trace or LatencyTrace()
+    try:
+        with trace.time('model_load'):
+            key, model, tokenizer, adapter_name = load_model(model_path)
+            draft_key, draft, draft_tokenizer, draft_adapter = load_model(draft_model)
+        if (key, draft_key) not in _compatible_drafts:
+            speculative.check_compatible(tokenizer, draft_tokenizer)
+            _compatible_drafts.add((key, draft_key))
         
-        # Generate response
-        inputs = tokenizer([formatted_prompt], return_tensors="pt").to("cuda")
+        with trace.time('tokenization'):
+            input_ids = tokenizer(format_prompt(prompt))["input_ids"]
+        request = scheduler.GenerationRequest(
+            input_ids, max_tokens, temperature, adapter_name=adapter_name,
+            detokenizer=IncrementalDetokenizer(tokenizer),
+            stop_sequences=config.TEMPLATE_STOP_SEQUENCES.get(PROMPT_TEMPLATE),
+            cancel_token=CancellationToken(timeout or config.GENERATION_TIMEOUT_SECONDS),
+            request_id=request_id,
+            trace=trace
+        )
+        target_scheduler = scheduler.get_scheduler(key, model, tokenizer)
+        scheduler.track_request(request)
         
-        outputs = model.generate(
-            **inputs,
-            max_new_tokens=max_tokens,
-            temperature=temperature,
-            do_sample=True if temperature > 0 else False,
-            use_cache=True
+        rounds = speculative.speculative_generate(
+            model, draft, request, target_scheduler.eos_token_ids,
+            k=config.SPECULATIVE_TOKENS,
+            target_adapter=adapter_name,
+            draft_adapter=draft_adapter
         )
         
-        # Decode and extract response
-        full_response = tokenizer.decode(outputs[0], skip_special_tokens=True)
+        def next_round():
+            try:
+                next(rounds)
+            except StopIteration as done:
+                return done.value
+            return None
         
-        # Extract only the response part (after "### Response:")
-        if "### Response:" in full_response:
-            response = full_response.split("### Response:")[-1].strip()
-        else:
-            response = full_response.strip()
+        try:
+            # One round at a time, so the shared batch is never paused for long
+            stats = None
+            while stats is None:
+                stats = target_scheduler.run_exclusive(next_round)
+        except Exception as e:
+            request.finish('error', e)
+            raise
+        request.wait()
         
-        return response
+        return extract_response(request.text), stats
     
+    except GenerationCancelled:
+        raise
     except Exception as e:
         print(f"❌ Error generating response: {str(e)}")
         raise Exception(f"Failed to generate response: {str(e)}")
 
+def generate_batch(model_path, prompts, max_tokens=256, temperature=0.7, shared_prefix="",
+                   request_id=None):
+    """
+    Generate responses for many prompts, yielding each one as it finishes
+    
+    All prompts are tokenized up front and fed to the model's scheduler
+    shortest first, so the requests decoding together have similar lengths
+    and little padding. At most BATCH_JOB_WINDOW of them are queued or
+    running at a time, which bounds the memory a job takes. They queue in
+    the 'batch' lane, so waiting chat and advice requests are admitted
+    first and SCHEDULER_RESERVED_CHAT_SLOTS stay free for chat; a batch
+    prompt already decoding keeps its slot until it finishes. The response
+    cache and sessions are bypassed.
+    
+    Args:
+        model_path: Path to the trained model directory
+        prompts: List of input prompts
+        max_tokens: Maximum tokens to generate per prompt
+        temperature: Sampling temperature (0.0 to 1.0)
+        shared_prefix: Fixed text at the start of every prompt
+        request_id: Optional id under which the whole batch can be cancelled
+    
+    Yields:
+        Dicts with the prompt's index, response, tokens and finish_reason
+        (or error, if that prompt failed)
+    """
+    if not prompts:
+        return
+    key, model, tokenizer, adapter_name = load_model(model_path)
+    model_scheduler = scheduler.get_scheduler(key, model, tokenizer)
+    
+    encoded = tokenizer([format_prompt(prompt) for prompt in prompts])["input_ids"]
+    prefix_ids = _template_prefix_ids(tokenizer, shared_prefix)
+    order = sorted(range(len(prompts)), key=lambda i: len(encoded[i]))
+    window = config.BATCH_JOB_WINDOW or 2 * model_scheduler.max_batch_size
+    kv_int8 = os.path.basename(os.path.normpath(model_path)) in config.KV_CACHE_INT8_MODELS
+    stop_sequences = config.TEMPLATE_STOP_SEQUENCES.get(PROMPT_TEMPLATE)
+    
+    # One token for the job: cancelling it drops every queued and running prompt
+    cancel_token = CancellationToken()
+    if request_id:
+        _batch_jobs[request_id] = cancel_token
+    finished = queue.Queue()
+    # Position in prompts of each submitted request, by request id
+    positions = {}
+    in_flight = 0
+    submitted = 0
+    
+    try:
+        while submitted < len(order) or in_flight:
+            while submitted < len(order) and in_flight < window and not cancel_token.cancelled:
+                index = order[submitted]
+                request = scheduler.GenerationRequest(
+                    encoded[index], max_tokens, temperature, adapter_name=adapter_name,
+                    prefix_len=shared_prefix_length(tokenizer, encoded[index], prefix_ids=prefix_ids),
+                    detokenizer=IncrementalDetokenizer(tokenizer),
+                    stop_sequences=stop_sequences,
+                    cancel_token=cancel_token,
+                    kv_int8=kv_int8,
+                    on_finish=finished.put,
+                    priority=config.LANE_PRIORITIES['batch']
+                )
+                positions[request.request_id] = index
+                model_scheduler.submit(request)
+                submitted += 1
+                in_flight += 1
+            if not in_flight:
+                break
+            
+            request = finished.get()
+            in_flight -= 1
+            index = positions.pop(request.request_id)
+            if request.error is not None:
+                if cancel_token.cancelled:
+                    continue
+                yield {'index': index, 'error': str(request.error)}
+            else:
+                yield {
+                    'index': index,
+                    'response': extract_response(request.text),
+                    'tokens': len(request.output_ids),
+                    'finish_reason': request.finish_reason,
+                }
+        
+        if cancel_token.cancelled:
+            raise cancel_token.error()
+    finally:
+        # The consumer stopped early: do not leave the rest of the batch running
+        if in_flight:
+            cancel_token.cancel('client_disconnected')
+        if request_id:
+            _batch_jobs.pop(request_id, None)
+
+def cancel_generation(request_id, reason='cancelled'):
+    """Cancel a queued or running generation (or batch job) by its request_id"""
+    token = _batch_jobs.get(request_id)
+    if token is not None:
+        token.cancel(reason)
+        return True
+    return scheduler.cancel_request(request_id, reason)
+
+def list_generations():
+    """Generations currently queued or running"""
+    return scheduler.list_requests()
+
 def clear_model_cache():
     """Clear the model cache to free up memory"""
-    global _model_cache
-    _model_cache = {}
+    _model_cache.clear()
+    scheduler.clear_schedulers()
     if torch.cuda.is_available():
         torch.cuda.empty_cache()
     print("🗑️ Model cache cleared")
 
+def get_cache_stats():
+    """Hit/miss/eviction counters and occupancy of the model cache"""
+    stats = _model_cache.stats()
+    stats['schedulers'] = scheduler.get_stats()
+    stats['response_cache'] = _response_cache.stats()
+    stats['session_cache'] = _session_cache.stats()
+    stats['resident_models'] = sorted(path for paths in list(_resident.values()) for path in paths)
+    return stats
+
+def resident_model_ids():
+    """Ids of the model directories currently served from the cache, for request routers"""
+    return sorted({os.path.basename(os.path.normpath(path)) for paths in list(_resident.values()) for path in paths})
+
+def evict_model(model_path):
+    """
+    Drop a model from the cache, e.g. after it was deleted from disk
+    
+    For an adapter only the adapter is unloaded; its base model stays resident.
+    Cached responses of the model are dropped either way.
+    """
+    _response_cache.invalidate(model_path)
+    _resolved.pop(model_path, None)
+    # Exports are cached under their own paths and may no longer be what
+    # resolve_model picks once the adapter has been retrained
+    _model_cache.evict(export.merged_path(model_path))
+    _model_cache.evict(onnx_backend.onnx_path(model_path))
+    # The adapter may still be attached to its base model even while a
+    # merged export was being served in its place, so clean it up regardless
+    key = get_adapter_base(model_path)
+    if key is None:
+        _model_cache.evict(model_path)
+        return
+    adapter_name = adapter_name_for(model_path)
+    
+    cached = _model_cache.peek(key)
+    if cached is None:
+        return
+    model, _ = cached
+    _resident.get(key, set()).discard(model_path)
+    _session_cache.invalidate(key, adapter_name)
+    
+    def unload():
+        with _adapter_lock:
+            if adapter_name in getattr(model, 'peft_config', {}):
+                model.delete_adapter(adapter_name)
+    
+    # The scheduler may be mid-forward on this model; unload between its steps
+    scheduler.unload_adapter(key, adapter_name, unload)
+
+def pin_model(model_path):
+    """Keep a model (or an adapter's base model) resident in the cache"""
+    _model_cache.pin(resolve_model(model_path)[0])
+
+def unpin_model(model_path):
+    """Allow a pinned model to be evicted again"""
+    _model_cache.unpin(resolve_model(model_path)[0])
+
 # For testing the module directly
 if __name__ == "__main__":
     test_prompt = "I'm 25 with $40k in student loans at 6% interest. Should I pay extra or invest?"
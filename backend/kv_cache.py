@@ -0,0 +1,247 @@
+import torch
+
+try:
+    from transformers import DynamicCache
+except ImportError:
+    DynamicCache = None
+
+
+def quantize_int8(tensor):
+    """
+    Symmetric int8 quantization with one scale per head and token
+
+    Args:
+        tensor: Key or value states of shape (batch, heads, seq, dim)
+
+    Returns:
+        Tuple of (int8 tensor, float32 scales of shape (batch, heads, seq, 1))
+    """
+    scale = tensor.abs().amax(dim=-1, keepdim=True).float().clamp(min=1e-8) / 127
+    quantized = torch.round(tensor.float() / scale).clamp(-127, 127).to(torch.int8)
+    return quantized, scale
+
+
+def dequantize_int8(quantized, scale, dtype):
+    return (quantized.float() * scale).to(dtype)
+
+
+class QuantizedCache:
+    """
+    A per-sequence cache held as int8 between decode steps
+
+    Each token of each head has its own scale, so appending a token never
+    re-quantizes the ones already stored. kv_eval.py uses it to measure what
+    int8 storage costs in quality.
+    """
+    def __init__(self, legacy):
+        self.dtype = legacy[0][0].dtype
+        self.layers = [quantize_int8(k) + quantize_int8(v) for k, v in legacy]
+
+    def append(self, legacy_tail):
+        """Quantize and append the states of newly processed tokens"""
+        for i, (k, v) in enumerate(legacy_tail):
+            qk, sk, qv, sv = self.layers[i]
+            tk, tsk = quantize_int8(k)
+            tv, tsv = quantize_int8(v)
+            self.layers[i] = (
+                torch.cat([qk, tk], dim=-2), torch.cat([sk, tsk], dim=-2),
+                torch.cat([qv, tv], dim=-2), torch.cat([sv, tsv], dim=-2),
+            )
+
+    def dequantize(self):
+        return tuple(
+            (dequantize_int8(qk, sk, self.dtype), dequantize_int8(qv, sv, self.dtype))
+            for qk, sk, qv, sv in self.layers
+        )
+
+    @property
+    def length(self):
+        return self.layers[0][0].shape[-2]
+
+    @property
+    def nbytes(self):
+        return sum(t.numel() * t.element_size() for layer in self.layers for t in layer)
+
+    @property
+    def full_precision_nbytes(self):
+        """Bytes the same states would take unquantized"""
+        itemsize = torch.empty((), dtype=self.dtype).element_size()
+        return sum(qk.numel() + qv.numel() for qk, _, qv, _ in self.layers) * itemsize
+
+
+def to_legacy(past_key_values):
+    """
+    Convert a model's past_key_values into the legacy tuple format
+
+    Args:
+        past_key_values: Cache object or tuple returned by a forward pass
+
+    Returns:
+        Tuple of (key, value) tensors per layer, each (batch, heads, seq, dim)
+    """
+    if past_key_values is None:
+        return None
+    if isinstance(past_key_values, QuantizedCache):
+        return past_key_values.dequantize()
+    if hasattr(past_key_values, 'to_legacy_cache'):
+        return past_key_values.to_legacy_cache()
+    return tuple((k, v) for k, v in past_key_values)
+
+
+def from_legacy(legacy):
+    """Wrap a legacy tuple cache in the cache class the model expects"""
+    if isinstance(legacy, QuantizedCache):
+        legacy = legacy.dequantize()
+    if legacy is None or DynamicCache is None:
+        return legacy
+    return DynamicCache.from_legacy_cache(legacy)
+
+
+def cache_length(legacy):
+    """Number of tokens held in a legacy cache"""
+    if isinstance(legacy, QuantizedCache):
+        return legacy.length
+    if not legacy:
+        return 0
+    return legacy[0][0].shape[-2]
+
+
+def cache_nbytes(legacy):
+    """Approximate memory used by a legacy cache in bytes"""
+    if isinstance(legacy, QuantizedCache):
+        return legacy.nbytes
+    if not legacy:
+        return 0
+    return sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in legacy)
+
+
+def cache_device(legacy):
+    """Device the tensors of a legacy cache live on"""
+    return legacy[0][0].device
+
+
+def to_device(legacy, device, non_blocking=False):
+    """Copy a legacy cache to device; non_blocking only overlaps from pinned memory"""
+    return tuple((k.to(device, non_blocking=non_blocking), v.to(device, non_blocking=non_blocking)) for k, v in legacy)
+
+
+def to_host(legacy, pin_memory=False):
+    """Copy a legacy cache to host memory, page-locked if pin_memory"""
+    def copy(tensor):
+        host = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=pin_memory)
+        return host.copy_(tensor)
+    return tuple((copy(k), copy(v)) for k, v in legacy)
+
+
+def _left_pad(tensor, length):
+    pad = length - tensor.shape[-2]
+    if pad:
+        tensor = torch.nn.functional.pad(tensor, (0, 0, pad, 0))
+    return tensor
+
+
+class BatchedCache:
+    """
+    KV states of the sequences decoding together, kept stacked between steps
+
+    Rows are left-padded to a common length. A decode step extends every row
+    by one token, so the cache the model returns simply replaces the stored
+    one (one concatenation per layer, as in model.generate); rows are only
+    padded, concatenated or selected when sequences join or leave. With
+    quantized=True the states rest as int8 with one scale per head and token
+    and are dequantized for the forward pass.
+    """
+    def __init__(self, quantized=False):
+        self.quantized = quantized
+        # Per layer (k, v), or (k, k scales, v, v scales) when quantized
+        self.layers = None
+        self.lengths = []
+        self.dtype = None
+
+    def __len__(self):
+        return len(self.lengths)
+
+    @property
+    def padded_len(self):
+        return self.layers[0][0].shape[-2] if self.layers else 0
+
+    def _parts(self, legacy):
+        if self.quantized:
+            return [quantize_int8(k) + quantize_int8(v) for k, v in legacy]
+        return [(k, v) for k, v in legacy]
+
+    def add(self, legacy):
+        """Append one sequence's legacy cache (batch size 1) as a new row"""
+        length = cache_length(legacy)
+        parts = self._parts(legacy)
+        if self.layers is None:
+            self.dtype = legacy[0][0].dtype
+            self.layers, self.lengths = parts, [length]
+            return
+        padded_len = max(self.padded_len, length)
+        self.layers = [
+            tuple(torch.cat([_left_pad(old, padded_len), _left_pad(new, padded_len)], dim=0)
+                  for old, new in zip(layer, row))
+            for layer, row in zip(self.layers, parts)
+        ]
+        self.lengths.append(length)
+
+    def remove(self, rows):
+        """Drop rows, along with left padding that no remaining row needs"""
+        rows = set(rows)
+        keep = [i for i in range(len(self.lengths)) if i not in rows]
+        if not keep:
+            self.layers, self.lengths = None, []
+            return
+        start = self.padded_len - max(self.lengths[i] for i in keep)
+        index = torch.tensor(keep, device=self.layers[0][0].device)
+        self.layers = [tuple(t[:, :, start:, :].index_select(0, index) for t in layer) for layer in self.layers]
+        self.lengths = [self.lengths[i] for i in keep]
+
+    def legacy(self):
+        """States to feed the model, dequantized if they rest as int8"""
+        if self.quantized:
+            return tuple(
+                (dequantize_int8(qk, sk, self.dtype), dequantize_int8(qv, sv, self.dtype))
+                for qk, sk, qv, sv in self.layers
+            )
+        return tuple(self.layers)
+
+    def advance(self, legacy):
+        """Take the cache returned by a decode step, one token longer per row"""
+        if self.quantized:
+            # Only the token just processed needs quantizing
+            self.layers = [
+                tuple(torch.cat([old, new], dim=-2)
+                      for old, new in zip(layer, quantize_int8(k[:, :, -1:, :]) + quantize_int8(v[:, :, -1:, :])))
+                for layer, (k, v) in zip(self.layers, legacy)
+            ]
+        else:
+            self.layers = [(k, v) for k, v in legacy]
+        self.lengths = [length + 1 for length in self.lengths]
+
+    def attention_mask(self, device):
+        """Mask over the padded states plus the token being decoded"""
+        mask = torch.zeros((len(self.lengths), self.padded_len + 1), dtype=torch.long, device=device)
+        for row, length in enumerate(self.lengths):
+            mask[row, self.padded_len - length:] = 1
+        return mask
+
+    @property
+    def nbytes(self):
+        if not self.layers:
+            return 0
+        return sum(t.numel() * t.element_size() for layer in self.layers for t in layer)
+
+    @property
+    def full_precision_nbytes(self):
+        """Bytes the same states take (or would take) unquantized"""
+        if not self.quantized:
+            return self.nbytes
+        itemsize = torch.empty((), dtype=self.dtype).element_size()
+        return sum(qk.numel() + qv.numel() for qk, _, qv, _ in self.layers) * itemsize
+
+
+def cache_tail(batched, row, n):
+    """States of the last n tokens of one row of a batched cache"""
+    return tuple((k[row:row + 1, :, -n:, :], v[row:row + 1, :, -n:, :]) for k, v in batched)
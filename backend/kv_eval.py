@@ -0,0 +1,123 @@
+import json
+import math
+import os
+import sys
+
+import torch
+
+import config
+import inference
+import kv_cache
+import scheduler
+from export import BENCHMARK_PROMPTS
+
+# Fixed prompt set, so runs of the evaluation can be compared with each other
+EVAL_PROMPTS = BENCHMARK_PROMPTS
+
+
+def _forward(model, adapter_name, input_ids, past):
+    if adapter_name:
+        model.set_adapter(adapter_name)
+    outputs = model(
+        input_ids=torch.tensor([input_ids], device=model.device),
+        past_key_values=kv_cache.from_legacy(past),
+        use_cache=True,
+    )
+    return outputs.logits[0, -1].float(), kv_cache.to_legacy(outputs.past_key_values)
+
+
+def _evaluate_prompt(model, tokenizer, adapter_name, prompt, max_tokens, eos_token_ids):
+    """Greedy-decode with full-precision states and score int8 states on the same tokens"""
+    input_ids = tokenizer(inference.format_prompt(prompt))["input_ids"]
+    logits, past = _forward(model, adapter_name, input_ids, None)
+    quantized = kv_cache.QuantizedCache(past)
+    quant_logits = logits
+
+    tokens = agree = 0
+    kl_total = nll_full = nll_quant = 0.0
+    for _ in range(max_tokens):
+        token = int(torch.argmax(logits))
+        log_probs = torch.log_softmax(logits, dim=-1)
+        quant_log_probs = torch.log_softmax(quant_logits, dim=-1)
+
+        tokens += 1
+        agree += int(torch.argmax(quant_logits)) == token
+        kl_total += float(torch.sum(log_probs.exp() * (log_probs - quant_log_probs)))
+        nll_full -= float(log_probs[token])
+        nll_quant -= float(quant_log_probs[token])
+        if token in eos_token_ids:
+            break
+
+        # Both caches are advanced with the reference token (teacher forcing)
+        logits, past = _forward(model, adapter_name, [token], past)
+        quant_logits, quant_past = _forward(model, adapter_name, [token], quantized)
+        quantized.append(kv_cache.cache_tail(quant_past, 0, 1))
+
+    return {
+        'tokens': tokens,
+        'agree': agree,
+        'kl_total': kl_total,
+        'nll_full': nll_full,
+        'nll_quant': nll_quant,
+        'full_bytes': kv_cache.cache_nbytes(past),
+        'int8_bytes': quantized.nbytes,
+    }
+
+
+def evaluate(model_path, prompts=None, max_tokens=64):
+    """
+    Measure memory saved and quality lost by holding a model's KV cache as int8
+
+    Args:
+        model_path: Path to the trained model directory
+        prompts: Prompts to evaluate (default EVAL_PROMPTS)
+        max_tokens: Tokens generated per prompt
+
+    Returns:
+        Dict with resting KV memory for both modes and the concurrency gain it
+        allows between steps (a decode step still dequantizes, see
+        peak_step_bytes in scheduler stats), greedy token agreement, mean KL
+        divergence and perplexity of both
+    """
+    prompts = prompts or EVAL_PROMPTS
+    key, model, tokenizer, adapter_name = inference.load_model(model_path)
+    model_scheduler = scheduler.get_scheduler(key, model, tokenizer)
+
+    def run():
+        return [
+            _evaluate_prompt(model, tokenizer, adapter_name, prompt, max_tokens, model_scheduler.eos_token_ids)
+            for prompt in prompts
+        ]
+
+    # The model is shared with live traffic, so evaluate between decode steps
+    results = model_scheduler.run_exclusive(run)
+
+    tokens = sum(r['tokens'] for r in results)
+    full_bytes = sum(r['full_bytes'] for r in results)
+    int8_bytes = sum(r['int8_bytes'] for r in results)
+    perplexity_full = math.exp(sum(r['nll_full'] for r in results) / tokens)
+    perplexity_int8 = math.exp(sum(r['nll_quant'] for r in results) / tokens)
+    return {
+        'model_id': os.path.basename(os.path.normpath(model_path)),
+        'prompts': len(prompts),
+        'tokens': tokens,
+        'full_precision_kv_bytes': full_bytes,
+        'int8_kv_bytes': int8_bytes,
+        'memory_saved_fraction': round(1 - int8_bytes / full_bytes, 4),
+        'concurrency_factor': round(full_bytes / int8_bytes, 2),
+        'greedy_agreement': round(sum(r['agree'] for r in results) / tokens, 4),
+        'mean_kl_divergence': sum(r['kl_total'] for r in results) / tokens,
+        'perplexity_full_precision': round(perplexity_full, 4),
+        'perplexity_int8': round(perplexity_int8, 4),
+        'perplexity_delta': round(perplexity_int8 - perplexity_full, 4),
+    }
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python kv_eval.py <model_id> [max_tokens]")
+        sys.exit(1)
+
+    max_tokens = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    report = evaluate(os.path.join(config.MODEL_PATH, sys.argv[1]), max_tokens=max_tokens)
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,147 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import config
+import metrics
+
+# Stages in the order a request passes through them
+STAGES = [
+    'cache_lookup',
+    'model_load',
+    'tokenization',
+    'queue',
+    'prefill',
+    'decode',
+    'detokenization',
+    'location_formatting',
+    'db_write',
+]
+
+
+class LatencyTrace:
+    """
+    Where the time of one request went, stage by stage
+
+    Stages can be added to several times (e.g. detokenization once per token)
+    and accumulate. Decode also keeps every step so per-token latency can be
+    aggregated separately from the total.
+    """
+    def __init__(self):
+        self.stages = {}
+        self.decode_steps = []
+        self.total = None
+        self._started = time.perf_counter()
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def add_decode_step(self, seconds):
+        self.decode_steps.append(seconds)
+        self.add('decode', seconds)
+
+    @contextmanager
+    def time(self, stage):
+        """Time the body of a with block as stage"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - started)
+
+    def merge(self, other):
+        """Fold in the stages recorded by another process for this request"""
+        for stage, seconds in other.stages.items():
+            self.add(stage, seconds)
+        self.decode_steps.extend(other.decode_steps)
+
+    def finish(self):
+        self.total = time.perf_counter() - self._started
+        return self
+
+    def as_dict(self):
+        """Breakdown in milliseconds, for API responses"""
+        breakdown = {
+            f'{stage}_ms': round(self.stages[stage] * 1000, 2)
+            for stage in STAGES if stage in self.stages
+        }
+        if self.decode_steps:
+            breakdown['decode_tokens'] = len(self.decode_steps)
+            breakdown['decode_per_token_ms'] = round(
+                sum(self.decode_steps) / len(self.decode_steps) * 1000, 2
+            )
+        if self.total is not None:
+            breakdown['total_ms'] = round(self.total * 1000, 2)
+        return breakdown
+
+
+def _percentile(ordered, q):
+    index = min(len(ordered) - 1, max(0, int(round(q / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+class LatencyHistograms:
+    """
+    Recent stage latencies per model, summarized as percentiles
+
+    Each (model, stage) keeps its last max_samples observations, so the
+    percentiles follow current behaviour rather than the whole uptime.
+    """
+    def __init__(self, max_samples=None):
+        self.max_samples = max_samples or config.LATENCY_SAMPLES
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def _observe(self, model_id, stage, seconds):
+        samples = self._samples.get((model_id, stage))
+        if samples is None:
+            samples = self._samples[(model_id, stage)] = deque(maxlen=self.max_samples)
+        samples.append(seconds)
+
+    def record(self, model_id, trace):
+        with self._lock:
+            for stage, seconds in trace.stages.items():
+                self._observe(model_id, stage, seconds)
+            for seconds in trace.decode_steps:
+                self._observe(model_id, 'decode_per_token', seconds)
+            if trace.total is not None:
+                self._observe(model_id, 'total', trace.total)
+
+    def summary(self):
+        """Per model and stage: sample count and p50/p95/p99 in milliseconds"""
+        with self._lock:
+            snapshot = {key: sorted(samples) for key, samples in self._samples.items()}
+
+        summary = {}
+        for (model_id, stage), ordered in snapshot.items():
+            summary.setdefault(model_id, {})[stage] = {
+                'count': len(ordered),
+                'p50_ms': round(_percentile(ordered, 50) * 1000, 2),
+                'p95_ms': round(_percentile(ordered, 95) * 1000, 2),
+                'p99_ms': round(_percentile(ordered, 99) * 1000, 2),
+            }
+        return summary
+
+
+_histograms = LatencyHistograms()
+
+
+def record(model_id, trace):
+    """Finish a request's trace and add it to the per-model histograms"""
+    if trace.total is None:
+        trace.finish()
+    _histograms.record(model_id, trace)
+
+    if 'prefill' in trace.stages:
+        # The first token comes out of prefill, the rest out of decode steps
+        tokens = len(trace.decode_steps) + 1
+        metrics.GENERATED_TOKENS.inc(model_id, amount=tokens)
+        generation_seconds = trace.stages['prefill'] + trace.stages.get('decode', 0.0)
+        if generation_seconds > 0:
+            metrics.GENERATION_THROUGHPUT.observe(tokens / generation_seconds, model_id)
+    return trace.as_dict()
+
+
+def summary():
+    return _histograms.summary()
@@ -0,0 +1,23 @@
+import asyncio
+
+
+class LoopQueue:
+    """
+    Queue filled from any thread and drained by a coroutine on one event loop
+
+    Drop-in for the queue.Queue sinks the scheduler and worker pool write
+    to, so async handlers can await results without parking a thread.
+    """
+    def __init__(self, loop):
+        self.loop = loop
+        self._queue = asyncio.Queue()
+
+    def put(self, item):
+        try:
+            self.loop.call_soon_threadsafe(self._queue.put_nowait, item)
+        except RuntimeError:
+            # The loop has shut down; nobody is left to read the item
+            pass
+
+    async def get(self):
+        return await self._queue.get()
@@ -0,0 +1,193 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# Shards per metric; a power of two well above the number of busy threads
+SHARDS = 64
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+class _Sharded:
+    """
+    Values kept in a fixed set of shards, picked by the writing thread's id
+
+    Each shard has its own lock, so threads only contend when their ids land
+    on the same shard, and the shard count never grows with the number of
+    threads Flask's thread-per-request server starts. Scrapes copy every
+    shard and add them up.
+    """
+    def __init__(self, shards=None):
+        self._shards = [(threading.Lock(), {}) for _ in range(shards or SHARDS)]
+
+    def _shard(self):
+        return self._shards[hash(threading.get_ident()) % len(self._shards)]
+
+    def _snapshots(self):
+        snapshots = []
+        for lock, shard in self._shards:
+            with lock:
+                snapshots.append({labels: list(value) if isinstance(value, list) else value
+                                  for labels, value in shard.items()})
+        return snapshots
+
+    def _fold(self, into, shard):
+        raise NotImplementedError
+
+
+class Counter(_Sharded):
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__()
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def inc(self, *labels, amount=1):
+        lock, shard = self._shard()
+        with lock:
+            shard[labels] = shard.get(labels, 0) + amount
+
+    def _fold(self, into, shard):
+        for labels, value in shard.items():
+            into[labels] = into.get(labels, 0) + value
+
+    def collect(self):
+        totals = {}
+        for shard in self._snapshots():
+            self._fold(totals, shard)
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(totals.items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}")
+        return lines
+
+
+class Histogram(_Sharded):
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__()
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        lock, shard = self._shard()
+        with lock:
+            entry = shard.get(labels)
+            if entry is None:
+                # Per-bucket counts (last one is +Inf) followed by the sum
+                entry = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            entry[i] += 1
+            entry[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def _fold(self, into, shard):
+        for labels, entry in shard.items():
+            total = into.setdefault(labels, [0] * len(entry))
+            for i, value in enumerate(entry):
+                total[i] += value
+
+    def collect(self):
+        totals = {}
+        for shard in self._snapshots():
+            self._fold(totals, shard)
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        names = self.labelnames + ('le',)
+        for labels, entry in sorted(totals.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), entry[:-1]):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else _number(bound)
+                lines.append(f"{self.name}_bucket{_labels(names, labels + (le,))} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(entry[-1])}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+def _number(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+HTTP_REQUESTS = Counter(
+    'langpbl_http_requests_total', 'HTTP requests by route, method and status',
+    ('route', 'method', 'status')
+)
+HTTP_LATENCY = Histogram(
+    'langpbl_http_request_duration_seconds',
+    'Time until the response is returned (time to first byte for streams)',
+    ('route',)
+)
+GENERATED_TOKENS = Counter(
+    'langpbl_generated_tokens_total', 'Tokens generated per model; rate() gives tokens/sec',
+    ('model',)
+)
+GENERATION_THROUGHPUT = Histogram(
+    'langpbl_generation_tokens_per_second', 'Decode throughput of each generation',
+    ('model',), buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+)
+DB_WRITE_LATENCY = Histogram(
+    'langpbl_db_write_seconds', 'Latency of saving a conversation to the database',
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+)
+ADMISSION_REJECTIONS = Counter(
+    'langpbl_admission_rejections_total', 'Requests turned away with 429 by priority lane',
+    ('lane',)
+)
+
+_metrics = [
+    HTTP_REQUESTS, HTTP_LATENCY, GENERATED_TOKENS, GENERATION_THROUGHPUT, DB_WRITE_LATENCY,
+    ADMISSION_REJECTIONS,
+]
+_collectors = []
+
+
+def register_collector(collect):
+    """
+    Add gauges computed at scrape time
+
+    Args:
+        collect: Callable returning (name, help, labelnames, samples) tuples,
+            where samples is a list of (label values, value)
+    """
+    _collectors.append(collect)
+
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.collect())
+    for collect in _collectors:
+        try:
+            gauges = collect()
+        except Exception as e:
+            print(f"⚠️  Metrics collector failed: {str(e)}")
+            continue
+        for name, documentation, labelnames, samples in gauges:
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in samples:
+                lines.append(f"{name}{_labels(labelnames, labels)} {_number(value)}")
+    return '\n'.join(lines) + '\n'
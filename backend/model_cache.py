@@ -0,0 +1,262 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import psutil
+import torch
+
+import config
+import device
+
+# Files holding a checkpoint's weights, whose sizes estimate a model before it loads
+WEIGHT_FILE_SUFFIXES = ('.safetensors', '.bin', '.pt', '.pth')
+
+
+def default_budget_bytes():
+    """Memory budget for resident models: configured, or a share of the inference device's memory"""
+    if config.MODEL_CACHE_BUDGET_BYTES:
+        return config.MODEL_CACHE_BUDGET_BYTES
+    if device.select_device() == 'cuda':
+        total = torch.cuda.get_device_properties(0).total_memory
+    else:
+        total = psutil.virtual_memory().total
+    return int(total * config.MODEL_CACHE_BUDGET_FRACTION)
+
+
+def checkpoint_nbytes(path):
+    """Total size of the weight files in a checkpoint directory, 0 if there are none"""
+    try:
+        names = os.listdir(path)
+    except OSError:
+        return 0
+    return sum(
+        os.path.getsize(os.path.join(path, name)) for name in names
+        if name.endswith(WEIGHT_FILE_SUFFIXES) and os.path.isfile(os.path.join(path, name))
+    )
+
+
+def _packed_nbytes(model):
+    """Bytes of int8 dynamically quantized weights, which parameters() does not list"""
+    total = 0
+    for module in model.modules():
+        packed = getattr(module, '_packed_params', None)
+        if packed is None or not hasattr(packed, '_weight_bias'):
+            continue
+        weight, bias = packed._weight_bias()
+        total += weight.numel() * weight.element_size()
+        if bias is not None:
+            total += bias.numel() * bias.element_size()
+    return total
+
+
+def model_nbytes(model):
+    """Estimate how much memory a loaded model occupies"""
+    if hasattr(model, 'get_memory_footprint'):
+        nbytes = model.get_memory_footprint()
+    else:
+        nbytes = sum(t.numel() * t.element_size() for t in list(model.parameters()) + list(model.buffers()))
+    return nbytes + _packed_nbytes(model)
+
+
+class ModelCache:
+    """
+    LRU cache of loaded models bounded by a memory budget
+
+    When a new model does not fit, the least recently used models are evicted
+    until it does. Given an estimate of its size, room is made before the
+    model loads, so the outgoing and incoming models are never resident
+    together. Pinned models and models that are still serving requests
+    are never evicted. reserved, if given, returns bytes of other state kept
+    in the same memory (e.g. session KV caches) that the budget must leave
+    room for.
+    """
+    def __init__(self, budget_bytes=None, on_evict=None, in_use=None, pinned=None, reserved=None):
+        self.budget_bytes = budget_bytes or default_budget_bytes()
+        self.on_evict = on_evict
+        self.in_use = in_use
+        self.reserved = reserved
+        self.pinned = set(pinned or [])
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.loads = 0
+        self.load_failures = 0
+        self.load_seconds_total = 0.0
+        self.last_load_seconds = {}
+        self.coalesced_waiters = 0
+        self._waiting = {}
+        self._loading = {}
+        # Estimated bytes of the models being loaded, already made room for
+        self._loading_bytes = {}
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries.keys())
+
+    def get(self, key):
+        """Return the cached value for key (or None) and mark it recently used"""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def peek(self, key):
+        """Return the cached value for key (or None) without touching recency or stats"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[0] if entry is not None else None
+
+    def get_or_load(self, key, loader, estimate=None):
+        """
+        Return the cached value for key, loading it at most once
+
+        The first caller for a missing key runs loader(), which must return
+        (value, nbytes). Callers arriving while that load is in progress wait
+        on the same future and receive its value or its exception. estimate,
+        if given, returns the expected nbytes; least recently used models are
+        evicted to fit it before loader() runs.
+        """
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key][0]
+            self.misses += 1
+            future = self._loading.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._loading[key] = future
+            else:
+                self.coalesced_waiters += 1
+                self._waiting[key] = self._waiting.get(key, 0) + 1
+
+        if not owner:
+            try:
+                return future.result()
+            finally:
+                with self._lock:
+                    self._waiting[key] -= 1
+                    if not self._waiting[key]:
+                        del self._waiting[key]
+
+        started = time.time()
+        try:
+            expected = estimate() if estimate else 0
+            if expected:
+                with self._lock:
+                    self._make_room(expected)
+                    self._loading_bytes[key] = expected
+            value, nbytes = loader()
+        except Exception as e:
+            with self._lock:
+                self.load_failures += 1
+                del self._loading[key]
+                self._loading_bytes.pop(key, None)
+            future.set_exception(e)
+            raise
+
+        elapsed = time.time() - started
+        with self._lock:
+            self._loading_bytes.pop(key, None)
+            self.put(key, value, nbytes)
+            self.loads += 1
+            self.load_seconds_total += elapsed
+            self.last_load_seconds[key] = elapsed
+            del self._loading[key]
+        future.set_result(value)
+        return value
+
+    def put(self, key, value, nbytes):
+        """Add or replace a value, evicting least recently used entries to stay within budget"""
+        with self._lock:
+            if key in self._entries:
+                self._entries[key] = (value, nbytes)
+                self._entries.move_to_end(key)
+                return
+            self._make_room(nbytes)
+            self._entries[key] = (value, nbytes)
+
+    def used_bytes(self):
+        with self._lock:
+            return sum(nbytes for _, nbytes in self._entries.values())
+
+    def reserved_bytes(self):
+        return self.reserved() if self.reserved else 0
+
+    def _make_room(self, nbytes):
+        nbytes += self.reserved_bytes() + sum(self._loading_bytes.values())
+        for key in list(self._entries.keys()):
+            if self.used_bytes() + nbytes <= self.budget_bytes:
+                return
+            if key in self.pinned or (self.in_use and self.in_use(key)):
+                continue
+            print(f"♻️ Evicting {key} from model cache")
+            self._remove(key)
+            self.evictions += 1
+
+        if self.used_bytes() + nbytes > self.budget_bytes:
+            print(f"⚠️ Model cache over budget: {self.used_bytes() + nbytes} > {self.budget_bytes} bytes")
+
+    def _remove(self, key):
+        value, _ = self._entries.pop(key)
+        if self.on_evict:
+            self.on_evict(key, value)
+
+    def evict(self, key):
+        """Drop one entry from the cache if present"""
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def pin(self, key):
+        """Keep key resident regardless of how recently it was used"""
+        with self._lock:
+            self.pinned.add(key)
+
+    def unpin(self, key):
+        with self._lock:
+            self.pinned.discard(key)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries.keys()):
+                self._remove(key)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'models': list(self._entries.keys()),
+                'pinned': sorted(self.pinned),
+                'used_bytes': self.used_bytes(),
+                'reserved_bytes': self.reserved_bytes(),
+                'budget_bytes': self.budget_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'loads': self.loads,
+                'load_failures': self.load_failures,
+                'load_seconds_total': round(self.load_seconds_total, 3),
+                'last_load_seconds': {k: round(v, 3) for k, v in self.last_load_seconds.items()},
+                'loading': list(self._loading.keys()),
+                'loading_bytes': sum(self._loading_bytes.values()),
+                'waiting': dict(self._waiting),
+                'coalesced_waiters': self.coalesced_waiters,
+            }
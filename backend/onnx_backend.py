@@ -0,0 +1,109 @@
+import os
+
+import torch
+
+import config
+import export
+import kv_cache
+
+ONNX_DIR = 'onnx'
+
+
+def onnx_path(model_path):
+    """Location of the ONNX export for a model directory"""
+    return os.path.join(model_path, ONNX_DIR)
+
+
+def enabled_for(model_path):
+    """Whether the model is configured to run on ONNX Runtime"""
+    return os.path.basename(os.path.normpath(model_path)) in config.ONNX_MODELS
+
+
+def _session_options():
+    import onnxruntime
+
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if config.CPU_THREADS:
+        options.intra_op_num_threads = config.CPU_THREADS
+    return options
+
+
+def _export(model_path):
+    """Export a model directory to ONNX, merging its adapter first if needed"""
+    from optimum.onnxruntime import ORTModelForCausalLM
+    from transformers import AutoTokenizer
+
+    source = model_path
+    if os.path.exists(os.path.join(model_path, 'adapter_config.json')):
+        source = export.merged_path(model_path)
+        if not export.is_current(source, model_path):
+            export.export_merged(model_path, dtype='fp16')
+
+    output_dir = onnx_path(model_path)
+    print(f"📦 Exporting {source} to ONNX at {output_dir}...")
+    model = ORTModelForCausalLM.from_pretrained(source, export=True, use_cache=True)
+    model.save_pretrained(output_dir)
+    AutoTokenizer.from_pretrained(source).save_pretrained(output_dir)
+    print(f"✅ ONNX export saved to: {output_dir}")
+    return output_dir
+
+
+def load(model_path):
+    """
+    Load the ONNX Runtime session for a model, exporting it on first use
+
+    Returns:
+        Tuple of ((model, tokenizer), nbytes) for the model cache
+    """
+    from optimum.onnxruntime import ORTModelForCausalLM
+    from transformers import AutoTokenizer
+
+    onnx_dir = onnx_path(model_path)
+    if not export.is_current(onnx_dir, model_path):
+        _export(model_path)
+
+    print(f"🔧 Loading ONNX Runtime session from {onnx_dir}...")
+    model = ORTModelForCausalLM.from_pretrained(
+        onnx_dir,
+        use_cache=True,
+        use_io_binding=config.ONNX_IO_BINDING,
+        provider='CPUExecutionProvider',
+        session_options=_session_options(),
+    )
+    tokenizer = AutoTokenizer.from_pretrained(onnx_dir)
+    nbytes = sum(
+        os.path.getsize(os.path.join(onnx_dir, name))
+        for name in os.listdir(onnx_dir) if name.endswith(('.onnx', '.onnx_data'))
+    )
+    print(f"✅ ONNX model loaded and cached!")
+    return (OnnxCausalLM(model), tokenizer), nbytes
+
+
+class OnnxCausalLM:
+    """
+    Presents an ORTModelForCausalLM through the forward interface the batch
+    scheduler drives, so ONNX models share its batching and KV handling
+    """
+    def __init__(self, model):
+        self.model = model
+        self.device = torch.device('cpu')
+        self.generation_config = model.generation_config
+
+    def __call__(self, input_ids, attention_mask=None, position_ids=None,
+                 past_key_values=None, use_cache=True, **kwargs):
+        if kwargs.get('adapter_names'):
+            raise ValueError("ONNX models do not support LoRA adapters")
+
+        past = kv_cache.to_legacy(past_key_values)
+        if attention_mask is None:
+            attention_mask = torch.ones(
+                (input_ids.shape[0], kv_cache.cache_length(past) + input_ids.shape[1]),
+                dtype=torch.long
+            )
+
+        inputs = dict(input_ids=input_ids, attention_mask=attention_mask,
+                      past_key_values=past, use_cache=use_cache)
+        if position_ids is not None:
+            inputs['position_ids'] = position_ids
+        return self.model(**inputs)
@@ -0,0 +1,66 @@
+import threading
+from collections import OrderedDict
+
+import config
+import kv_cache
+
+
+class PrefixCache:
+    """
+    LRU cache of precomputed KV states for shared prompt prefixes
+
+    Entries are keyed by (adapter name, prefix token ids) so that a prefix is
+    only reused with the adapter whose key/value projections produced it.
+    """
+    def __init__(self, budget_bytes=None):
+        self.budget_bytes = budget_bytes if budget_bytes is not None else config.PREFIX_CACHE_BUDGET_BYTES
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.used_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, adapter_name, prefix_ids):
+        key = (adapter_name, tuple(prefix_ids))
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, adapter_name, prefix_ids, past_key_values):
+        nbytes = kv_cache.cache_nbytes(past_key_values)
+        if nbytes > self.budget_bytes:
+            return
+        key = (adapter_name, tuple(prefix_ids))
+        with self._lock:
+            if key in self._entries:
+                self.used_bytes -= kv_cache.cache_nbytes(self._entries.pop(key))
+            while self._entries and self.used_bytes + nbytes > self.budget_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.used_bytes -= kv_cache.cache_nbytes(evicted)
+                self.evictions += 1
+            self._entries[key] = past_key_values
+            self.used_bytes += nbytes
+
+    def invalidate(self, adapter_name=None):
+        """Drop cached prefixes for one adapter, or all of them"""
+        with self._lock:
+            for key in list(self._entries.keys()):
+                if adapter_name is None or key[0] == adapter_name:
+                    self.used_bytes -= kv_cache.cache_nbytes(self._entries.pop(key))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'used_bytes': self.used_bytes,
+            'budget_bytes': self.budget_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
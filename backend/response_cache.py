@@ -0,0 +1,118 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import config
+
+
+def normalize_prompt(prompt):
+    """Collapse whitespace so trivially different prompts share a cache entry"""
+    return " ".join(prompt.split())
+
+
+def model_version(model_path):
+    """Version stamp of a model directory, changed whenever its files are rewritten"""
+    try:
+        return max(
+            os.path.getmtime(os.path.join(model_path, name))
+            for name in os.listdir(model_path)
+        )
+    except (OSError, ValueError):
+        return None
+
+
+def dir_mtime(path):
+    """Modification time of a directory itself, which changes when entries are added or removed"""
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class ResponseCache:
+    """
+    TTL + LRU cache of generated responses for deterministic requests
+
+    Only requests at or below RESPONSE_CACHE_MAX_TEMPERATURE are cached, since
+    sampled responses are expected to differ between calls.
+    Model versions are remembered until the model directory's own mtime
+    changes or the model is invalidated, so a lookup costs one stat instead
+    of listing the directory.
+    """
+    def __init__(self, max_entries=None, ttl_seconds=None):
+        self.max_entries = max_entries or config.RESPONSE_CACHE_MAX_ENTRIES
+        self.ttl_seconds = ttl_seconds or config.RESPONSE_CACHE_TTL_SECONDS
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()
+        # Model directory -> (directory mtime, model_version)
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def cacheable(self, temperature):
+        return temperature is not None and temperature <= config.RESPONSE_CACHE_MAX_TEMPERATURE
+
+    def make_key(self, model_path, prompt, max_tokens, temperature):
+        return (model_path, self._version(model_path), normalize_prompt(prompt), max_tokens, temperature)
+
+    def _version(self, model_path):
+        stamp = dir_mtime(model_path)
+        known = self._versions.get(model_path)
+        if known is not None and known[0] == stamp:
+            return known[1]
+        version = model_version(model_path)
+        self._versions[model_path] = (stamp, version)
+        return version
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            response, stored_at = entry
+            if time.time() - stored_at > self.ttl_seconds:
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return response
+
+    def put(self, key, response):
+        with self._lock:
+            self._entries[key] = (response, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, model_path=None):
+        """Drop cached responses for one model directory, or everything"""
+        with self._lock:
+            # Retraining rewrites files in place without touching the directory's mtime
+            if model_path is None:
+                self._versions.clear()
+            else:
+                self._versions.pop(model_path, None)
+            for key in list(self._entries.keys()):
+                if model_path is None or key[0] == model_path:
+                    del self._entries[key]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl_seconds,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
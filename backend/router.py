@@ -0,0 +1,147 @@
+import bisect
+import hashlib
+import math
+import threading
+from collections import Counter
+
+import config
+
+
+def _hash(value):
+    return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class ModelRouter:
+    """
+    Route requests for a model to the worker that already has it loaded
+
+    Workers are placed on a consistent-hash ring so each model_id has a
+    stable home worker, and adding or removing a worker only moves the
+    models next to it. A worker is skipped while its in-flight load is above
+    load_factor times the average (bounded-load consistent hashing), so a
+    hot model spills over to the next worker on the ring instead of
+    queueing. Workers are plain hashable ids, so local stand-ins work as
+    well as processes or remote nodes.
+    """
+    def __init__(self, workers, load_factor=None, virtual_nodes=None):
+        self.load_factor = load_factor or config.ROUTER_LOAD_FACTOR
+        self.virtual_nodes = virtual_nodes or config.ROUTER_VIRTUAL_NODES
+        self.spillovers = 0
+        self.affinity_hits = 0
+        self._ring = []
+        self._owners = {}
+        self._load = {}
+        self._holdings = {}
+        # Models of the requests in flight on each worker
+        self._routed = {}
+        self._lock = threading.Lock()
+        for worker in workers:
+            self.add_worker(worker)
+
+    def add_worker(self, worker):
+        with self._lock:
+            if worker in self._load:
+                return
+            self._load[worker] = 0
+            self._holdings[worker] = set()
+            self._routed[worker] = Counter()
+            for i in range(self.virtual_nodes):
+                point = _hash(f"{worker}#{i}")
+                bisect.insort(self._ring, point)
+                self._owners[point] = worker
+
+    def remove_worker(self, worker):
+        with self._lock:
+            self._load.pop(worker, None)
+            self._holdings.pop(worker, None)
+            self._routed.pop(worker, None)
+            for point in [p for p, owner in self._owners.items() if owner == worker]:
+                del self._owners[point]
+                self._ring.remove(point)
+
+    def _bound(self):
+        total = sum(self._load.values()) + 1
+        return math.ceil(self.load_factor * total / len(self._load))
+
+    def _ring_order(self, model_id):
+        """Workers in ring order starting from model_id's home position"""
+        start = bisect.bisect(self._ring, _hash(model_id))
+        seen = []
+        for i in range(len(self._ring)):
+            worker = self._owners[self._ring[(start + i) % len(self._ring)]]
+            if worker not in seen:
+                seen.append(worker)
+                if len(seen) == len(self._load):
+                    break
+        return seen
+
+    def route(self, model_id):
+        """
+        Pick the worker for a request and count it as in flight there
+
+        Call release(worker, model_id) when the request finishes.
+        """
+        with self._lock:
+            if not self._load:
+                raise RuntimeError("No workers available")
+            bound = self._bound()
+            order = self._ring_order(model_id)
+
+            holders = [w for w in order if model_id in self._holdings[w] and self._load[w] < bound]
+            if holders:
+                worker = min(holders, key=lambda w: self._load[w])
+                self.affinity_hits += 1
+            else:
+                worker = next((w for w in order if self._load[w] < bound), None)
+                if worker is None:
+                    worker = min(order, key=lambda w: self._load[w])
+                if worker != order[0]:
+                    self.spillovers += 1
+
+            self._load[worker] += 1
+            self._holdings[worker].add(model_id)
+            self._routed[worker][model_id] += 1
+            return worker
+
+    def home(self, model_id):
+        """Home worker of model_id on the ring, ignoring load"""
+        with self._lock:
+            return self._ring_order(model_id)[0]
+
+    def release(self, worker, model_id=None):
+        with self._lock:
+            if self._load.get(worker):
+                self._load[worker] -= 1
+            routed = self._routed.get(worker)
+            if routed is not None and routed[model_id] > 0:
+                routed[model_id] -= 1
+                if not routed[model_id]:
+                    del routed[model_id]
+
+    def update_holdings(self, worker, model_ids):
+        """
+        Replace what a worker is known to have loaded, as it reports with results
+
+        Models of requests still in flight there are kept: they may not have
+        finished loading when the report was taken.
+        """
+        with self._lock:
+            if worker in self._holdings:
+                self._holdings[worker] = set(model_ids) | set(self._routed[worker])
+
+    def forget(self, worker):
+        """Reset a worker's state after it restarted with an empty cache"""
+        with self._lock:
+            if worker in self._load:
+                self._load[worker] = 0
+                self._holdings[worker] = set()
+                self._routed[worker] = Counter()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'load': dict(self._load),
+                'holdings': {w: sorted(models) for w, models in self._holdings.items()},
+                'affinity_hits': self.affinity_hits,
+                'spillovers': self.spillovers,
+            }
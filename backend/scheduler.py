@@ -0,0 +1,682 @@
+import heapq
+import itertools
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+
+import torch
+
+import config
+import kv_cache
+from cancellation import CancellationToken, GenerationCancelled
+from latency import LatencyTrace
+from loop_queue import LoopQueue
+from prefix_cache import PrefixCache
+
+
+class GenerationRequest:
+    """
+    A single prompt being generated by a BatchScheduler
+
+    When a detokenizer is given, the request also builds its response text as
+    tokens arrive and stops as soon as one of its stop sequences appears.
+    Streamed text holds back just enough characters that a stop sequence is
+    never partially sent to the client. The scheduler checks the cancel token
+    before every step and drops a cancelled request from the batch. Time spent
+    queued, prefilling, decoding and detokenizing is recorded on its trace.
+    With keep_prompt_cache, a copy of the prompt's KV states is kept in
+    prompt_cache after prefill so a later request can continue from it.
+    With kv_int8, its KV states rest quantized between decode steps once
+    prefill is done; each step still runs on dequantized states.
+    on_finish, if given, is called with the request once it has finished.
+    session is the (session key, turns) of a chat turn, for the caller to
+    store prompt_cache under afterwards. Waiting requests are admitted to the
+    batch lowest priority number first (see LANE_PRIORITIES).
+    """
+    def __init__(self, input_ids, max_tokens=256, temperature=0.7, stream=False, adapter_name=None,
+                 prefix_len=0, detokenizer=None, stop_sequences=None, cancel_token=None, request_id=None,
+                 trace=None, loop=None, past_prefix=None, keep_prompt_cache=False, kv_int8=False,
+                 on_finish=None, session=None, priority=0):
+        if stream and detokenizer is None:
+            raise ValueError("Streaming requests need a detokenizer")
+        self.request_id = request_id or uuid.uuid4().hex
+        self.cancel_token = cancel_token or CancellationToken()
+        self.trace = trace or LatencyTrace()
+        self.created = time.perf_counter()
+        self.input_ids = list(input_ids)
+        self.adapter_name = adapter_name
+        self.prefix_len = prefix_len
+        # KV states already computed for the start of input_ids (e.g. a chat session)
+        self.past_prefix = past_prefix
+        self.keep_prompt_cache = keep_prompt_cache
+        self.prompt_cache = None
+        self.session = session
+        self.priority = priority
+        # Hold the KV states as int8 between decode steps
+        self.kv_int8 = kv_int8
+        self.on_finish = on_finish
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.detokenizer = detokenizer
+        self.stop_sequences = [s for s in (stop_sequences or []) if s]
+        self.holdback = max((len(s) for s in self.stop_sequences), default=1) - 1
+        self.output_ids = []
+        self.text = ""
+        self.past_key_values = None
+        self.next_token = None
+        # Prompt tokens whose KV states have been computed so far
+        self.prefill_pos = 0
+        self.finish_reason = None
+        self.error = None
+        self.done = threading.Event()
+        # Streams consumed by a coroutine are delivered on its event loop
+        self.stream = None
+        if stream:
+            self.stream = LoopQueue(loop) if loop is not None else queue.Queue()
+        self._flushed = 0
+
+    def finish(self, reason, error=None):
+        """Mark the request as finished and wake up whoever is waiting on it"""
+        if self.done.is_set():
+            return
+        self.finish_reason = reason
+        self.error = error
+        self.past_key_values = None
+        if error is None:
+            self._flush(len(self.text))
+        with _in_flight_lock:
+            _in_flight.pop(self.request_id, None)
+        self.done.set()
+        if self.stream is not None:
+            self.stream.put(None)
+        if self.on_finish is not None:
+            self.on_finish(self)
+
+    def push(self, token):
+        """
+        Record a generated token
+
+        Returns:
+            True if the response text now contains a stop sequence
+        """
+        self.output_ids.append(token)
+        if self.detokenizer is None:
+            return False
+
+        started = time.perf_counter()
+        delta = self.detokenizer.add(token)
+        self.trace.add('detokenization', time.perf_counter() - started)
+        if not delta:
+            return False
+
+        search_from = max(0, len(self.text) - self.holdback)
+        self.text += delta
+        hits = [i for i in (self.text.find(stop, search_from) for stop in self.stop_sequences) if i != -1]
+        if hits:
+            self.text = self.text[:min(hits)]
+            return True
+
+        self._flush(len(self.text) - self.holdback)
+        return False
+
+    def _flush(self, upto):
+        if self.stream is not None and upto > self._flushed:
+            self.stream.put(self.text[self._flushed:upto])
+            self._flushed = upto
+
+    def iter_text(self):
+        """Yield chunks of response text as they are produced"""
+        if self.stream is None:
+            raise RuntimeError("Request was not submitted with stream=True")
+        while True:
+            text = self.stream.get()
+            if text is None:
+                break
+            yield text
+        if self.error is not None:
+            raise self.error
+
+    async def aiter_text(self):
+        """Async version of iter_text for requests created with an event loop"""
+        if not isinstance(self.stream, LoopQueue):
+            raise RuntimeError("Request was not submitted with stream=True and a loop")
+        while True:
+            text = await self.stream.get()
+            if text is None:
+                break
+            yield text
+        if self.error is not None:
+            raise self.error
+
+    def wait(self, timeout=None):
+        """Block until generation finishes and return the generated token ids"""
+        if not self.done.wait(timeout):
+            raise TimeoutError(f"Generation {self.request_id} did not finish in time")
+        if self.error is not None:
+            raise self.error
+        return self.output_ids
+
+
+class PendingQueue:
+    """
+    Requests waiting for a batch slot, lowest priority number first
+
+    Requests of equal priority keep their arrival order. wake() interrupts a
+    blocked wait() without adding a request.
+    """
+    def __init__(self):
+        self._heap = []
+        self._order = itertools.count()
+        self._woken = False
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        with self._cond:
+            return len(self._heap)
+
+    def put(self, request):
+        with self._cond:
+            heapq.heappush(self._heap, (request.priority, next(self._order), request))
+            self._cond.notify()
+
+    def wake(self):
+        with self._cond:
+            self._woken = True
+            self._cond.notify()
+
+    def wait(self):
+        """Block until a request is queued or wake() is called"""
+        with self._cond:
+            while not self._heap and not self._woken:
+                self._cond.wait()
+            self._woken = False
+
+    def get(self, max_priority):
+        """Pop the first request if its priority is at most max_priority, else None"""
+        with self._cond:
+            if not self._heap or self._heap[0][0] > max_priority:
+                return None
+            return heapq.heappop(self._heap)[2]
+
+    def take_cancelled(self):
+        """Remove and return waiting requests that were cancelled or timed out"""
+        with self._cond:
+            cancelled = [entry[2] for entry in self._heap if entry[2].cancel_token.cancelled]
+            if cancelled:
+                self._heap = [entry for entry in self._heap if not entry[2].cancel_token.cancelled]
+                heapq.heapify(self._heap)
+            return cancelled
+
+    def drain(self):
+        """Remove and return every waiting request"""
+        with self._cond:
+            requests = [entry[2] for entry in sorted(self._heap)]
+            self._heap = []
+            return requests
+
+
+class _Batch:
+    """Requests decoding together, in the row order of their stacked KV states"""
+    def __init__(self, quantized):
+        self.requests = []
+        self.cache = kv_cache.BatchedCache(quantized=quantized)
+
+
+class BatchScheduler:
+    """
+    Continuous-batching decode loop for one loaded model
+
+    Requests join the running batch as soon as they are submitted and leave it
+    as soon as they finish, so a long generation never holds back short ones.
+    The batch's KV states stay stacked between decode steps and are only
+    re-stacked when a request joins or leaves.
+    Prompts are prefilled at most PREFILL_CHUNK_TOKENS per step between
+    decode steps, so a long prompt does not stall the running batch.
+    Every request keeps its own max_tokens and temperature. When the model is
+    a PEFT model with several LoRA adapters loaded, requests for different
+    adapters share the same batch. Waiting requests join in priority order,
+    and SCHEDULER_RESERVED_CHAT_SLOTS slots are only given to the chat lane,
+    so chat turns never queue behind a batch full of long generations.
+    """
+    def __init__(self, model, tokenizer, max_batch_size=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size or config.SCHEDULER_MAX_BATCH_SIZE
+        self.reserved_slots = min(config.SCHEDULER_RESERVED_CHAT_SLOTS, self.max_batch_size - 1)
+        self.mixed_adapters = config.MIXED_ADAPTER_BATCHES
+        self.prefill_chunk_tokens = config.PREFILL_CHUNK_TOKENS
+        self.prefix_cache = PrefixCache()
+        self.device = model.device
+        self.eos_token_ids = self._eos_token_ids()
+        self._pending = PendingQueue()
+        self._calls = queue.Queue()
+        self._active = []
+        # Decoding requests by (adapter group, kv_int8)
+        self._batches = {}
+        # KV bytes alive during the latest and the largest decode step
+        self._step_bytes = 0
+        self._peak_step_bytes = 0
+        self._stopped = False
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def _eos_token_ids(self):
+        eos = getattr(self.model.generation_config, 'eos_token_id', None)
+        if eos is None:
+            eos = self.tokenizer.eos_token_id
+        if eos is None:
+            return set()
+        return set(eos) if isinstance(eos, (list, tuple)) else {eos}
+
+    def submit(self, request):
+        """Queue a request for generation and return it"""
+        if self._stopped:
+            raise RuntimeError("Scheduler has been stopped")
+        track_request(request)
+        self._pending.put(request)
+        return request
+
+    def generate(self, input_ids, max_tokens=256, temperature=0.7):
+        """Submit a prompt and block until its token ids are generated"""
+        request = self.submit(GenerationRequest(input_ids, max_tokens, temperature))
+        return request.wait()
+
+    def run_exclusive(self, fn):
+        """
+        Run fn() on the decode thread between two steps and return its result
+
+        The batch is paused while fn runs, which gives it sole use of the
+        model (e.g. for a speculative decoding loop).
+        """
+        if self._stopped:
+            raise RuntimeError("Scheduler has been stopped")
+        future = Future()
+        self._calls.put((fn, future))
+        self._pending.wake()
+        return future.result()
+
+    def attach_adapter(self, attach):
+        """
+        Call attach() between two steps and serve the model it returns from then on
+
+        Loading a LoRA adapter rewrites the base model's layers in place, so it
+        must never overlap a forward pass.
+        """
+        def run():
+            self.model = attach()
+            return self.model
+        return self.run_exclusive(run)
+
+    def unload_adapter(self, adapter_name, unload):
+        """
+        Cancel an adapter's running requests, then call unload() between two steps
+
+        Queued requests for the adapter are failed when they reach the batch,
+        so no forward pass ever runs against an adapter that is gone.
+        """
+        def run():
+            error = GenerationCancelled('adapter_unloaded')
+            for request in self._active:
+                if request.adapter_name == adapter_name:
+                    request.finish('cancelled', error)
+            self._active = [r for r in self._active if not r.done.is_set()]
+            self._drop_finished()
+            self.prefix_cache.invalidate(adapter_name)
+            return unload()
+        return self.run_exclusive(run)
+
+    def _run_calls(self):
+        while not self._calls.empty():
+            fn, future = self._calls.get_nowait()
+            try:
+                with torch.inference_mode():
+                    future.set_result(fn())
+            except Exception as e:
+                future.set_exception(e)
+
+    def stop(self):
+        """Stop the decode loop and fail every request still in flight"""
+        self._stopped = True
+        self._pending.wake()
+
+    def stats(self):
+        return {
+            'active': len(self._active),
+            'pending': len(self._pending),
+            'prefilling': sum(1 for r in list(self._active) if r.prefill_pos < len(r.input_ids)),
+            'max_batch_size': self.max_batch_size,
+            'prefill_chunk_tokens': self.prefill_chunk_tokens,
+            'prefix_cache': self.prefix_cache.stats(),
+            'kv_cache': self._kv_stats(),
+        }
+
+    def _kv_stats(self):
+        """
+        Memory held by the KV states of running requests and what int8 storage saves
+
+        bytes is what rests between steps. During a step the model works on
+        full-precision states and returns a new full-precision cache, so
+        step_bytes (the latest step) and peak_step_bytes (the largest so far)
+        are what the device must actually fit; int8 lowers them by less than
+        it lowers bytes.
+        """
+        held = full = 0
+        for batch in list(self._batches.values()):
+            held += batch.cache.nbytes
+            full += batch.cache.full_precision_nbytes
+        for request in list(self._active):
+            # Requests still prefilling hold their own full-precision states
+            nbytes = kv_cache.cache_nbytes(request.past_key_values)
+            held += nbytes
+            full += nbytes
+        return {
+            'bytes': held,
+            'full_precision_bytes': full,
+            'saved_bytes': full - held,
+            'step_bytes': self._step_bytes,
+            'peak_step_bytes': self._peak_step_bytes,
+        }
+
+    def _loop(self):
+        while not self._stopped:
+            self._run_calls()
+            self._admit()
+            if not self._active:
+                continue
+            try:
+                with torch.inference_mode():
+                    self._step()
+            except Exception as e:
+                print(f"❌ Decode step failed: {str(e)}")
+                for request in self._active:
+                    request.finish('error', e)
+                self._batches = {}
+            self._active = [r for r in self._active if not r.done.is_set()]
+
+        error = RuntimeError("Scheduler stopped")
+        for request in self._active:
+            request.finish('error', error)
+        self._batches = {}
+        while not self._calls.empty():
+            _, future = self._calls.get_nowait()
+            future.set_exception(error)
+        for request in self._pending.drain():
+            request.finish('error', error)
+
+    def _admit(self):
+        """Move pending requests into the running batch; block only when idle"""
+        if not self._active:
+            self._pending.wait()
+        # A request whose deadline passes while it waits fails now, not when
+        # a slot frees up
+        for request in self._pending.take_cancelled():
+            request.finish('cancelled', request.cancel_token.error())
+        while len(self._active) < self.max_batch_size:
+            # Only the highest priority lane may take the reserved slots
+            reserved = len(self._active) >= self.max_batch_size - self.reserved_slots
+            request = self._pending.get(0 if reserved else float('inf'))
+            if request is None:
+                break
+            if request.cancel_token.cancelled:
+                request.finish('cancelled', request.cancel_token.error())
+                continue
+            if request.adapter_name and request.adapter_name not in getattr(self.model, 'peft_config', {}):
+                request.finish('cancelled', GenerationCancelled('adapter_unloaded'))
+                continue
+            request.trace.add('queue', time.perf_counter() - request.created)
+            self._active.append(request)
+
+    def _step(self):
+        for request in self._active:
+            if request.cancel_token.cancelled:
+                request.finish('cancelled', request.cancel_token.error())
+        self._drop_finished()
+
+        # Long prompts are prefilled a chunk per step, so the decode batch keeps
+        # moving while they are admitted
+        budget = self.prefill_chunk_tokens or float('inf')
+        for request in self._active:
+            if budget <= 0:
+                break
+            if request.prefill_pos < len(request.input_ids) and not request.done.is_set():
+                budget -= self._prefill(request, budget)
+
+        # Batches decode one after another, each briefly holding the cache the
+        # model returns alongside the stored one
+        resting = sum(batch.cache.nbytes for batch in self._batches.values())
+        transient = [self._decode(batch) for batch in list(self._batches.values())]
+        if transient:
+            self._step_bytes = resting + max(transient)
+            self._peak_step_bytes = max(self._peak_step_bytes, self._step_bytes)
+        self._drop_finished()
+
+    def _join(self, request):
+        """Move a prefilled request's KV states into its decode batch"""
+        key = (None if self.mixed_adapters else request.adapter_name, request.kv_int8)
+        batch = self._batches.get(key)
+        if batch is None:
+            batch = self._batches[key] = _Batch(quantized=request.kv_int8)
+        batch.cache.add(request.past_key_values)
+        batch.requests.append(request)
+        request.past_key_values = None
+
+    def _drop_finished(self):
+        """Take finished requests' rows out of their batches"""
+        for key, batch in list(self._batches.items()):
+            rows = [row for row, request in enumerate(batch.requests) if request.done.is_set()]
+            if rows:
+                batch.cache.remove(rows)
+                batch.requests = [r for row, r in enumerate(batch.requests) if row not in rows]
+            if not batch.requests:
+                del self._batches[key]
+
+    def _forward(self, requests, **inputs):
+        """Run the model, routing each row through its request's LoRA adapter"""
+        names = [r.adapter_name for r in requests]
+        if not any(names):
+            return self.model(**inputs)
+        if self.mixed_adapters:
+            return self.model(**inputs, adapter_names=[name or '__base__' for name in names])
+        self.model.set_adapter(names[0])
+        return self.model(**inputs)
+
+    def _prefix_kv(self, request):
+        """KV states for the request's shared prefix, computed once per adapter"""
+        prefix_ids = request.input_ids[:request.prefix_len]
+        past = self.prefix_cache.get(request.adapter_name, prefix_ids)
+        if past is None:
+            input_ids = torch.tensor([prefix_ids], device=self.device)
+            outputs = self._forward([request], input_ids=input_ids, use_cache=True)
+            past = tuple((k.clone(), v.clone()) for k, v in kv_cache.to_legacy(outputs.past_key_values))
+            self.prefix_cache.put(request.adapter_name, prefix_ids, past)
+        return past
+
+    def _prefill(self, request, budget=float('inf')):
+        """
+        Prefill up to budget more prompt tokens of a request
+
+        Returns:
+            Number of prompt tokens processed
+        """
+        started = time.perf_counter()
+        if request.prefill_pos == 0:
+            if request.past_prefix is not None:
+                request.past_key_values, request.past_prefix = request.past_prefix, None
+                request.prefill_pos = kv_cache.cache_length(request.past_key_values)
+            elif 0 < request.prefix_len < len(request.input_ids):
+                request.past_key_values = self._prefix_kv(request)
+                request.prefill_pos = request.prefix_len
+
+        end = min(len(request.input_ids), request.prefill_pos + budget)
+        input_ids = torch.tensor([request.input_ids[request.prefill_pos:end]], device=self.device)
+        outputs = self._forward(
+            [request],
+            input_ids=input_ids,
+            past_key_values=kv_cache.from_legacy(request.past_key_values),
+            use_cache=True,
+        )
+        processed = end - request.prefill_pos
+        request.past_key_values = kv_cache.to_legacy(outputs.past_key_values)
+        request.prefill_pos = end
+        request.trace.add('prefill', time.perf_counter() - started)
+        if end < len(request.input_ids):
+            return processed
+
+        if request.keep_prompt_cache:
+            request.prompt_cache = tuple((k.clone(), v.clone()) for k, v in request.past_key_values)
+        self._accept(request, outputs.logits[0, -1])
+        if not request.done.is_set():
+            self._join(request)
+        return processed
+
+    def _decode(self, batch):
+        """Run one decode step of a batch; returns the bytes of the cache the model built"""
+        started = time.perf_counter()
+        requests, cache = batch.requests, batch.cache
+        input_ids = torch.tensor([[r.next_token] for r in requests], device=self.device)
+        position_ids = torch.tensor([[length] for length in cache.lengths], device=self.device)
+
+        outputs = self._forward(
+            requests,
+            input_ids=input_ids,
+            attention_mask=cache.attention_mask(self.device),
+            position_ids=position_ids,
+            past_key_values=kv_cache.from_legacy(cache.legacy()),
+            use_cache=True,
+        )
+        legacy = kv_cache.to_legacy(outputs.past_key_values)
+        transient = kv_cache.cache_nbytes(legacy)
+        cache.advance(legacy)
+
+        # Every request in the batch waited for the whole step
+        elapsed = time.perf_counter() - started
+        for row, request in enumerate(requests):
+            request.trace.add_decode_step(elapsed)
+            self._accept(request, outputs.logits[row, -1])
+        return transient
+
+    def _accept(self, request, logits):
+        """Sample the next token for a request and decide whether it is finished"""
+        token = sample_token(logits, request.temperature)
+        request.next_token = None
+
+        if token in self.eos_token_ids:
+            request.finish('stop')
+            return
+
+        if request.push(token):
+            request.finish('stop_sequence')
+            return
+
+        if len(request.output_ids) >= request.max_tokens:
+            request.finish('length')
+            return
+
+        request.next_token = token
+
+
+def sampling_probs(logits, temperature, top_k=None):
+    """Distribution sample_token draws from: softmax at temperature over the top_k logits"""
+    logits = logits.float() / temperature
+    top_k = top_k or config.SAMPLING_TOP_K
+    if top_k and top_k < logits.shape[-1]:
+        threshold = torch.topk(logits, top_k).values[..., -1:]
+        logits = logits.masked_fill(logits < threshold, float('-inf'))
+    return torch.softmax(logits, dim=-1)
+
+
+def sample_token(logits, temperature, top_k=None):
+    """Pick the next token from a row of logits using the request's temperature"""
+    if temperature is None or temperature <= 0:
+        return int(torch.argmax(logits))
+    return int(torch.multinomial(sampling_probs(logits, temperature, top_k), 1))
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+# Requests queued or running on any scheduler, by request_id
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+
+def track_request(request):
+    """Make a request visible to list_requests and cancel_request until it finishes"""
+    with _in_flight_lock:
+        _in_flight[request.request_id] = request
+
+
+def cancel_request(request_id, reason='cancelled'):
+    """Cancel an in-flight request; returns False if it is unknown or already done"""
+    with _in_flight_lock:
+        request = _in_flight.get(request_id)
+    if request is None:
+        return False
+    request.cancel_token.cancel(reason)
+    return True
+
+
+def list_requests():
+    """Summaries of every queued or running request"""
+    with _in_flight_lock:
+        requests = list(_in_flight.values())
+    return [{
+        'request_id': r.request_id,
+        'adapter': r.adapter_name,
+        'prompt_tokens': len(r.input_ids),
+        'generated_tokens': len(r.output_ids),
+        'max_tokens': r.max_tokens,
+    } for r in requests]
+
+
+def get_scheduler(key, model, tokenizer):
+    """Return the scheduler serving the cached model under key, starting one if needed"""
+    with _schedulers_lock:
+        if key not in _schedulers:
+            _schedulers[key] = BatchScheduler(model, tokenizer)
+        return _schedulers[key]
+
+
+def get_stats():
+    """Batch occupancy and prefix cache counters of every running scheduler"""
+    with _schedulers_lock:
+        schedulers = dict(_schedulers)
+    return {key: scheduler.stats() for key, scheduler in schedulers.items()}
+
+
+def is_busy(key):
+    """Whether the scheduler for key still has requests in flight"""
+    with _schedulers_lock:
+        scheduler = _schedulers.get(key)
+    if scheduler is None:
+        return False
+    stats = scheduler.stats()
+    return bool(stats['active'] or stats['pending'])
+
+
+def unload_adapter(key, adapter_name, unload):
+    """Run unload() for an adapter of the model under key once no forward pass can use it"""
+    with _schedulers_lock:
+        scheduler = _schedulers.get(key)
+    if scheduler is None or scheduler._stopped:
+        return unload()
+    return scheduler.unload_adapter(adapter_name, unload)
+
+
+def remove_scheduler(key):
+    """Stop and forget the scheduler serving key"""
+    with _schedulers_lock:
+        scheduler = _schedulers.pop(key, None)
+    if scheduler:
+        scheduler.stop()
+
+
+def clear_schedulers():
+    """Stop every running scheduler"""
+    with _schedulers_lock:
+        schedulers = list(_schedulers.values())
+        _schedulers.clear()
+    for scheduler in schedulers:
+        scheduler.stop()
@@ -0,0 +1,180 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+import config
+import kv_cache
+
+
+class SessionState:
+    """
+    KV states of a chat session through its latest prompt
+
+    token_ids are the tokens the states cover; the reply to that prompt is
+    kept as text and prefilled together with the next message. device is
+    where the states are used, even while they are parked in host memory.
+    """
+    def __init__(self, token_ids, past_key_values, last_response, turns):
+        self.token_ids = list(token_ids)
+        self.past_key_values = past_key_values
+        self.last_response = last_response
+        self.turns = turns
+        self.device = kv_cache.cache_device(past_key_values)
+        self.nbytes = kv_cache.cache_nbytes(past_key_values)
+
+
+class SessionCache:
+    """
+    Tiered LRU store of per-session KV states
+
+    Hot sessions stay on the model's device up to budget_bytes. The least
+    recently used ones are demoted to host memory (page-locked when the
+    device is CUDA) up to host_budget_bytes; past that they are dropped and
+    the next turn rebuilds them from the conversations table. On CPU nodes
+    both tiers are plain RAM and demotion only moves the accounting.
+
+    Keys are (model key, adapter name, session id). take() removes the entry
+    so one turn owns a session's states while it runs; the turn puts the
+    extended states back when it finishes. prefetch() starts copying a
+    demoted session back to its device as soon as its next request arrives.
+    """
+    def __init__(self, budget_bytes=None, host_budget_bytes=None):
+        self.budget_bytes = budget_bytes if budget_bytes is not None else config.SESSION_CACHE_BYTES
+        self.host_budget_bytes = (
+            host_budget_bytes if host_budget_bytes is not None else config.SESSION_HOST_CACHE_BYTES
+        )
+        self.used_bytes = 0
+        self.host_used_bytes = 0
+        self.device_hits = 0
+        self.host_hits = 0
+        self.prefetched_hits = 0
+        self.misses = 0
+        self.demotions = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._host_entries = OrderedDict()
+        self._prefetching = {}
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='session-prefetch')
+        self._lock = threading.Lock()
+
+    def take(self, key):
+        with self._lock:
+            state = self._entries.pop(key, None)
+            if state is not None:
+                self.device_hits += 1
+                self.used_bytes -= state.nbytes
+                return state
+            prefetch = self._prefetching.pop(key, None)
+            if prefetch is None:
+                state = self._host_entries.pop(key, None)
+                if state is None:
+                    self.misses += 1
+                    return None
+                self.host_hits += 1
+                self.host_used_bytes -= state.nbytes
+            else:
+                self.prefetched_hits += 1
+
+        if prefetch is not None:
+            return prefetch.result()
+        return self._promote(state)
+
+    def prefetch(self, key):
+        """Start moving a demoted session back to its device in the background"""
+        with self._lock:
+            state = self._host_entries.pop(key, None)
+            if state is None:
+                return
+            self.host_used_bytes -= state.nbytes
+            self._prefetching[key] = self._executor.submit(self._promote, state)
+
+    def _promote(self, state):
+        if state.device.type != 'cuda':
+            return state
+        # A side stream lets the copy overlap with whatever the model is running
+        stream = torch.cuda.Stream(state.device)
+        with torch.cuda.stream(stream):
+            state.past_key_values = kv_cache.to_device(state.past_key_values, state.device, non_blocking=True)
+        stream.synchronize()
+        return state
+
+    def _demote(self, state):
+        if state.device.type == 'cuda':
+            state.past_key_values = kv_cache.to_host(state.past_key_values, pin_memory=True)
+        return state
+
+    def put(self, key, state):
+        if state.nbytes > self.budget_bytes:
+            return
+        demoted = []
+        with self._lock:
+            self._discard(key)
+            while self._entries and self.used_bytes + state.nbytes > self.budget_bytes:
+                old_key, old_state = self._entries.popitem(last=False)
+                self.used_bytes -= old_state.nbytes
+                demoted.append((old_key, old_state))
+            self._entries[key] = state
+            self.used_bytes += state.nbytes
+
+        # Copies run outside the lock; a demoted session is unreachable until stored
+        for old_key, old_state in demoted:
+            self._store_host(old_key, self._demote(old_state))
+
+    def _store_host(self, key, state):
+        with self._lock:
+            self.demotions += 1
+            if state.nbytes > self.host_budget_bytes:
+                self.evictions += 1
+                return
+            while self._host_entries and self.host_used_bytes + state.nbytes > self.host_budget_bytes:
+                _, evicted = self._host_entries.popitem(last=False)
+                self.host_used_bytes -= evicted.nbytes
+                self.evictions += 1
+            self._host_entries[key] = state
+            self.host_used_bytes += state.nbytes
+
+    def _discard(self, key):
+        state = self._entries.pop(key, None)
+        if state is not None:
+            self.used_bytes -= state.nbytes
+        state = self._host_entries.pop(key, None)
+        if state is not None:
+            self.host_used_bytes -= state.nbytes
+        self._prefetching.pop(key, None)
+
+    def device_bytes(self):
+        """Bytes of session KV states currently held on the device tier"""
+        with self._lock:
+            return self.used_bytes
+
+    def invalidate(self, model_key, adapter_name=None):
+        """Drop the sessions of a model, or of one of its adapters, from every tier"""
+        with self._lock:
+            keys = set(self._entries) | set(self._host_entries) | set(self._prefetching)
+            for key in keys:
+                if key[0] == model_key and (adapter_name is None or key[1] == adapter_name):
+                    self._discard(key)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.device_hits + self.host_hits + self.prefetched_hits + self.misses
+            return {
+                'sessions': len(self._entries),
+                'host_sessions': len(self._host_entries),
+                'prefetching': len(self._prefetching),
+                'used_bytes': self.used_bytes,
+                'budget_bytes': self.budget_bytes,
+                'host_used_bytes': self.host_used_bytes,
+                'host_budget_bytes': self.host_budget_bytes,
+                'device_hits': self.device_hits,
+                'host_hits': self.host_hits,
+                'prefetched_hits': self.prefetched_hits,
+                'misses': self.misses,
+                'demotions': self.demotions,
+                'evictions': self.evictions,
+                'device_hit_rate': self.device_hits / lookups if lookups else 0.0,
+                'host_hit_rate': (self.host_hits + self.prefetched_hits) / lookups if lookups else 0.0,
+                'miss_rate': self.misses / lookups if lookups else 0.0,
+            }
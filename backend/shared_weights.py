@@ -0,0 +1,89 @@
+import os
+import re
+
+import torch
+from accelerate import init_empty_weights
+
+import config
+
+
+def shared_weights_path(model_name, dtype):
+    """File holding the exported weights of model_name in dtype"""
+    safe_name = re.sub(r'[^A-Za-z0-9_.-]', '_', model_name)
+    dtype_name = str(dtype).replace('torch.', '')
+    return os.path.join(config.SHARED_WEIGHTS_PATH, f"{safe_name}-{dtype_name}.pt")
+
+
+def export_weights(model_name, dtype, path):
+    """Load model_name once and write its state dict where workers can map it"""
+    from transformers import AutoModelForCausalLM
+
+    print(f"📤 Exporting shared weights for {model_name} to {path}...")
+    model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=dtype)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    torch.save(model.state_dict(), tmp_path)
+    os.replace(tmp_path, path)
+    del model
+
+
+def _ensure_exported(model_name, dtype, path):
+    """
+    Export the weights unless another process already did or is doing it
+
+    Exporters hold an flock on a lock file next to the export. The kernel
+    drops it when the holder exits, so a crashed (e.g. OOM-killed) exporter
+    cannot leave the other workers waiting forever; the next one exports.
+    """
+    import fcntl
+
+    if os.path.exists(path):
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if not os.path.exists(path):
+                export_weights(model_name, dtype, path)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def load_shared(model_name, dtype):
+    """
+    Build a CPU model whose weights are memory-mapped from a shared file
+
+    The first process to ask exports the weights; every process then maps
+    the same file read-only, so the OS page cache holds a single copy of the
+    base weights however many workers serve it. Only per-process state such
+    as LoRA adapters and KV caches is private.
+
+    Args:
+        model_name: Full-precision hub id or directory of the base model
+        dtype: Weight dtype to export and map
+
+    Returns:
+        The model with weights backed by the mapped file
+    """
+    from transformers import AutoConfig, AutoModelForCausalLM
+
+    path = shared_weights_path(model_name, dtype)
+    _ensure_exported(model_name, dtype, path)
+
+    model_config = AutoConfig.from_pretrained(model_name)
+    with init_empty_weights():
+        model = AutoModelForCausalLM.from_config(model_config, torch_dtype=dtype)
+
+    state_dict = torch.load(path, mmap=True, weights_only=True, map_location='cpu')
+    result = model.load_state_dict(state_dict, assign=True, strict=False)
+    # Anything else left out would stay a meta tensor and fail at the first forward
+    tied = set(getattr(model, '_tied_weights_keys', None) or [])
+    missing = [key for key in result.missing_keys if key not in tied]
+    if missing or result.unexpected_keys:
+        raise RuntimeError(
+            f"Shared weights {path} do not match {model_name}: "
+            f"missing {missing[:5]}, unexpected {result.unexpected_keys[:5]}"
+        )
+    model.tie_weights()
+    print(f"🔗 Mapped shared weights from {path}")
+    return model
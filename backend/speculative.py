@@ -0,0 +1,173 @@
+import time
+
+import torch
+
+import kv_cache
+import scheduler
+
+
+def check_compatible(target_tokenizer, draft_tokenizer):
+    """Speculative decoding compares token ids, so both models must share a vocabulary"""
+    if target_tokenizer.get_vocab() != draft_tokenizer.get_vocab():
+        raise ValueError(
+            "Draft model uses a different vocabulary than the target model; "
+            "pick a draft from the same model family"
+        )
+
+
+def _forward(model, cache, tokens, adapter_name, device):
+    """Feed tokens after a cached prefix; returns (new legacy cache, logits for each token)"""
+    kwargs = {'adapter_names': [adapter_name]} if adapter_name else {}
+    outputs = model(
+        input_ids=torch.tensor([tokens], device=device),
+        past_key_values=kv_cache.from_legacy(cache),
+        use_cache=True,
+        **kwargs,
+    )
+    return kv_cache.to_legacy(outputs.past_key_values), outputs.logits[0].float()
+
+
+def _crop(cache, length):
+    return tuple((k[:, :, :length, :], v[:, :, :length, :]) for k, v in cache)
+
+
+def _probs(logits, temperature):
+    # The same top-k filtered distribution the batch scheduler samples from
+    if temperature <= 0:
+        return None
+    return scheduler.sampling_probs(logits, temperature)
+
+
+def _pick(logits, probs):
+    if probs is None:
+        return int(torch.argmax(logits))
+    return int(torch.multinomial(probs, 1))
+
+
+def speculative_generate(target, draft, request, eos_token_ids, k=4,
+                         target_adapter=None, draft_adapter=None):
+    """
+    Generate tokens for request with a draft model proposing k tokens at a time
+
+    The draft model proposes k tokens autoregressively and the target model
+    scores all of them in one forward pass. Proposals are accepted with the
+    standard rejection rule (exact match under greedy decoding), so the output
+    follows the same top-k sampling distribution as plain decoding.
+
+    This is a generator that yields after every round, so the caller can let
+    other work use the model in between; its return value is the stats dict.
+
+    Args:
+        target: Model whose output distribution is produced
+        draft: Smaller model sharing the target's vocabulary
+        request: GenerationRequest holding the prompt, limits and cancel token
+        eos_token_ids: Token ids that end the generation
+        k: Number of tokens the draft proposes per round
+        target_adapter: LoRA adapter to route target forwards through
+        draft_adapter: LoRA adapter to route draft forwards through
+
+    Returns:
+        Dict with acceptance rate and speedup for this request
+    """
+    device = next(target.parameters()).device
+    draft_device = next(draft.parameters()).device
+    temperature = request.temperature or 0
+    started = time.time()
+
+    seq = list(request.input_ids)
+    target_cache, logits = _forward(target, None, seq, target_adapter, device)
+    target_steps = 1
+    draft_cache = None
+    proposed = accepted = 0
+    next_token = _pick(logits[-1], _probs(logits[-1], temperature))
+
+    while True:
+        if next_token in eos_token_ids:
+            request.finish('stop')
+            break
+        seq.append(next_token)
+        if request.push(next_token):
+            request.finish('stop_sequence')
+            break
+        if len(request.output_ids) >= request.max_tokens:
+            request.finish('length')
+            break
+        if request.cancel_token.cancelled:
+            request.finish('cancelled', request.cancel_token.error())
+            break
+
+        # Draft proposes k tokens after the last accepted one
+        proposals, draft_probs = [], []
+        draft_in = seq[kv_cache.cache_length(draft_cache):]
+        for _ in range(k):
+            draft_cache, draft_logits = _forward(draft, draft_cache, draft_in, draft_adapter, draft_device)
+            probs = _probs(draft_logits[-1], temperature)
+            token = _pick(draft_logits[-1], probs)
+            proposals.append(token)
+            draft_probs.append(probs)
+            draft_in = [token]
+
+        # Target scores the unprocessed tail plus every proposal in one pass
+        target_in = seq[kv_cache.cache_length(target_cache):] + proposals
+        target_cache, logits = _forward(target, target_cache, target_in, target_adapter, device)
+        target_steps += 1
+        base = len(target_in) - k - 1
+
+        n_accepted = 0
+        next_token = None
+        for i, token in enumerate(proposals):
+            row = logits[base + i]
+            if temperature <= 0:
+                if int(torch.argmax(row)) != token:
+                    next_token = int(torch.argmax(row))
+                    break
+            else:
+                p = _probs(row, temperature)
+                q = draft_probs[i].to(p.device)
+                if torch.rand(()) >= torch.clamp(p[token] / q[token], max=1.0):
+                    residual = torch.clamp(p - q, min=0)
+                    next_token = int(torch.multinomial(residual / residual.sum(), 1))
+                    break
+            n_accepted += 1
+
+        proposed += k
+        accepted += n_accepted
+        if next_token is None:
+            row = logits[base + k]
+            next_token = _pick(row, _probs(row, temperature))
+
+        finished = False
+        for token in proposals[:n_accepted]:
+            if token in eos_token_ids:
+                request.finish('stop')
+                finished = True
+                break
+            seq.append(token)
+            if request.push(token):
+                request.finish('stop_sequence')
+                finished = True
+                break
+            if len(request.output_ids) >= request.max_tokens:
+                request.finish('length')
+                finished = True
+                break
+        if finished:
+            break
+
+        # Keep only cache entries for tokens that were actually accepted
+        target_cache = _crop(target_cache, len(seq))
+        draft_cache = _crop(draft_cache, min(kv_cache.cache_length(draft_cache), len(seq)))
+        yield
+
+    elapsed = time.time() - started
+    generated = len(request.output_ids)
+    return {
+        'proposed_tokens': proposed,
+        'accepted_tokens': accepted,
+        'acceptance_rate': accepted / proposed if proposed else 0.0,
+        'target_forward_passes': target_steps,
+        'generated_tokens': generated,
+        # Plain decoding needs one target pass per token
+        'speedup': generated / target_steps if target_steps else 0.0,
+        'tokens_per_second': generated / elapsed if elapsed else 0.0,
+    }
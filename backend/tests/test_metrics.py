@@ -0,0 +1,26 @@
+import threading
+
+from metrics import Counter, Histogram
+
+
+def test_shards_stay_bounded_across_many_threads():
+    counter = Counter('test_total', 'test', ('route',))
+    histogram = Histogram('test_seconds', 'test', buckets=(0.5, 1.0))
+
+    def work():
+        for _ in range(10):
+            counter.inc('/chat')
+            histogram.observe(0.25)
+
+    threads = [threading.Thread(target=work) for _ in range(500)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(counter._shards) == len(histogram._shards) <= 64
+    assert 'test_total{route="/chat"} 5000' in counter.collect()
+    lines = histogram.collect()
+    assert 'test_seconds_bucket{le="0.5"} 5000' in lines
+    assert 'test_seconds_count 5000' in lines
+    assert 'test_seconds_sum 1250' in lines
@@ -0,0 +1,88 @@
+import pytest
+
+from router import ModelRouter
+
+WORKERS = [0, 1, 2, 3]
+MODEL_IDS = [f"model-{i}" for i in range(200)]
+
+
+@pytest.fixture
+def router():
+    return ModelRouter(WORKERS, load_factor=1.25, virtual_nodes=64)
+
+
+def test_model_goes_to_its_home_worker(router):
+    home = router.home('model-a')
+    assert router.route('model-a') == home
+    assert router.stats()['load'][home] == 1
+    assert router.stats()['spillovers'] == 0
+
+
+def test_every_worker_is_home_to_some_models(router):
+    assert {router.home(model_id) for model_id in MODEL_IDS} == set(WORKERS)
+
+
+def test_removing_a_worker_only_moves_its_models(router):
+    before = {model_id: router.home(model_id) for model_id in MODEL_IDS}
+    router.remove_worker(2)
+    for model_id, home in before.items():
+        if home != 2:
+            assert router.home(model_id) == home
+        else:
+            assert router.home(model_id) != 2
+
+
+def test_busy_home_worker_spills_over_along_the_ring(router):
+    home = router.route('model-a')
+    # The bound is ceil(1.25 * 2 / 4) = 1, so the home worker is full
+    spilled = router.route('model-a')
+    assert spilled != home
+    assert router.stats()['spillovers'] == 1
+    assert router.stats()['load'][spilled] == 1
+
+
+def test_holder_is_preferred_over_home(router):
+    home = router.home('model-a')
+    holder = next(w for w in WORKERS if w != home)
+    router.update_holdings(holder, ['model-a'])
+    assert router.route('model-a') == holder
+    assert router.stats()['affinity_hits'] == 1
+    assert router.stats()['spillovers'] == 0
+
+
+def test_release_frees_the_slot_for_the_same_worker(router):
+    worker = router.route('model-a')
+    router.release(worker, 'model-a')
+    assert router.stats()['load'][worker] == 0
+    assert router.route('model-a') == worker
+    assert router.stats()['affinity_hits'] == 1
+    # Releasing more than was routed never goes negative
+    router.release(worker, 'model-a')
+    router.release(worker, 'model-a')
+    assert router.stats()['load'][worker] == 0
+
+
+def test_reported_holdings_replace_known_ones(router):
+    worker = router.route('model-a')
+    router.release(worker, 'model-a')
+    # The worker evicted model-a and reported so with its next result
+    router.update_holdings(worker, ['model-b'])
+    assert router.stats()['holdings'][worker] == ['model-b']
+
+
+def test_report_keeps_models_still_in_flight(router):
+    worker = router.route('model-a')
+    # A report taken before model-a finished loading must not drop it
+    router.update_holdings(worker, [])
+    assert router.stats()['holdings'][worker] == ['model-a']
+    router.release(worker, 'model-a')
+    router.update_holdings(worker, [])
+    assert router.stats()['holdings'][worker] == []
+
+
+def test_forget_resets_a_restarted_worker(router):
+    worker = router.route('model-a')
+    router.forget(worker)
+    stats = router.stats()
+    assert stats['load'][worker] == 0
+    assert stats['holdings'][worker] == []
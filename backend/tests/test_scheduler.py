@@ -0,0 +1,162 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+import config
+import kv_cache
+from cancellation import CancellationToken, GenerationCancelled
+from scheduler import BatchScheduler, GenerationRequest, PendingQueue
+
+VOCAB = 32
+EOS = 0
+
+
+class CountingModel:
+    """
+    Stand-in causal LM whose next token is always the last input token + 1
+
+    Its single-layer cache stores each token id + 1, so left padding (zeros)
+    is recognisable, and every forward checks that the attention mask and
+    position ids line up with the cache it is given.
+    """
+    def __init__(self):
+        self.device = torch.device('cpu')
+        self.generation_config = SimpleNamespace(eos_token_id=EOS)
+        self.batch_sizes = []
+        # Seconds per forward, so tests can act while a batch is running
+        self.delay = 0
+
+    def __call__(self, input_ids, past_key_values=None, attention_mask=None, position_ids=None,
+                 use_cache=True, **kwargs):
+        past = kv_cache.to_legacy(past_key_values)
+        new = (input_ids.float() + 1)[:, None, :, None]
+        keys = torch.cat([past[0][0], new], dim=-2) if past else new
+        real = keys[:, 0, :, 0] != 0
+        if attention_mask is not None:
+            assert torch.equal(attention_mask.bool(), real)
+        if position_ids is not None:
+            assert torch.equal(position_ids[:, -1], real.sum(dim=-1) - 1)
+        self.batch_sizes.append(input_ids.shape[0])
+        time.sleep(self.delay)
+
+        logits = torch.full((*input_ids.shape, VOCAB), -1e4)
+        logits.scatter_(-1, ((input_ids + 1) % VOCAB)[..., None], 1e4)
+        return SimpleNamespace(logits=logits, past_key_values=((keys, keys.clone()),))
+
+
+def expected_tokens(prompt, max_tokens):
+    tokens, token = [], prompt[-1]
+    while len(tokens) < max_tokens:
+        token = (token + 1) % VOCAB
+        if token == EOS:
+            break
+        tokens.append(token)
+    return tokens
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.001)
+
+
+@pytest.fixture
+def model():
+    return CountingModel()
+
+
+@pytest.fixture
+def batch_scheduler(model, monkeypatch):
+    monkeypatch.setattr(config, 'PREFILL_CHUNK_TOKENS', 4)
+    monkeypatch.setattr(config, 'SCHEDULER_RESERVED_CHAT_SLOTS', 0)
+    scheduler = BatchScheduler(model, SimpleNamespace(eos_token_id=EOS), max_batch_size=4)
+    yield scheduler
+    scheduler.stop()
+
+
+def test_generates_until_max_tokens(batch_scheduler):
+    request = batch_scheduler.submit(GenerationRequest([3, 4, 5], max_tokens=5, temperature=0))
+    assert request.wait(timeout=10) == [6, 7, 8, 9, 10]
+    assert request.finish_reason == 'length'
+
+
+def test_stops_at_eos(batch_scheduler):
+    request = batch_scheduler.submit(GenerationRequest([29], max_tokens=10, temperature=0))
+    assert request.wait(timeout=10) == [30, 31]
+    assert request.finish_reason == 'stop'
+
+
+@pytest.mark.parametrize('kv_int8', [False, True])
+def test_requests_of_different_lengths_share_a_batch(batch_scheduler, model, kv_int8):
+    prompts = [[1], [2, 3, 4, 5, 6, 7, 8, 9, 10], [5, 6], [11, 12, 13, 14, 15]]
+    limits = [12, 3, 8, 20]
+    requests = [
+        batch_scheduler.submit(GenerationRequest(prompt, max_tokens=limit, temperature=0, kv_int8=kv_int8))
+        for prompt, limit in zip(prompts, limits)
+    ]
+    for request, prompt, limit in zip(requests, prompts, limits):
+        assert request.wait(timeout=10) == expected_tokens(prompt, limit)
+    assert max(model.batch_sizes) > 1
+    wait_for(lambda: batch_scheduler.stats()['kv_cache']['bytes'] == 0)
+
+
+def test_request_joins_and_leaves_a_running_batch(batch_scheduler, model):
+    model.delay = 0.005
+    long = batch_scheduler.submit(GenerationRequest([1, 2], max_tokens=25, temperature=0))
+    wait_for(lambda: len(long.output_ids) >= 3)
+    short = batch_scheduler.submit(GenerationRequest([7, 8, 9, 10, 11, 12], max_tokens=4, temperature=0))
+    assert short.wait(timeout=10) == expected_tokens([12], 4)
+    assert not long.done.is_set()
+    assert long.wait(timeout=10) == expected_tokens([2], 25)
+
+
+def test_sampling_keeps_each_requests_temperature(batch_scheduler):
+    greedy = batch_scheduler.submit(GenerationRequest([4], max_tokens=6, temperature=0))
+    sampled = batch_scheduler.submit(GenerationRequest([9], max_tokens=6, temperature=0.7))
+    assert greedy.wait(timeout=10) == expected_tokens([4], 6)
+    # The stand-in's logits leave no probability anywhere else
+    assert sampled.wait(timeout=10) == expected_tokens([9], 6)
+
+
+def test_cancelled_request_leaves_the_batch(batch_scheduler, model):
+    model.delay = 0.005
+    cancelled = batch_scheduler.submit(GenerationRequest([1], max_tokens=30, temperature=0))
+    other = batch_scheduler.submit(GenerationRequest([2, 3], max_tokens=12, temperature=0))
+    wait_for(lambda: len(cancelled.output_ids) >= 2)
+    cancelled.cancel_token.cancel('client_disconnected')
+    with pytest.raises(GenerationCancelled):
+        cancelled.wait(timeout=10)
+    assert other.wait(timeout=10) == expected_tokens([3], 12)
+
+
+def test_queued_request_times_out_while_the_batch_is_full(model):
+    model.delay = 0.005
+    full_scheduler = BatchScheduler(model, SimpleNamespace(eos_token_id=EOS), max_batch_size=1)
+    try:
+        running = full_scheduler.submit(GenerationRequest([1], max_tokens=30, temperature=0))
+        wait_for(lambda: running.output_ids)
+        queued = full_scheduler.submit(GenerationRequest([2], cancel_token=CancellationToken(timeout=0.02)))
+        with pytest.raises(GenerationCancelled):
+            queued.wait(timeout=1)
+        assert queued.finish_reason == 'cancelled'
+        assert not running.done.is_set()
+    finally:
+        full_scheduler.stop()
+
+
+def test_pending_queue_orders_by_priority_then_arrival():
+    pending = PendingQueue()
+    for name, priority in [('batch', 2), ('advice-1', 1), ('chat-1', 0), ('advice-2', 1), ('chat-2', 0)]:
+        request = GenerationRequest([1], priority=priority)
+        request.name = name
+        pending.put(request)
+
+    assert [pending.get(0).name, pending.get(0).name] == ['chat-1', 'chat-2']
+    # Lower lanes stay queued while only reserved slots are free
+    assert pending.get(0) is None
+    assert pending.get(float('inf')).name == 'advice-1'
+    assert [r.name for r in pending.drain()] == ['advice-2', 'batch']
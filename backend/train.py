@@ -4,6 +4,8 @@ from datasets import load_dataset, Dataset
 from trl import SFTTrainer
 from transformers import TrainingArguments, TrainerCallback
 import json
+import config
+import export
 
 class StatusCallback(TrainerCallback):
     """Callback to track training progress and update status"""
@@ -206,6 +208,11 @@ def train_model(data_path, model_name, output_dir, max_steps=60,
         model.save_pretrained(output_dir)
         tokenizer.save_pretrained(output_dir)
         
+        if config.EXPORT_MERGED_AFTER_TRAINING:
+            if training_id and status_dict:
+                status_dict[training_id]['status'] = 'exporting'
+            export.export_merged(output_dir, dtype=config.MERGED_EXPORT_DTYPE, model=model, tokenizer=tokenizer)
+        
         if training_id and status_dict:
             status_dict[training_id].update({
                 'status': 'completed',
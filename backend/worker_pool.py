@@ -0,0 +1,419 @@
+import asyncio
+import itertools
+import multiprocessing
+import os
+import pickle
+import queue
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+
+import config
+from cancellation import GenerationCancelled
+from latency import LatencyTrace
+from loop_queue import LoopQueue
+from router import ModelRouter
+
+# Functions of the inference module a worker process will run on request
+WORKER_METHODS = {
+    'generate_response',
+    'stream_response',
+    'generate_speculative',
+    'generate_batch',
+    'cancel_generation',
+    'list_generations',
+    'get_cache_stats',
+    'evict_model',
+    'pin_model',
+    'unpin_model',
+    'clear_model_cache',
+}
+
+# Methods that are generators; their items are sent back one by one
+STREAM_METHODS = {'stream_response', 'generate_batch'}
+
+# Short calls that must not queue behind running generations
+CONTROL_METHODS = {
+    'cancel_generation',
+    'list_generations',
+    'get_cache_stats',
+    'evict_model',
+    'pin_model',
+    'unpin_model',
+    'clear_model_cache',
+}
+
+# Passed as a broadcast's on_timeout to raise instead of substituting a value
+_RAISE = object()
+
+
+class WorkerCrashed(Exception):
+    """Raised for requests that were running on a worker process that died"""
+
+
+def _portable_error(error):
+    """Exceptions are pickled across processes; fall back to a plain Exception"""
+    try:
+        pickle.dumps(error)
+        return error
+    except Exception:
+        return Exception(str(error))
+
+
+def _run_job(inference, job_id, method, kwargs, results):
+    # A latency trace is filled in here and shipped back with the result.
+    # Final messages also carry the models the worker holds, so the router
+    # learns about loads and evictions as they happen
+    trace = kwargs.get('trace')
+    try:
+        if method in STREAM_METHODS:
+            for chunk in getattr(inference, method)(**kwargs):
+                results.put((job_id, 'chunk', chunk, None))
+            results.put((job_id, 'done', trace, inference.resident_model_ids()))
+        else:
+            value = getattr(inference, method)(**kwargs)
+            results.put((job_id, 'done', value if trace is None else (value, trace), inference.resident_model_ids()))
+    except Exception as e:
+        results.put((job_id, 'error', _portable_error(e), inference.resident_model_ids()))
+
+
+def _worker_main(worker_id, jobs, results):
+    """Entry point of an inference worker process"""
+    import inference
+
+    print(f"🧵 Inference worker {worker_id} started")
+    # Jobs run on threads so the worker's schedulers can batch them together;
+    # control calls get their own threads so they never wait for a free one
+    executor = ThreadPoolExecutor(max_workers=config.WORKER_THREADS)
+    control = ThreadPoolExecutor(max_workers=config.WORKER_CONTROL_THREADS)
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        job_id, method, kwargs = job
+        target = control if method in CONTROL_METHODS else executor
+        target.submit(_run_job, inference, job_id, method, kwargs, results)
+    executor.shutdown(wait=False)
+    control.shutdown(wait=False)
+
+
+class InferenceWorkerPool:
+    """
+    Inference in separate worker processes, fed through local IPC queues
+
+    Each worker owns the models routed to it and runs its own schedulers, so
+    Flask threads only route requests and wait for results. Requests are
+    routed by model_id with a ModelRouter, which keeps a model on the worker
+    that already has it loaded; every finished job reports the models its
+    worker holds, so evictions reach the router right away. A worker that
+    crashes (e.g. OOM) fails its in-flight requests and is restarted without
+    taking the API down. Methods mirror the inference module.
+    """
+    def __init__(self, num_workers=None):
+        self.num_workers = num_workers or config.INFERENCE_WORKERS
+        self._ctx = multiprocessing.get_context('spawn')
+        self._processes = [None] * self.num_workers
+        self._job_queues = [None] * self.num_workers
+        self._result_queues = [None] * self.num_workers
+        self._jobs = {}
+        self._job_ids = itertools.count()
+        self._lock = threading.Lock()
+        self._closed = False
+        self.restarts = 0
+        self.router = ModelRouter(range(self.num_workers))
+
+        for worker_id in range(self.num_workers):
+            self._start_worker(worker_id)
+
+        threading.Thread(target=self._monitor, daemon=True).start()
+
+    def _start_worker(self, worker_id):
+        # Every worker gets fresh queues: a process killed mid-write can leave
+        # a shared queue's lock held forever
+        jobs = self._ctx.Queue()
+        results = self._ctx.Queue()
+        process = self._ctx.Process(
+            target=_worker_main,
+            args=(worker_id, jobs, results),
+            daemon=True,
+        )
+        process.start()
+        self._job_queues[worker_id] = jobs
+        self._result_queues[worker_id] = results
+        self._processes[worker_id] = process
+        threading.Thread(target=self._read_results, args=(worker_id, results), daemon=True).start()
+
+    def _monitor(self):
+        while not self._closed:
+            time.sleep(config.WORKER_MONITOR_INTERVAL)
+            for worker_id, process in enumerate(self._processes):
+                if self._closed or process.is_alive():
+                    continue
+                print(f"💥 Inference worker {worker_id} exited with code {process.exitcode}; restarting")
+                # _submit registers and enqueues under the same lock, so every
+                # job either is failed here or lands on the new worker's queue
+                with self._lock:
+                    sinks = self._take_jobs(worker_id)
+                    self.router.forget(worker_id)
+                    self.restarts += 1
+                    self._start_worker(worker_id)
+                self._fail_sinks(sinks, WorkerCrashed(
+                    f"Inference worker {worker_id} exited with code {process.exitcode}"
+                ))
+
+    def _take_jobs(self, worker_id):
+        """Remove and return the sinks of a worker's jobs; the caller holds _lock"""
+        failed = [job_id for job_id, (owner, _, _) in self._jobs.items() if owner == worker_id]
+        return [self._jobs.pop(job_id)[1] for job_id in failed]
+
+    def _fail_sinks(self, sinks, error):
+        for sink in sinks:
+            self._deliver(sink, 'error', error)
+
+    def _deliver(self, sink, kind, payload):
+        if not isinstance(sink, Future):
+            sink.put((kind, payload))
+            return
+        try:
+            if kind == 'error':
+                sink.set_exception(payload)
+            else:
+                sink.set_result(payload)
+        except InvalidStateError:
+            # Cancelled by an async caller that stopped waiting
+            pass
+
+    def _read_results(self, worker_id, results):
+        while not self._closed:
+            try:
+                job_id, kind, payload, resident = results.get(timeout=config.WORKER_MONITOR_INTERVAL)
+            except queue.Empty:
+                if self._result_queues[worker_id] is not results:
+                    return
+                continue
+            if resident is not None:
+                self.router.update_holdings(worker_id, resident)
+            with self._lock:
+                entry = self._jobs.get(job_id)
+                if entry is not None and kind != 'chunk':
+                    del self._jobs[job_id]
+            if entry is None:
+                continue
+
+            _, sink, routed = entry
+            if routed is not None and kind != 'chunk':
+                self.router.release(worker_id, routed)
+            self._deliver(sink, kind, payload)
+
+    def _submit(self, worker_id, method, kwargs, stream=False, routed=None, loop=None):
+        if method not in WORKER_METHODS:
+            raise ValueError(f"Unknown inference method: {method}")
+        sink = Future()
+        if stream:
+            sink = LoopQueue(loop) if loop is not None else queue.Queue()
+        job_id = next(self._job_ids)
+        with self._lock:
+            self._jobs[job_id] = (worker_id, sink, routed)
+            self._job_queues[worker_id].put((job_id, method, kwargs))
+        return sink
+
+    def _abandon(self, sink):
+        """Forget a job its caller stopped waiting for; a late result is dropped"""
+        with self._lock:
+            job_id = next((j for j, (_, other, _) in self._jobs.items() if other is sink), None)
+            entry = self._jobs.pop(job_id) if job_id is not None else None
+        if entry is not None and entry[2] is not None:
+            self.router.release(entry[0], entry[2])
+
+    def _broadcast(self, method, on_timeout=_RAISE, **kwargs):
+        """
+        Run a control call on every worker and return their results in worker order
+
+        A worker that does not answer within WORKER_CONTROL_TIMEOUT_SECONDS
+        contributes on_timeout(worker_id), or raises TimeoutError if none is given.
+        """
+        futures = [self._submit(w, method, kwargs) for w in range(self.num_workers)]
+        deadline = time.monotonic() + config.WORKER_CONTROL_TIMEOUT_SECONDS
+        results = []
+        for worker_id, future in enumerate(futures):
+            try:
+                results.append(future.result(timeout=max(0, deadline - time.monotonic())))
+            except FutureTimeout:
+                self._abandon(future)
+                if on_timeout is _RAISE:
+                    raise TimeoutError(f"Inference worker {worker_id} did not answer {method}")
+                results.append(on_timeout(worker_id))
+        return results
+
+    def _result_timeout(self, kwargs):
+        """Seconds to wait for a generation: its own timeout plus room for a model load"""
+        return (kwargs.get('timeout') or config.GENERATION_TIMEOUT_SECONDS) + config.WORKER_RESULT_GRACE_SECONDS
+
+    def _give_up(self, sink, kwargs):
+        """Stop waiting for a generation whose worker did not answer in time"""
+        self._abandon(sink)
+        if kwargs.get('request_id'):
+            self.cancel_generation(kwargs['request_id'], reason='timeout')
+        return GenerationCancelled('timeout')
+
+    def _route(self, method, model_path, kwargs, stream=False, loop=None):
+        """Send a generation to the worker the router picks for its model"""
+        kwargs['model_path'] = model_path
+        model_id = os.path.basename(os.path.normpath(model_path))
+        worker_id = self.router.route(model_id)
+        return self._submit(worker_id, method, kwargs, stream=stream, routed=model_id, loop=loop)
+
+    def _traced(self, method, model_path, kwargs, trace):
+        if trace is not None:
+            kwargs = dict(kwargs, trace=LatencyTrace())
+        future = self._route(method, model_path, kwargs)
+        try:
+            result = future.result(timeout=self._result_timeout(kwargs))
+        except FutureTimeout:
+            raise self._give_up(future, kwargs)
+        if trace is None:
+            return result
+        value, remote = result
+        trace.merge(remote)
+        return value
+
+    def generate_response(self, model_path, trace=None, **kwargs):
+        return self._traced('generate_response', model_path, kwargs, trace)
+
+    def generate_speculative(self, model_path, trace=None, **kwargs):
+        return self._traced('generate_speculative', model_path, kwargs, trace)
+
+    def stream_response(self, model_path, trace=None, **kwargs):
+        if trace is not None:
+            kwargs = dict(kwargs, trace=LatencyTrace())
+        return self._stream('stream_response', model_path, kwargs, trace)
+
+    def generate_batch(self, model_path, **kwargs):
+        # The whole batch runs on one worker so its scheduler can batch the prompts together
+        return self._stream('generate_batch', model_path, kwargs)
+
+    def _stream(self, method, model_path, kwargs, trace=None):
+        chunks = self._route(method, model_path, kwargs, stream=True)
+        # A batch job may legitimately go quiet for long; single generations may not
+        timeout = None if method == 'generate_batch' else self._result_timeout(kwargs)
+        finished = False
+        try:
+            while True:
+                try:
+                    kind, payload = chunks.get(timeout=timeout)
+                except queue.Empty:
+                    finished = True
+                    raise self._give_up(chunks, kwargs)
+                if kind == 'chunk':
+                    yield payload
+                elif kind == 'error':
+                    finished = True
+                    raise payload
+                else:
+                    finished = True
+                    if trace is not None and payload is not None:
+                        trace.merge(payload)
+                    return
+        finally:
+            if not finished and kwargs.get('request_id'):
+                self.cancel_generation(kwargs['request_id'], reason='client_disconnected')
+
+    async def agenerate_response(self, model_path, trace=None, **kwargs):
+        if trace is not None:
+            kwargs = dict(kwargs, trace=LatencyTrace())
+        future = self._route('generate_response', model_path, kwargs)
+        try:
+            result = await asyncio.wait_for(asyncio.wrap_future(future), self._result_timeout(kwargs))
+        except asyncio.TimeoutError:
+            raise await asyncio.get_running_loop().run_in_executor(None, self._give_up, future, kwargs)
+        if trace is None:
+            return result
+        value, remote = result
+        trace.merge(remote)
+        return value
+
+    async def astream_response(self, model_path, trace=None, **kwargs):
+        if trace is not None:
+            kwargs = dict(kwargs, trace=LatencyTrace())
+        chunks = self._route(
+            'stream_response', model_path, kwargs, stream=True, loop=asyncio.get_running_loop()
+        )
+        finished = False
+        try:
+            while True:
+                try:
+                    kind, payload = await asyncio.wait_for(chunks.get(), self._result_timeout(kwargs))
+                except asyncio.TimeoutError:
+                    finished = True
+                    raise await asyncio.get_running_loop().run_in_executor(None, self._give_up, chunks, kwargs)
+                if kind == 'chunk':
+                    yield payload
+                elif kind == 'error':
+                    finished = True
+                    raise payload
+                else:
+                    finished = True
+                    if trace is not None and payload is not None:
+                        trace.merge(payload)
+                    return
+        finally:
+            if not finished and kwargs.get('request_id'):
+                await asyncio.get_running_loop().run_in_executor(None, lambda: self.cancel_generation(
+                    kwargs['request_id'], reason='client_disconnected'
+                ))
+
+    def cancel_generation(self, request_id, reason='cancelled'):
+        return any(self._broadcast(
+            'cancel_generation', on_timeout=lambda worker_id: False, request_id=request_id, reason=reason
+        ))
+
+    def list_generations(self):
+        generations = []
+        for worker_id, items in enumerate(self._broadcast('list_generations', on_timeout=lambda worker_id: [])):
+            for item in items:
+                item['worker'] = worker_id
+                generations.append(item)
+        return generations
+
+    def get_cache_stats(self):
+        workers = dict(enumerate(self._broadcast(
+            'get_cache_stats', on_timeout=lambda worker_id: {'error': 'timed out'}
+        )))
+        return {
+            'workers': workers,
+            'router': self.router.stats(),
+            'restarts': self.restarts,
+        }
+
+    def evict_model(self, model_path):
+        self._broadcast('evict_model', model_path=model_path)
+
+    def pin_model(self, model_path):
+        self._broadcast('pin_model', model_path=model_path)
+
+    def unpin_model(self, model_path):
+        self._broadcast('unpin_model', model_path=model_path)
+
+    def clear_model_cache(self):
+        self._broadcast('clear_model_cache')
+
+    def shutdown(self):
+        self._closed = True
+        for jobs in self._job_queues:
+            jobs.put(None)
+        for process in self._processes:
+            process.join(timeout=5)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Return the process-wide worker pool, starting it on first use"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = InferenceWorkerPool()
+        return _pool